@@ -0,0 +1,137 @@
+# vim: set expandtab ts=4 sw=4 filetype=python fileencoding=utf8:
+
+"""
+Measure how long Dispatcher.dispatch takes as the number of handlers
+grows.
+
+Run it like this::
+
+    $ PYTHONPATH=. python benchmarks/bench_dispatch.py
+
+The "linear" column is the old approach, where every handler's route
+method gets called until one says yes.  The "indexed" column is the
+route table.  The indexed numbers should stay flat for handlers with
+route strings, and grow much slower than the linear numbers for
+handlers with route patterns.  The "cached" column is the dispatch
+cache.  All the numbers are microseconds per dispatch.
+"""
+
+import logging
+import re
+import timeit
+
+from horsemeat import configwrapper
+from horsemeat.webapp import frameworkhandlers
+from horsemeat.webapp.dispatcher import Dispatcher
+from horsemeat.webapp.handler import Handler
+from horsemeat.webapp.request import Request
+
+class BogusConnection(object):
+
+    def commit(self):
+        pass
+
+class BenchConfigWrapper(configwrapper.ConfigWrapper):
+
+    dispatcher_class = None
+
+    def get_postgresql_connection(self, register_composite_types=True):
+        return BogusConnection()
+
+    get_pgconn = get_postgresql_connection
+
+class CatchAll(frameworkhandlers.NotFound):
+    pass
+
+def make_handler_class(i, route_kind):
+
+    if route_kind == 'strings':
+
+        return type('Handler{0}'.format(i), (Handler,), dict(
+            route=Handler.check_route_strings,
+            route_strings=set([
+                'GET /page-{0}'.format(i),
+                'POST /page-{0}'.format(i)]),
+            handle=lambda self, req: None))
+
+    else:
+
+        return type('Handler{0}'.format(i), (Handler,), dict(
+            route=Handler.check_route_patterns,
+            route_patterns=[
+                re.compile(r'GET /page-{0}/(?P<thing_id>\d+)$'.format(i)),
+                re.compile(r'POST /page-{0}/(?P<thing_id>\d+)$'.format(i))],
+            handle=lambda self, req: None))
+
+class BenchDispatcher(Dispatcher):
+
+    request_class = None
+    error_page = None
+
+    def __init__(self, handler_count, route_kind, config_wrapper):
+        self.handler_count = handler_count
+        self.route_kind = route_kind
+        super(BenchDispatcher, self).__init__(None, None, config_wrapper)
+
+    def make_handlers(self):
+
+        self.handlers = [
+            make_handler_class(i, self.route_kind)(self.config_wrapper, self)
+            for i in range(self.handler_count)]
+
+        self.handlers.append(
+            CatchAll(self.config_wrapper, self))
+
+    def linear_dispatch(self, request):
+
+        for candidate in self.handlers:
+
+            thing = candidate.route(request)
+
+            if thing:
+                return thing
+
+def time_it(f, n=200):
+    return min(timeit.repeat(f, number=n, repeat=3)) / n * 1e6
+
+def main():
+
+    logging.disable(logging.CRITICAL)
+
+    uncached_cw = BenchConfigWrapper({'app': {'dispatch_cache_size': 0}})
+    cached_cw = BenchConfigWrapper({'app': {}})
+
+    print("{0:>9} {1:>9} {2:>8} {3:>12} {4:>12} {5:>12}".format(
+        "kind", "handlers", "request", "linear", "indexed", "cached"))
+
+    for route_kind, last_page, handler_count in [
+        (route_kind, last_page, handler_count)
+
+        for route_kind, last_page in [
+            ('strings', 'GET /page-{0}'),
+            ('patterns', 'GET /page-{0}/99')]
+
+        for handler_count in [10, 100, 300, 1000]]:
+
+        uncached = BenchDispatcher(handler_count, route_kind, uncached_cw)
+        cached = BenchDispatcher(handler_count, route_kind, cached_cw)
+
+        for label, line_one in [
+            ('last', last_page.format(handler_count - 1)),
+            ('404', 'GET /wp-login.php')]:
+
+            req = Request(None, None, dict(zip(
+                ['REQUEST_METHOD', 'PATH_INFO'],
+                line_one.split(' '))))
+
+            print("{0:>9} {1:>9} {2:>8} {3:>12.2f} {4:>12.2f} "
+                "{5:>12.2f}".format(
+                    route_kind,
+                    handler_count,
+                    label,
+                    time_it(lambda: uncached.linear_dispatch(req)),
+                    time_it(lambda: uncached.dispatch(req)),
+                    time_it(lambda: cached.dispatch(req))))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# vim: set expandtab ts=4 sw=4 filetype=python fileencoding=utf8:
+
+"""
+Measure how much private memory each forked worker ends up with when
+the master process preloads a big app, with and without
+ConfigWrapper.prepare_for_fork.
+
+Run it like this::
+
+    $ PYTHONPATH=. python benchmarks/bench_preload.py
+
+Each child touches nothing but runs a full garbage collection, which is
+what any worker does sooner or later.  Without gc.freeze, that
+collection writes to the header of every object the master made, and
+the kernel copies every page those objects live on.  The numbers are
+megabytes of private memory per child, so smaller is better.
+
+This only works on linux, since it reads /proc/self/smaps_rollup.
+"""
+
+import gc
+import logging
+import os
+import sys
+
+from horsemeat import configwrapper
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_dispatch import BenchConfigWrapper, BenchDispatcher
+
+def fork_and_measure(children=4):
+
+    """
+    Fork some children, have each one run a garbage collection, and
+    return the average private memory in megabytes.
+    """
+
+    results = []
+
+    for i in range(children):
+
+        r, w = os.pipe()
+        pid = os.fork()
+
+        if pid == 0:
+
+            os.close(r)
+            gc.collect()
+
+            os.write(w, str(
+                configwrapper.get_memory_usage().get('private', 0)).encode())
+
+            os._exit(0)
+
+        os.close(w)
+
+        with os.fdopen(r) as f:
+            results.append(int(f.read()))
+
+        os.waitpid(pid, 0)
+
+    return sum(results) / len(results) / 1024.0
+
+def main():
+
+    logging.disable(logging.CRITICAL)
+
+    if not os.path.exists('/proc/self/smaps_rollup'):
+        print("I need /proc/self/smaps_rollup to measure private memory")
+        return
+
+    print("{0:>9} {1:>12} {2:>12}".format(
+        "handlers", "plain", "frozen"))
+
+    for handler_count in [100, 1000, 5000]:
+
+        # Stuff that sticks around in a real app: handlers, compiled
+        # patterns, and a pile of small objects.
+        cw = BenchConfigWrapper({'app': {}})
+
+        dispatchers = [
+            BenchDispatcher(handler_count, 'patterns', cw),
+            BenchDispatcher(handler_count, 'strings', cw)]
+
+        ballast = [dict(n=i, s=str(i)) for i in range(handler_count * 100)]
+
+        plain = fork_and_measure()
+
+        cw.prepare_for_fork()
+        frozen = fork_and_measure()
+        gc.unfreeze()
+
+        print("{0:>9} {1:>12.2f} {2:>12.2f}".format(
+            handler_count, plain, frozen))
+
+        del dispatchers, ballast
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+# vim: set expandtab ts=4 sw=4 filetype=python fileencoding=utf8:
+
+"""
+Compare the row factories: psycopg2's NamedTupleCursor, psycopg's
+namedtuple_row, horsemeat.pg.get_row_maker, and plain tuples.
+
+Run it like this::
+
+    $ PYTHONPATH=. python benchmarks/bench_rows.py
+
+This doesn't need a database.  Every factory gets the same list of
+tuples, which is what the driver hands over after it has parsed the
+wire format, so the only difference left is the per-row work each
+factory does.  Each one also sums an int column, by name or by
+position, since rows that nobody reads don't happen in real life.
+
+The numbers are nanoseconds per row, so smaller is better.
+"""
+
+import datetime
+import gc
+import time
+
+import psycopg.rows
+import psycopg2.extras
+
+from horsemeat import pg
+
+column_names = ('person_id', 'email_address', 'display_name',
+    'person_status', 'is_superuser', 'inserted', 'updated')
+
+def make_tuples(row_count):
+
+    now = datetime.datetime.now()
+
+    return [
+        (i, 'p{0}@example.com'.format(i), 'Person {0}'.format(i),
+            'confirmed', False, now, now)
+        for i in range(row_count)]
+
+def psycopg2_named_tuples(tuples):
+
+    # This is what NamedTupleCursor.fetchall does.
+    Record = psycopg2.extras.NamedTupleCursor._cached_make_nt(column_names)
+    rows = list(map(Record._make, tuples))
+
+    return sum(row.person_id for row in rows)
+
+def psycopg_named_tuples(tuples):
+
+    make_row = psycopg.rows._make_nt(
+        'utf8', *(name.encode('utf8') for name in column_names))._make
+    rows = list(map(make_row, tuples))
+
+    return sum(row.person_id for row in rows)
+
+def compact_rows(tuples):
+
+    make_row = pg.get_row_maker(column_names)
+    rows = list(map(make_row, tuples))
+
+    return sum(row.person_id for row in rows)
+
+def plain_tuples(tuples):
+
+    rows = list(tuples)
+
+    return sum(row[0] for row in rows)
+
+factories = [
+    ('psycopg2', psycopg2_named_tuples),
+    ('psycopg', psycopg_named_tuples),
+    ('compact', compact_rows),
+    ('tuples', plain_tuples),
+]
+
+def time_it(f, tuples):
+
+    """
+    Return the best of a few runs, in nanoseconds per row.
+    """
+
+    # Fewer repeats for the big result sets, or this takes all day.
+    repeats = max(3, min(1000, 100000 // len(tuples)))
+
+    best = None
+
+    for i in range(repeats):
+
+        gc.collect()
+
+        started = time.perf_counter_ns()
+        f(tuples)
+        elapsed = time.perf_counter_ns() - started
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best / len(tuples)
+
+def main():
+
+    print("{0:>9} ".format("rows")
+        + " ".join("{0:>10}".format(name) for name, f in factories))
+
+    for row_count in [10, 1000, 100000, 1000000]:
+
+        tuples = make_tuples(row_count)
+
+        print("{0:>9} ".format(row_count)
+            + " ".join(
+                "{0:>10.1f}".format(time_it(f, tuples))
+                for name, f in factories))
+
+        del tuples
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,10 @@
 # vim: set expandtab ts=4 sw=4 filetype=python:
 
 import abc
+import concurrent.futures
 import contextlib
 import datetime
+import gc
 import importlib
 import json
 import logging
@@ -12,6 +14,8 @@ import os
 import smtplib
 import sys
 import textwrap
+import threading
+import time
 import traceback
 import uuid
 import warnings
@@ -21,12 +25,22 @@ import jinja2
 # import pkg_resources
 import psycopg2, psycopg2.extras
 import psycopg
+import werkzeug.local
 import yaml
 
 from horsemeat import fancyjsondumps
+from horsemeat import pg
+from horsemeat.webapp.request import current_request
 
 log = logging.getLogger(__name__)
 
+# After a fork, the child process holds onto the connections it
+# inherited in here, rather than letting them get garbage collected.
+# psycopg2 sends a terminate message when a connection gets cleaned up,
+# and that would hang up on the parent process, since the child and the
+# parent share the same socket.
+inherited_connections = []
+
 class ConfigWrapper(object):
 
     """
@@ -59,8 +73,34 @@ class ConfigWrapper(object):
         self.config_dictionary = config_dictionary
         self.yaml_file_name = yaml_file_name
 
-        self.postgresql_connection = None
+        # Each thread gets its own database connection, so a worker can
+        # run more than one thread.  This maps thread idents to
+        # connections.  See the postgresql_connection property.
+        self.postgresql_connections = dict()
+
         self.jinja2_environment = None
+        self.async_jinja2_environment = None
+        self.query_executor = None
+        self.query_executor_lock = threading.Lock()
+
+        self.connection_pool = None
+        self.connection_pool_lock = threading.Lock()
+
+        self.replica_router = None
+        self.replica_router_lock = threading.Lock()
+
+    @property
+    def postgresql_connection(self):
+        return self.postgresql_connections.get(threading.get_ident())
+
+    @postgresql_connection.setter
+    def postgresql_connection(self, pgconn):
+
+        if pgconn is None:
+            self.postgresql_connections.pop(threading.get_ident(), None)
+
+        else:
+            self.postgresql_connections[threading.get_ident()] = pgconn
 
     @classmethod
     def from_yaml_file_name(cls, filename):
@@ -130,20 +170,240 @@ class ConfigWrapper(object):
 
     def get_postgresql_connection(self, register_composite_types=True):
 
-        if not self.postgresql_connection:
+        """
+        Return the connection this thread or request should use right
+        now.  That's a replica when the dispatcher said this request
+        can read from one and one is caught up, and the primary
+        otherwise.
+        """
+
+        if pg.current_database_role.get(None) == 'replica':
+
+            pgconn = self.get_replica_postgresql_connection()
+
+            if pgconn is not None:
 
-            pgconn = self.make_database_connection(
-                register_composite_types=register_composite_types)
+                pg.set_transaction_mode(
+                    pgconn,
+                    pg.current_transaction_mode.get(None))
 
-            # Keep a reference to this connection, so that
-            # we can just recycle this connection.
-            self.postgresql_connection = pgconn
+                return pgconn
 
-        return self.postgresql_connection
+        return self.get_primary_postgresql_connection(
+            register_composite_types=register_composite_types)
 
     # Short aliases are fun too.
     get_pgconn = get_postgresql_connection
 
+    def get_primary_postgresql_connection(self,
+        register_composite_types=True):
+
+        """
+        Return the connection to the primary, even while the request is
+        reading from a replica.  Use this for writes.
+        """
+
+        # While the dispatcher handles a request with a connection pool,
+        # the request's lease checks a connection out the first time
+        # anybody asks.
+        lease = pg.current_lease.get(None)
+
+        if lease is not None and lease.pool is not None:
+            pgconn = lease.get()
+
+        else:
+
+            pgconn = self.postgresql_connection
+
+            if not pgconn:
+
+                pgconn = self.make_database_connection(
+                    register_composite_types=register_composite_types)
+
+                # Keep a reference to this connection, so that this
+                # thread can just recycle this connection.
+                self.postgresql_connection = pgconn
+
+        # Handlers can ask for read only, autocommit, or serializable
+        # transactions.  Outside of those handlers, this puts the
+        # connection back the way it was.  When the handler reads from
+        # a replica, the replica gets the handler's mode, and the
+        # primary stays regular, for the writes.
+        if pg.current_database_role.get(None) == 'replica':
+            pg.set_transaction_mode(pgconn, None)
+
+        else:
+
+            pg.set_transaction_mode(
+                pgconn,
+                pg.current_transaction_mode.get(None))
+
+        return pgconn
+
+    get_primary_pgconn = get_primary_postgresql_connection
+
+    def get_replica_postgresql_connection(self):
+
+        """
+        Return this request's connection to a replica, or None when
+        there are no replicas, or they're all too far behind or busy.
+        """
+
+        router = self.get_replica_router()
+
+        if router:
+            return router.get()
+
+    def get_pgconn_if_connected(self):
+
+        """
+        Return the connection to the primary that get_pgconn would
+        return, but only if it exists already.  The dispatcher uses
+        this to commit without checking out a connection just to commit
+        nothing.
+        """
+
+        lease = pg.current_lease.get(None)
+
+        if lease is not None and lease.pool is not None:
+            return lease.pgconn
+
+        else:
+            return self.postgresql_connection
+
+    def get_pgconns_if_connected(self):
+
+        """
+        Return a list of the connections this thread or request already
+        has, to the primary and to a replica.
+        """
+
+        pgconns = [self.get_pgconn_if_connected()]
+
+        if self.replica_router:
+            pgconns.append(self.replica_router.get_if_connected())
+
+        return [pgconn for pgconn in pgconns if pgconn is not None]
+
+    def get_replica_router(self):
+
+        """
+        Return a horsemeat.pg.ReplicaRouter if the postgresql section
+        in the yaml file lists some replicas, like this::
+
+            postgresql:
+                host: db1
+                database: horsemeat
+                replicas:
+                    - host: db2
+                    - host: db3
+                      port: 5433
+                replica_max_lag_seconds: 5
+
+        Each replica only needs whatever is different from the primary.
+        Each one gets a pool of its own, with room for as many
+        connections as the primary's pool, or 10 without one.
+
+        Otherwise, return None, and everything goes to the primary.
+        """
+
+        if self.replica_router is None and self.replicas:
+
+            with self.replica_router_lock:
+
+                if self.replica_router is None:
+
+                    self.replica_router = pg.ReplicaRouter(
+                        self.make_replica_connection,
+                        self.replicas,
+                        max_lag_seconds=self.replica_max_lag_seconds,
+                        check_interval=self.config_dictionary[
+                            'postgresql'].get('replica_check_interval', 5.0),
+                        max_size=self.config_dictionary['postgresql'].get(
+                            'pool', {}).get('max_size', 10))
+
+                    log.info("Made {0}".format(self.replica_router))
+
+        return self.replica_router
+
+    @property
+    def replicas(self):
+        return self.config_dictionary.get('postgresql', {}).get('replicas', [])
+
+    @property
+    def replica_max_lag_seconds(self):
+
+        """
+        Requests go back to the primary when the replica is more than
+        this many seconds behind.
+        """
+
+        return self.config_dictionary['postgresql'].get(
+            'replica_max_lag_seconds', 5.0)
+
+    @property
+    def route_safe_methods_to_replicas(self):
+
+        """
+        When there are replicas, GET and HEAD requests read from them,
+        unless you set this to false under postgresql.  Then only
+        handlers with a read only transaction_mode or use_replica set
+        to True do.
+        """
+
+        return self.config_dictionary['postgresql'].get(
+            'route_safe_methods_to_replicas', True)
+
+    def make_replica_connection(self, replica):
+
+        """
+        Connect to one of the replicas listed in the yaml file, using
+        the primary's settings for anything the replica doesn't set.
+        """
+
+        overrides = dict(replica)
+
+        if 'database' in overrides:
+            overrides['dbname'] = overrides.pop('database')
+
+        return self.make_database_connection(
+            register_composite_types=self.should_register_composite_types,
+            **overrides)
+
+    def get_connection_pool(self):
+
+        """
+        Return a horsemeat.pg.ConnectionPool if there's a pool section
+        under postgresql in the yaml file, like this::
+
+            postgresql:
+                pool:
+                    min_size: 2
+                    max_size: 10
+                    timeout: 30
+                    check_interval: 30
+
+        Otherwise, return None, and every thread keeps its own
+        connection.
+        """
+
+        if self.connection_pool is None \
+        and 'pool' in self.config_dictionary.get('postgresql', {}):
+
+            with self.connection_pool_lock:
+
+                if self.connection_pool is None:
+
+                    self.connection_pool = pg.ConnectionPool(
+                        self.make_database_connection,
+                        **self.config_dictionary['postgresql']['pool'])
+
+                    self.connection_pool.fill()
+
+                    log.info("Made {0}".format(self.connection_pool))
+
+        return self.connection_pool
+
     @contextlib.contextmanager
     def get_autocommitting_postgresql_connection(self):
 
@@ -160,12 +420,83 @@ class ConfigWrapper(object):
 
         """
 
+        # Commit the same connection we hand out, which might be a
+        # leased one, not this thread's.
+        pgconn = self.get_postgresql_connection()
+
         try:
-            yield self.get_postgresql_connection()
+            yield pgconn
 
         finally:
             log.info("Committing postgresql connection...")
-            self.postgresql_connection.commit()
+            pgconn.commit()
+
+    @property
+    def instrument_queries(self):
+
+        """
+        Every query from a connection made by this config wrapper gets
+        counted and timed for the request that ran it, unless you set
+        instrument_queries to false under postgresql.
+        """
+
+        return self.config_dictionary['postgresql'].get(
+            'instrument_queries', True)
+
+    @property
+    def slow_query_seconds(self):
+
+        """
+        Queries that take at least this long get their plans logged to
+        the horsemeat.slowqueries logger.  Set it to null to turn that
+        off.
+        """
+
+        return self.config_dictionary.get('postgresql', {}).get(
+            'slow_query_seconds', 1.0)
+
+    @property
+    def n_plus_one_threshold(self):
+
+        """
+        Warn when one request runs the same statement more times than
+        this.
+        """
+
+        return self.config_dictionary.get('postgresql', {}).get(
+            'n_plus_one_threshold', 10)
+
+    def get_query_executor(self):
+
+        """
+        The thread pool that horsemeat.pg.run_queries_concurrently uses.
+        Every thread in it keeps its own database connection, so this
+        doubles as a pool of connections.
+        """
+
+        if not self.query_executor:
+
+            with self.query_executor_lock:
+
+                if not self.query_executor:
+
+                    self.query_executor = \
+                    concurrent.futures.ThreadPoolExecutor(
+                        max_workers=self.query_threads,
+                        thread_name_prefix='horsemeat-query')
+
+        return self.query_executor
+
+    @property
+    def query_threads(self):
+
+        """
+        How many queries run_queries_concurrently runs at once, which
+        is also how many extra database connections each process might
+        open.
+        """
+
+        return self.config_dictionary['postgresql'].get('query_threads', 4)
 
     @property
     def database_host(self):
@@ -191,10 +522,14 @@ class ConfigWrapper(object):
     def database_password(self):
         return self.config_dictionary['postgresql'].get('password')
 
-    def make_psycopg_database_connection(self, register_composite_types=True):
+    def make_psycopg_database_connection(self, register_composite_types=True,
+        **overrides):
 
         """
         This is NOT psycopg2, but psycopg3, which goes by psycopg.
+
+        Anything in overrides, like host or port, replaces the setting
+        from the yaml file.
         """
 
         if self.config_dictionary["postgresql"].get("psycopg_version") != "psycopg":
@@ -204,15 +539,15 @@ class ConfigWrapper(object):
         else:
 
             pgconn = psycopg.connect(
-                row_factory=psycopg.rows.namedtuple_row,
-                port=self.database_port,
-                dbname=self.database_name,
-                host=self.database_host,
-                user=self.database_user,
-                password=self.database_password)
+                row_factory=pg.compact_row,
+                cursor_factory=pg.InstrumentedCursor
+                    if self.instrument_queries else psycopg.Cursor,
+                **self.database_connection_settings(**overrides))
 
             log.info(f"Just made postgresql connection {pgconn} (composite types registered: {register_composite_types}.")
 
+            pg.register_json_adapters(pgconn)
+
             # psycopg2.extras.register_uuid()
             # psycopg2.extras.register_hstore(pgconn, globally=True)
             # psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
@@ -223,15 +558,37 @@ class ConfigWrapper(object):
 
             return pgconn
 
-    def make_psycopg2_database_connection(self, register_composite_types=True):
+    async def make_async_database_connection(self,
+        register_composite_types=True):
+
+        """
+        Make a psycopg (3) AsyncConnection for async handlers.  This
+        works even if the sync connections come from psycopg2.
+        """
+
+        pgconn = await psycopg.AsyncConnection.connect(
+            row_factory=pg.compact_row,
+            cursor_factory=pg.InstrumentedAsyncCursor
+                if self.instrument_queries else psycopg.AsyncCursor,
+            **self.database_connection_settings())
+
+        log.info(f"Just made async postgresql connection {pgconn} (composite types registered: {register_composite_types}.")
+
+        pg.register_json_adapters(pgconn)
+
+        if register_composite_types:
+            await self.register_psycopg_async_composite_types(pgconn)
+
+        return pgconn
+
+    def make_psycopg2_database_connection(self, register_composite_types=True,
+        **overrides):
 
         pgconn = psycopg2.connect(
             connection_factory=psycopg2.extras.NamedTupleConnection,
-            port=self.database_port,
-            database=self.database_name,
-            host=self.database_host,
-            user=self.database_user,
-            password=self.database_password)
+            cursor_factory=pg.InstrumentedNamedTupleCursor
+                if self.instrument_queries else pg.CompactRowCursor,
+            **self.database_connection_settings(**overrides))
 
         log.info(f"Just made postgresql connection {pgconn} (composite types registered: {register_composite_types}.")
 
@@ -241,12 +598,33 @@ class ConfigWrapper(object):
         psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
         psycopg2.extensions.register_type(psycopg2.extensions.UNICODEARRAY)
 
+        pg.register_json_adapters(pgconn)
+
         if register_composite_types:
             self.register_psycopg2_composite_types(pgconn)
 
         return pgconn
 
-    def make_database_connection(self, register_composite_types=True):
+    def database_connection_settings(self, **overrides):
+
+        """
+        The keyword arguments both psycopg2.connect and psycopg.connect
+        want, with anything in overrides swapped in.
+        """
+
+        settings = dict(
+            port=self.database_port,
+            dbname=self.database_name,
+            host=self.database_host,
+            user=self.database_user,
+            password=self.database_password)
+
+        settings.update(overrides)
+
+        return settings
+
+    def make_database_connection(self, register_composite_types=True,
+        **overrides):
 
         """
         Defaults to psycopg2, not the fancy newer psycopg, which is
@@ -259,10 +637,10 @@ class ConfigWrapper(object):
         # until I get tests passing.
         if self.config_dictionary["postgresql"].get("psycopg_version") != "psycopg":
             log.warning("psycopg2 is fine but psycopg is the library that is going to keep getting better")
-            return self.make_psycopg2_database_connection(register_composite_types=register_composite_types)
+            return self.make_psycopg2_database_connection(register_composite_types=register_composite_types, **overrides)
 
         else:
-            return self.make_psycopg_database_connection(register_composite_types=register_composite_types)
+            return self.make_psycopg_database_connection(register_composite_types=register_composite_types, **overrides)
 
     # Make aliases because Matt can't remember stuff well.
     create_postgresql_connection = make_database_connection
@@ -275,6 +653,13 @@ class ConfigWrapper(object):
         """
         pass
 
+    async def register_psycopg_async_composite_types(self, pgconn):
+
+        """
+        Subclasses can define this if they want to.
+        """
+        pass
+
     def register_psycopg2_composite_types(self, pgconn):
 
         """
@@ -393,6 +778,8 @@ class ConfigWrapper(object):
             extensions=['jinja2.ext.loopcontrols'],
         )
 
+        j.template_class = RequestAwareTemplate
+
         log.info("Just built a jinja2 environment")
 
         self.jinja2_environment = j
@@ -423,6 +810,12 @@ class ConfigWrapper(object):
         # Give jinja a reference to the configwrapper.
         j.globals['cw'] = self
 
+        # These stand in for the current request in templates that
+        # didn't get it passed in when they rendered, like macros in
+        # imported templates.  See RequestAwareTemplate.
+        j.globals['request'] = werkzeug.local.LocalProxy(current_request)
+        j.globals['req'] = werkzeug.local.LocalProxy(current_request)
+
         self.add_more_stuff_to_jinja2_globals()
 
         return j
@@ -444,6 +837,21 @@ class ConfigWrapper(object):
     def j(self):
         return self.get_jinja2_environment()
 
+    def get_async_jinja2_environment(self):
+
+        """
+        Same templates, globals, and loaders as the regular jinja2
+        environment, but with enable_async turned on, so templates can
+        render with render_async and await stuff.
+        """
+
+        if not self.async_jinja2_environment:
+
+            self.async_jinja2_environment = \
+            self.get_jinja2_environment().overlay(enable_async=True)
+
+        return self.async_jinja2_environment
+
 
     @property
     def scheme(self):
@@ -515,6 +923,100 @@ class ConfigWrapper(object):
 
         self.get_postgresql_connection()
 
+    def disconnect_everything(self):
+
+        """
+        Close connections to all the external services we connected to.
+
+        The next call to get_postgresql_connection makes a fresh one.
+
+        We don't hold on to SMTP connections (see make_smtp_connection),
+        so there's nothing to do for those.
+        """
+
+        while self.postgresql_connections:
+
+            _, pgconn = self.postgresql_connections.popitem()
+            pgconn.close()
+
+        if self.connection_pool:
+            self.connection_pool.close()
+            self.connection_pool = None
+
+        if self.replica_router:
+            self.replica_router.close()
+            self.replica_router = None
+
+    def prepare_for_fork(self):
+
+        """
+        Run this in the gunicorn master process after the app is built,
+        when gunicorn runs with preload_app.  build_webapp does this for
+        you when preload_app is true under app in the yaml file.
+
+        This closes the database connection, so the workers don't all
+        share one socket, and then freezes everything allocated so far,
+        so the garbage collector in each worker doesn't write to all
+        those handlers, templates, and compiled regular expressions and
+        make private copies of them.
+        """
+
+        self.disconnect_everything()
+
+        # Threads don't survive a fork, so don't bring a thread pool
+        # along.
+        if self.query_executor:
+            self.query_executor.shutdown(wait=True)
+            self.query_executor = None
+
+        gc.collect()
+        gc.freeze()
+
+        log.info("Ready to fork with {0} objects frozen; {1}".format(
+            gc.get_freeze_count(),
+            describe_memory_usage()))
+
+    def reset_after_fork(self):
+
+        """
+        Run this in each worker right after it gets forked.
+
+        If the parent still had database connections open, from any of
+        its threads, we forget about them (without closing them) and
+        make a new one the next time somebody asks.
+        """
+
+        self.query_executor = None
+        self.query_executor_lock = threading.Lock()
+
+        if self.connection_pool:
+            inherited_connections.extend(self.connection_pool.forget())
+            self.connection_pool = None
+
+        if self.replica_router:
+            inherited_connections.extend(self.replica_router.forget())
+            self.replica_router = None
+
+        if self.postgresql_connections:
+
+            inherited_connections.extend(
+                self.postgresql_connections.values())
+
+            self.postgresql_connections.clear()
+
+            log.warning("Inherited a database connection from the parent "
+                "process.  Run prepare_for_fork before forking!")
+
+    @property
+    def preload_app(self):
+
+        """
+        Set this to true under app in the yaml file when gunicorn runs
+        with preload_app, so build_webapp gets ready to fork.
+        """
+
+        return self.config_dictionary['app'].get('preload_app', False)
+
     @property
     def dev_mode(self):
 
@@ -532,6 +1034,8 @@ class ConfigWrapper(object):
 
     def build_webapp(self):
 
+        started = time.monotonic()
+
         self.set_as_default()
         self.configure_logging()
 
@@ -541,9 +1045,18 @@ class ConfigWrapper(object):
         j = self.get_jinja2_environment()
         pgconn = self.get_postgresql_connection()
 
-        return self.dispatcher_class(j, pgconn, self,
+        webapp = self.dispatcher_class(j, pgconn, self,
             self.enable_access_control)
 
+        log.info("Built webapp in {0:.3f} seconds; {1}".format(
+            time.monotonic() - started,
+            describe_memory_usage()))
+
+        if self.preload_app:
+            self.prepare_for_fork()
+
+        return webapp
+
     def run_production_mode_stuff(self):
 
         """
@@ -567,14 +1080,159 @@ class ConfigWrapper(object):
     def webapp_port(self):
         return self.config_dictionary["app"]["webapp_port"]
 
+    @property
+    def webapp_host(self):
+        return self.config_dictionary["app"].get("webapp_host", "127.0.0.1")
+
     @property
     def num_webapp_workers(self):
-        return self.config_dictionary["app"].get("num_webapp_workers", 1)
+
+        """
+        Set num_webapp_workers to auto to get two workers per CPU plus
+        one.
+
+        >>> ConfigWrapper({'app': {}}).num_webapp_workers
+        1
+
+        >>> cw = ConfigWrapper({'app': {'num_webapp_workers': 'auto'}})
+        >>> cw.num_webapp_workers == (os.cpu_count() or 1) * 2 + 1
+        True
+        """
+
+        n = self.config_dictionary["app"].get("num_webapp_workers", 1)
+
+        if n == "auto":
+            return (os.cpu_count() or 1) * 2 + 1
+
+        else:
+            return n
+
+    @property
+    def num_webapp_threads(self):
+
+        """
+        Threads per worker.  More than one makes gunicorn use its
+        gthread worker.  Set this to auto to get one per CPU.
+        """
+
+        n = self.config_dictionary["app"].get("num_webapp_threads", 1)
+
+        if n == "auto":
+            return os.cpu_count() or 1
+
+        else:
+            return n
 
     @property
     def webapp_timeout_secs(self):
         return self.config_dictionary["app"].get("webapp_timeout", 30)
 
+    @property
+    def latency_budget_secs(self):
+
+        """
+        How long a request gets before its queries get canceled.
+        Handlers can set their own latency_budget.
+
+        This defaults to a little less than webapp_timeout, so the
+        database gives up before gunicorn kills the worker.  The
+        timeout rides along with the first query of each transaction,
+        so it doesn't cost a round trip.  Set latency_budget to null
+        under app to turn it off.
+        """
+
+        return self.config_dictionary["app"].get(
+            "latency_budget",
+            self.webapp_timeout_secs * 0.9)
+
+    @property
+    def webapp_graceful_timeout_secs(self):
+
+        """
+        How long workers get to finish their requests after a HUP or a
+        TERM before they get killed.
+        """
+
+        return self.config_dictionary["app"].get(
+            "webapp_graceful_timeout",
+            self.webapp_timeout_secs)
+
+    @property
+    def webapp_reuse_port(self):
+
+        """
+        Set SO_REUSEPORT on the listening socket, so a new master can
+        bind the same port while the old one drains.
+        """
+
+        return self.config_dictionary["app"].get("webapp_reuse_port", True)
+
+    @property
+    def asgi_max_threads(self):
+
+        """
+        How many threads the ASGI dispatcher uses to run sync handlers.
+        None means let concurrent.futures pick.
+        """
+
+        return self.config_dictionary["app"].get("asgi_max_threads")
+
+    @property
+    def asgi_max_async_connections(self):
+
+        """
+        How many async connections the ASGI dispatcher lets async
+        handlers hold at once.  A handler that wants one more waits for
+        somebody to give one back, for up to asgi_async_connection_timeout
+        seconds.
+        """
+
+        return self.config_dictionary["app"].get(
+            "asgi_max_async_connections", 10)
+
+    @property
+    def asgi_async_connection_timeout(self):
+        return self.config_dictionary["app"].get(
+            "asgi_async_connection_timeout", 30.0)
+
+    @property
+    def liveness_path(self):
+        return self.config_dictionary["app"].get("liveness_path")
+
+    @property
+    def readiness_path(self):
+        return self.config_dictionary["app"].get("readiness_path")
+
+    @property
+    def readiness_checks_database(self):
+        return self.config_dictionary["app"].get(
+            "readiness_checks_database", True)
+
+    @property
+    def readiness_cache_seconds(self):
+        return self.config_dictionary["app"].get(
+            "readiness_cache_seconds", 1.0)
+
+    @property
+    def dispatch_cache_size(self):
+
+        """
+        How many line ones the dispatcher remembers.  Set this to 0 to
+        turn off the dispatch cache.
+        """
+
+        return self.config_dictionary["app"].get("dispatch_cache_size", 1024)
+
+    @property
+    def handler_manifest_path(self):
+
+        """
+        Point this at a file written by Dispatcher.write_handler_manifest
+        and the dispatcher will load handlers on first use.
+        """
+
+        return self.config_dictionary["app"].get("handler_manifest")
+
     @property
     def update_expires(self):
         """
@@ -584,12 +1242,87 @@ class ConfigWrapper(object):
 
         return self.config_dictionary["app"].get("update_expires", False)
 
+class RequestAwareTemplate(jinja2.Template):
+
+    """
+    Every time a template renders while the dispatcher handles a
+    request, the template gets that request as request and req, unless
+    the caller passed in its own.
+
+    This used to work by sticking the request into the environment's
+    globals, but the environment is shared by every thread in the
+    process.
+    """
+
+    @staticmethod
+    def add_current_request(data):
+
+        req = current_request.get(None)
+
+        if req is not None:
+            data.setdefault('request', req)
+            data.setdefault('req', req)
+
+        return data
+
+    def render(self, *args, **kwargs):
+        return super(RequestAwareTemplate, self).render(
+            self.add_current_request(dict(*args, **kwargs)))
+
+    def render_async(self, *args, **kwargs):
+        return super(RequestAwareTemplate, self).render_async(
+            self.add_current_request(dict(*args, **kwargs)))
+
+    def generate(self, *args, **kwargs):
+        return super(RequestAwareTemplate, self).generate(
+            self.add_current_request(dict(*args, **kwargs)))
+
 class MissingConfig(KeyError):
 
     """
     You need to add some more stuff to your config file!
     """
 
+def get_memory_usage():
+
+    """
+    Return a dictionary with this process's resident set size, and on
+    linux, its proportional set size and private memory, all in
+    kilobytes.
+
+    After a fork, the private number is the one to watch.  Everything
+    else is shared with the parent.
+    """
+
+    d = dict()
+
+    try:
+
+        with open('/proc/self/smaps_rollup') as f:
+
+            for line in f:
+
+                k, _, v = line.partition(':')
+
+                if k in ('Rss', 'Pss', 'Private_Clean', 'Private_Dirty'):
+                    d[k.lower()] = int(v.split()[0])
+
+        d['private'] = d.pop('private_clean', 0) \
+        + d.pop('private_dirty', 0)
+
+    except (IOError, OSError, ValueError):
+
+        import resource
+
+        d['rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return d
+
+def describe_memory_usage():
+
+    return ', '.join('{0}: {1:.1f} MB'.format(k, v / 1024.0)
+        for k, v in sorted(get_memory_usage().items()))
+
 def log_uncaught_exceptions(ex_cls, ex, tb):
     log.critical(''.join(traceback.format_tb(tb)))
     log.critical('{0}: {1}'.format(ex_cls, ex))
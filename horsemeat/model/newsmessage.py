@@ -1,10 +1,35 @@
 # vim: set expandtab ts=4 sw=4 filetype=python:
 
 import logging
-import textwrap
+
+from horsemeat.pg import statements
 
 log = logging.getLogger(__name__)
 
+insert_news_message = statements.register('insert_news_message', """
+    insert into news_messages
+    (
+        session_uuid,
+        news_message
+    )
+
+    values
+    (
+        %(session_uuid)s,
+        %(news_message)s
+    )
+
+    returning news_message_id""")
+
+select_latest_unread_news_message = statements.register(
+    'select_latest_unread_news_message', """
+    select news_message_id, news_message
+    from news_messages
+    where session_uuid = %s and has_been_read = false
+    order by inserted
+    desc limit 1
+    """)
+
 class NewsMessageQueryMaker(object):
 
     """
@@ -20,21 +45,7 @@ class NewsMessageQueryMaker(object):
 
     @property
     def insert_query(self):
-
-        return textwrap.dedent("""
-            insert into news_messages
-            (
-                session_uuid,
-                news_message
-            )
-
-            values
-            (
-                %(session_uuid)s,
-                %(news_message)s
-            )
-
-            returning news_message_id""")
+        return insert_news_message.sql
 
     @property
     def bound_variables(self):
@@ -47,12 +58,21 @@ class NewsMessageQueryMaker(object):
 
         cursor = dbconn.cursor()
 
-        cursor.execute(self.insert_query, self.bound_variables)
+        insert_news_message.execute(cursor, self.bound_variables)
 
         self.news_message_id = cursor.fetchone()
 
         return self.news_message_id
 
+    def insert_later(self, deferred_statements):
+
+        """
+        Use this instead of insert when you don't need the new
+        news_message_id.  The insert goes out with the commit.
+        """
+
+        deferred_statements.add(insert_news_message, self.bound_variables)
+
 
 """
 
@@ -64,18 +84,11 @@ def pop_news_message(pgconn, session_uuid):
 
     try:
 
-        pgconn.execute(textwrap.dedent("""
-
-            select news_message_id, news_message
-            from news_messages
-            where session_uuid = %s and has_been_read = false
-            order by inserted
-            desc limit 1;
-        """), [session_uuid])
+        cursor = pgconn.cursor()
 
-        values = pgconn.cursor.fetchone()
+        select_latest_unread_news_message.execute(cursor, [session_uuid])
 
-        return values['news_message']
+        return cursor.fetchone().news_message
 
 
     except Exception as e:
@@ -1,13 +1,121 @@
 # vim: set expandtab ts=4 sw=4 filetype=python:
 
-import json
 import logging
-import textwrap
 
-import psycopg2.extras
+from horsemeat.pg import Jsonb
+from horsemeat.pg import SlotsCompositeCaster
+from horsemeat.pg import SlotsRecord
+from horsemeat.pg import statements
 
 log = logging.getLogger(__name__)
 
+# These get dedented once, right here, and prepared once per connection.
+# See horsemeat.pg.Statement.
+
+insert_session = statements.register('insert_session', """
+    insert into webapp_sessions
+    (
+        person_id,
+        news_message,
+        redirect_to_url
+    )
+
+    values
+    (
+        %(person_id)s,
+        %(news_message)s,
+        %(redirect_to_this_url)s
+    )
+
+    returning session_uuid""")
+
+update_session_data = statements.register('update_session_data', """
+    update webapp_session_data
+    set session_data = (%s)
+    where session_uuid = (%s)
+    and namespace = (%s)
+    """)
+
+insert_session_data = statements.register('insert_session_data', """
+    insert into webapp_session_data
+    (session_uuid, namespace, session_data)
+    values
+    (%s, %s, %s)
+    """)
+
+select_all_session_namespaces = statements.register(
+    'select_all_session_namespaces', """
+    select session_uuid, namespace, session_data, inserted,
+    updated
+
+    from webapp_session_data
+
+    where session_uuid = (%s)
+    """)
+
+select_one_session_namespace = statements.register(
+    'select_one_session_namespace', """
+    select session_uuid, namespace, session_data, inserted,
+    updated
+
+    from webapp_session_data
+
+    where session_uuid = (%s)
+    and namespace = (%s)
+    """)
+
+expire_session = statements.register('expire_session', """
+    update webapp_sessions
+    set expires = current_timestamp
+    where session_uuid = (%(session_uuid)s)
+    and expires > current_timestamp
+    returning expires
+    """)
+
+expire_all_sessions_for_person = statements.register(
+    'expire_all_sessions_for_person', """
+    update webapp_sessions
+    set expires = current_timestamp
+    where person_uuid = (%(person_uuid)s)
+    and expires > current_timestamp
+    returning (webapp_sessions.*)::webapp_sessions as expired_session
+    """)
+
+update_session_expires = statements.register('update_session_expires', """
+    update webapp_sessions
+    set expires = default
+    where session_uuid = (%(session_uuid)s)
+    and expires > current_timestamp
+    returning expires
+    """)
+
+select_session_data = statements.register('select_session_data', """
+    select session_data
+    from webapp_session_data
+    where session_uuid = %s
+    and namespace = %s
+    """)
+
+delete_session_data = statements.register('delete_session_data', """
+    delete from webapp_session_data
+    where session_uuid = %s
+    and namespace = %s
+    """)
+
+start_session_after_checking_password = statements.register(
+    'start_session_after_checking_password', """
+    insert into webapp_sessions
+    (person_id)
+    select person_id
+    from people
+    where email_address = %(email_address)s
+    and salted_hashed_password = crypt(
+        %(password)s,
+        salted_hashed_password)
+    and person_status = 'confirmed'
+    returning (webapp_sessions.*)::webapp_sessions as gs
+    """)
+
 class SessionInserter(object):
 
     def __init__(self, person_id, news_message=None, redirect_to_this_url=None):
@@ -18,23 +126,7 @@ class SessionInserter(object):
 
     @property
     def insert_query(self):
-
-        return textwrap.dedent("""
-            insert into webapp_sessions
-            (
-                person_id,
-                news_message,
-                redirect_to_url
-            )
-
-            values
-            (
-                %(person_id)s,
-                %(news_message)s,
-                %(redirect_to_this_url)s
-            )
-
-            returning session_uuid""")
+        return insert_session.sql
 
     @property
     def bound_variables(self):
@@ -48,7 +140,7 @@ class SessionInserter(object):
 
         cursor = dbconn.cursor()
 
-        cursor.execute(self.insert_query, self.bound_variables)
+        insert_session.execute(cursor, self.bound_variables)
 
         return cursor.fetchone()
 
@@ -70,12 +162,9 @@ def set_project_id_in_session(pgconn, session_uuid, project_id):
         session_data = cursor.fetchone().session_data
         session_data['project_id'] = str(project_id)
 
-        cursor.execute(textwrap.dedent("""
-            update webapp_session_data
-            set session_data = (%s)
-            where session_uuid = (%s)
-            and namespace = (%s)
-            """), [session_data, session_uuid, 'global'])
+        update_session_data.execute(
+            cursor,
+            [Jsonb(session_data), session_uuid, 'global'])
 
     else:
 
@@ -83,26 +172,16 @@ def set_project_id_in_session(pgconn, session_uuid, project_id):
 
         session_data = dict({'project_id': str(project_id)})
 
-        cursor.execute(textwrap.dedent("""
-            insert into webapp_session_data
-            (session_uuid, namespace, session_data)
-            values
-            (%s, %s, %s)
-            """), [session_uuid, 'global', session_data])
+        insert_session_data.execute(
+            cursor,
+            [session_uuid, 'global', Jsonb(session_data)])
 
 
 def get_all_session_namespaces(pgconn, session_uuid):
 
     cursor = pgconn.cursor()
 
-    cursor.execute(textwrap.dedent("""
-        select session_uuid, namespace, session_data, inserted,
-        updated
-
-        from webapp_session_data
-
-        where session_uuid = (%s)
-        """), [session_uuid])
+    select_all_session_namespaces.execute(cursor, [session_uuid])
 
     d = dict()
 
@@ -116,15 +195,7 @@ def get_one_session_namespace(pgconn, session_uuid, namespace):
 
     cursor = pgconn.cursor()
 
-    cursor.execute(textwrap.dedent("""
-        select session_uuid, namespace, session_data, inserted,
-        updated
-
-        from webapp_session_data
-
-        where session_uuid = (%s)
-        and namespace = (%s)
-        """), [session_uuid, namespace])
+    select_one_session_namespace.execute(cursor, [session_uuid, namespace])
 
     return cursor
 
@@ -137,12 +208,9 @@ def set_binder_id_in_session(pgconn, session_uuid, binder_id):
         session_data = cursor.fetchone().session_data
         session_data['binder_id'] = str(binder_id)
 
-        cursor.execute(textwrap.dedent("""
-            update webapp_session_data
-            set session_data = (%s)
-            where session_uuid = (%s)
-            and namespace = (%s)
-            """), [json.dumps(session_data), session_uuid, 'global'])
+        update_session_data.execute(
+            cursor,
+            [Jsonb(session_data), session_uuid, 'global'])
 
     else:
 
@@ -150,21 +218,15 @@ def set_binder_id_in_session(pgconn, session_uuid, binder_id):
 
         session_data = dict({'binder_id': str(binder_id)})
 
-        cursor.execute(textwrap.dedent("""
-            insert into webapp_session_data
-            (session_uuid, namespace, session_data)
-            values
-            (%s, %s, %s)
-            """), [session_uuid, 'global', json.dumps(session_data)])
+        insert_session_data.execute(
+            cursor,
+            [session_uuid, 'global', Jsonb(session_data)])
 
 
-class SessionFactory(psycopg2.extras.CompositeCaster):
+class Session(SlotsRecord):
 
-    def make(self, values):
-        d = dict(zip(self.attnames, values))
-        return Session(**d)
-
-class Session(object):
+    __slots__ = ('session_uuid', 'expires', 'person_id', 'news_message',
+        'redirect_to_url', 'inserted', 'updated')
 
     def __init__(self, session_uuid, expires, person_id, news_message,
         redirect_to_url, inserted, updated):
@@ -186,13 +248,7 @@ class Session(object):
 
         cursor = pgconn.cursor()
 
-        cursor.execute(textwrap.dedent("""
-            update webapp_sessions
-            set expires = current_timestamp
-            where session_uuid = (%(session_uuid)s)
-            and expires > current_timestamp
-            returning expires
-            """), {'session_uuid': self.session_uuid})
+        expire_session.execute(cursor, {'session_uuid': self.session_uuid})
 
         if cursor.rowcount:
             return cursor.fetchone().expires
@@ -202,13 +258,9 @@ class Session(object):
 
         cursor = pgconn.cursor()
 
-        cursor.execute(textwrap.dedent("""
-            update webapp_sessions
-            set expires = current_timestamp
-            where person_uuid = (%(person_uuid)s)
-            and expires > current_timestamp
-            returning (webapp_sessions.*)::webapp_sessions as expired_session
-            """), {'person_uuid': self.person_uuid})
+        expire_all_sessions_for_person.execute(
+            cursor,
+            {'person_uuid': person_uuid})
 
         if cursor.rowcount:
             return cursor
@@ -225,28 +277,31 @@ class Session(object):
 
         cursor = pgconn.cursor()
 
-        cursor.execute(textwrap.dedent("""
-            update webapp_sessions
-            set expires = default
-            where session_uuid = (%(session_uuid)s)
-            and expires > current_timestamp
-            returning expires
-            """), {'session_uuid': self.session_uuid})
+        update_session_expires.execute(
+            cursor,
+            {'session_uuid': self.session_uuid})
 
         if cursor.rowcount:
             return cursor.fetchone().expires
 
 
+    def update_session_expires_time_later(self, deferred_statements):
+
+        """
+        Same as maybe_update_session_expires_time, but goes out with
+        the commit at the end of the request, so it doesn't cost a
+        round trip of its own.
+        """
+
+        deferred_statements.add(
+            update_session_expires,
+            {'session_uuid': self.session_uuid})
+
     def retrieve_session_data(self, pgconn, namespace):
 
         cursor = pgconn.cursor()
 
-        cursor.execute(textwrap.dedent("""
-            select session_data
-            from webapp_session_data
-            where session_uuid = %s
-            and namespace = %s
-            """), [self.session_uuid, namespace])
+        select_session_data.execute(cursor, [self.session_uuid, namespace])
 
         if cursor.rowcount:
             return cursor.fetchone().session_data
@@ -263,11 +318,9 @@ class Session(object):
 
             cursor = pgconn.cursor()
 
-            cursor.execute(textwrap.dedent("""
-                delete from webapp_session_data
-                where session_uuid = %s
-                and namespace = %s
-                """), [self.session_uuid, namespace])
+            delete_session_data.execute(
+                cursor,
+                [self.session_uuid, namespace])
 
         return session_data
 
@@ -282,25 +335,19 @@ class Session(object):
 
         cursor = pgconn.cursor()
 
-        cursor.execute(textwrap.dedent("""
-            insert into webapp_sessions
-            (person_id)
-            select person_id
-            from people
-            where email_address = %(email_address)s
-            and salted_hashed_password = crypt(
-                %(password)s,
-                salted_hashed_password)
-            and person_status = 'confirmed'
-            returning (webapp_sessions.*)::webapp_sessions as gs
-            """), {
-                "email_address": email_address,
-                "password": password})
+        start_session_after_checking_password.execute(cursor, {
+            "email_address": email_address,
+            "password": password})
 
 
         if cursor.rowcount:
             return cursor.fetchone().gs
 
-    @property
-    def __jsondata__(self):
-        return self.__dict__
+class SessionFactory(SlotsCompositeCaster):
+
+    """
+    Turns webapp_sessions rows into Session objects, with a slot for
+    every column in the table.
+    """
+
+    record_class = Session
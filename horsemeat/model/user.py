@@ -1,13 +1,93 @@
 # vim: set expandtab ts=4 sw=4 filetype=python:
 
 import logging
-import textwrap
-import weakref
+import uuid
 
-import psycopg2.extras
+from horsemeat.pg import SlotsCompositeCaster
+from horsemeat.pg import SlotsRecord
+from horsemeat.pg import statements
 
 log = logging.getLogger(__name__)
 
+insert_person_with_password = statements.register(
+    'insert_person_with_password', """
+    insert into people
+    (
+        email_address,
+        display_name,
+        salted_hashed_password,
+        person_status
+    )
+    values
+    (
+        %(email_address)s,
+        %(display_name)s,
+        crypt(%(password)s, gen_salt('md5')),
+        %(person_status)s
+    )
+    returning person_id
+    """)
+
+insert_person = statements.register('insert_person', """
+    insert into people
+    (
+        email_address,
+        display_name,
+        person_status
+    )
+    values
+    (
+        %(email_address)s,
+        %(display_name)s,
+        %(person_status)s
+    )
+    returning person_id
+    """)
+
+set_password = statements.register('set_password', """
+    update people
+
+    set salted_hashed_password =
+    crypt(%(new_password)s, gen_salt('md5'))
+
+    where email_address = (%(email_address)s)
+    returning person_id
+    """)
+
+select_person = statements.register('select_person', """
+    select (p.*)::people as p
+    from people p
+    where person_id = (%(person_id)s)
+    """)
+
+# PersonLoader uses these to look up a whole bunch of people at once.
+# They're separate so looking people up by ID works even without a
+# person_uuid column.
+select_people_by_id = statements.register('select_people_by_id', """
+    select (p.*)::people as p
+    from people p
+    where p.person_id = any(%(person_ids)s::bigint[])
+    """)
+
+select_people_by_uuid = statements.register('select_people_by_uuid', """
+    select (p.*)::people as p
+    from people p
+    where p.person_uuid = any(%(person_uuids)s::uuid[])
+    """)
+
+# Later, consider returning some registered composite type.
+check_credentials = statements.register('check_credentials', """
+    select exists(
+        select *
+        from people
+        where person_id = %(person_id)s
+        and email_address = %(email_address)s
+        and salted_hashed_password = crypt(
+            %(password)s,
+            salted_hashed_password)
+    )
+    """)
+
 class UserInserter(object):
 
     def __init__(self, email_address, display_name, password=None,
@@ -37,51 +117,23 @@ class UserInserter(object):
                 person_status=self.user_status)
 
     @property
-    def insert_query(self):
+    def insert_statement(self):
 
         if self.password:
-
-            return textwrap.dedent("""
-                insert into people
-                (
-                    email_address,
-                    display_name,
-                    salted_hashed_password,
-                    person_status
-                )
-                values
-                (
-                    %(email_address)s,
-                    %(display_name)s,
-                    crypt(%(password)s, gen_salt('md5')),
-                    %(person_status)s
-                )
-                returning person_id
-                """)
+            return insert_person_with_password
 
         else:
+            return insert_person
 
-            return textwrap.dedent("""
-                insert into people
-                (
-                    email_address,
-                    display_name,
-                    person_status
-                )
-                values
-                (
-                    %(email_address)s,
-                    %(display_name)s,
-                    %(person_status)s
-                )
-                returning person_id
-                """)
+    @property
+    def insert_query(self):
+        return self.insert_statement.sql
 
     def execute(self, dbconn):
 
         cursor = dbconn.cursor()
 
-        cursor.execute(self.insert_query, self.bound_variables)
+        self.insert_statement.execute(cursor, self.bound_variables)
 
         return cursor.fetchone()
 
@@ -100,16 +152,7 @@ class PasswordUpdater(object):
 
     @property
     def update_query(self):
-
-        return textwrap.dedent("""
-            update people
-
-            set salted_hashed_password =
-            crypt(%(new_password)s, gen_salt('md5'))
-
-            where email_address = (%(email_address)s)
-            returning person_id
-            """)
+        return set_password.sql
 
     @property
     def bound_variables(self):
@@ -121,7 +164,7 @@ class PasswordUpdater(object):
     def execute(self, dbconn):
 
         cursor = dbconn.cursor()
-        cursor.execute(self.update_query, self.bound_variables)
+        set_password.execute(cursor, self.bound_variables)
 
     # I love aliases.
     update_password = execute
@@ -130,11 +173,7 @@ def get_person_details(pgconn, person_id):
 
     cursor = pgconn.cursor()
 
-    cursor.execute(textwrap.dedent("""
-        select (p.*)::people as p
-        from people p
-        where person_id = (%(person_id)s)
-        """), {'person_id': person_id})
+    select_person.execute(cursor, {'person_id': person_id})
 
     return cursor.fetchone().p
 
@@ -142,33 +181,22 @@ def verify_credentials(pgconn, person_id, email_address, password):
 
     cursor = pgconn.cursor()
 
-    # Later, consider returning some registered composite type.
-    cursor.execute(textwrap.dedent("""
-        select exists(
-            select *
-            from people
-            where person_id = %(person_id)s
-            and email_address = %(email_address)s
-            and salted_hashed_password = crypt(
-                %(password)s,
-                salted_hashed_password)
-        )
-        """), {
-            'person_id': person_id,
-            'email_address': email_address,
-            'password': password
-        })
+    check_credentials.execute(cursor, {
+        'person_id': person_id,
+        'email_address': email_address,
+        'password': password
+    })
 
     return cursor.fetchone().exists
 
-class PersonFactory(psycopg2.extras.CompositeCaster):
+class Person(SlotsRecord):
 
-    def make(self, values):
-        d = dict(zip(self.attnames, values))
-        return Person(**d)
+    __slots__ = ('person_id', 'email_address', 'salted_hashed_password',
+        'person_status', 'display_name', 'is_superuser', 'inserted',
+        'updated')
 
-
-class Person(object):
+    # Don't ever send this out to a browser.
+    json_exclude = ('salted_hashed_password',)
 
     def __init__(self, person_id, email_address, salted_hashed_password,
         person_status, display_name, is_superuser, inserted, updated):
@@ -193,3 +221,187 @@ class Person(object):
 
     def __eq__(self, other):
         return self.person_id == getattr(other, 'person_id', -1)
+
+class PersonFactory(SlotsCompositeCaster):
+
+    """
+    Turns people rows into Person objects, with a slot for every column
+    in the table.
+    """
+
+    record_class = Person
+
+class PersonLoader(object):
+
+    """
+    Looks up people by person_id or person_uuid for one request, and
+    remembers everybody it finds, so a page that lists a hundred
+    authors runs one query instead of a hundred.
+
+    Tell it who you are going to need first, then ask for them::
+
+        req.people.want(*(post.author_id for post in posts))
+
+        for post in posts:
+            author = req.people.get(post.author_id)
+
+    The first get looks up everybody in the want list in one query (or
+    two, if you wanted some by ID and some by UUID).  get_many does both
+    steps at once.  IDs can be strings, like the ones that come out of
+    a URL.  Asking for somebody nobody
+    wanted yet works too, it just costs a query.
+
+    Request.people makes one of these per request, so don't hang on to
+    it after the request is over.  People don't get updated in here
+    when their rows change.
+    """
+
+    def __init__(self, get_pgconn):
+
+        # A function, so we don't check out a connection unless we
+        # have to look somebody up.
+        self.get_pgconn = get_pgconn
+
+        self.by_id = dict()
+        self.by_uuid = dict()
+
+        self.wanted_ids = set()
+        self.wanted_uuids = set()
+
+    @staticmethod
+    def normalize_id(person_id):
+        return int(person_id)
+
+    @staticmethod
+    def normalize_uuid(person_uuid):
+
+        if isinstance(person_uuid, uuid.UUID):
+            return person_uuid
+
+        else:
+            return uuid.UUID(str(person_uuid))
+
+    def want(self, *person_ids):
+
+        for person_id in person_ids:
+
+            if person_id is not None:
+
+                person_id = self.normalize_id(person_id)
+
+                if person_id not in self.by_id:
+                    self.wanted_ids.add(person_id)
+
+        return self
+
+    def want_uuids(self, *person_uuids):
+
+        for person_uuid in person_uuids:
+
+            if person_uuid is not None:
+
+                person_uuid = self.normalize_uuid(person_uuid)
+
+                if person_uuid not in self.by_uuid:
+                    self.wanted_uuids.add(person_uuid)
+
+        return self
+
+    def remember(self, person):
+
+        """
+        Put somebody we already have, like req.user, in here, so nobody
+        looks them up again.
+        """
+
+        self.by_id[person.person_id] = person
+
+        person_uuid = getattr(person, 'person_uuid', None)
+
+        if person_uuid is not None:
+            self.by_uuid[self.normalize_uuid(person_uuid)] = person
+
+        return person
+
+    def load(self):
+
+        """
+        Look up everybody that got wanted but isn't in here yet.
+        """
+
+        if not self.wanted_ids and not self.wanted_uuids:
+            return
+
+        person_ids = sorted(self.wanted_ids)
+        person_uuids = sorted(self.wanted_uuids)
+
+        self.wanted_ids = set()
+        self.wanted_uuids = set()
+
+        if person_ids:
+
+            cursor = self.get_pgconn().cursor()
+
+            select_people_by_id.execute(
+                cursor,
+                {'person_ids': person_ids})
+
+            for row in cursor:
+                self.remember(row.p)
+
+        if person_uuids:
+
+            cursor = self.get_pgconn().cursor()
+
+            select_people_by_uuid.execute(
+                cursor,
+                {'person_uuids': person_uuids})
+
+            for row in cursor:
+                self.remember(row.p)
+
+        # Remember the misses too, so we don't keep asking.
+        for person_id in person_ids:
+            self.by_id.setdefault(person_id, None)
+
+        for person_uuid in person_uuids:
+            self.by_uuid.setdefault(person_uuid, None)
+
+    def get(self, person_id):
+
+        if person_id is None:
+            return None
+
+        person_id = self.normalize_id(person_id)
+
+        if person_id not in self.by_id:
+            self.want(person_id).load()
+
+        return self.by_id[person_id]
+
+    def get_by_uuid(self, person_uuid):
+
+        if person_uuid is None:
+            return None
+
+        person_uuid = self.normalize_uuid(person_uuid)
+
+        if person_uuid not in self.by_uuid:
+            self.want_uuids(person_uuid).load()
+
+        return self.by_uuid[person_uuid]
+
+    def get_many(self, person_ids):
+
+        """
+        Return a list of people (or None for anybody missing) in the
+        same order as person_ids, with at most one query.
+        """
+
+        person_ids = [
+            None if person_id is None else self.normalize_id(person_id)
+            for person_id in person_ids]
+
+        self.want(*person_ids).load()
+
+        return [self.by_id.get(person_id) for person_id in person_ids]
@@ -1,48 +1,683 @@
 # vim: set expandtab ts=4 sw=4 filetype=python fileencoding=utf8:
 
+import collections
+import concurrent.futures
+import contextvars
+import itertools
 import logging
+import re
 import textwrap
+import threading
+import time
+import weakref
+
+import psycopg
+import psycopg2.extras
+
+# These live in their own modules, but everything still imports them
+# from here.
+from horsemeat.pgpool import (
+    get_transaction_status, is_broken, transaction_is_open, transaction_modes,
+    current_transaction_mode, set_transaction_mode, PoolTimeout,
+    ConnectionPool, ConnectionLease, current_lease, current_database_role,
+    get_replica_lag, ReplicaRouter)
+from horsemeat.pgstats import (
+    DeadlineExceeded, RequestDeadline, current_deadline, timeout_errors,
+    get_deadline_setting, prepend_setting, apply_deadline, normalize_query,
+    QueryStats, current_query_stats, explain_slow_query, record_query,
+    InstrumentedPsycopg2Cursor, InstrumentedNamedTupleCursor,
+    InstrumentedTupleCursor, InstrumentedCursor, InstrumentedAsyncCursor,
+    tuple_cursor)
+from horsemeat.pgrows import (
+    SlotsRecord, SlotsCompositeCaster, register_slots_composite, get_row_maker,
+    compact_row, CompactRowCursor)
+from horsemeat.pgjson import (
+    dump_json, json_dumps, json_loads, Jsonb, register_json_adapters)
+from horsemeat.pgcopy import (
+    BinaryCopyParser, fetch_columns)
+from horsemeat.pgpaging import (
+    BadPageToken, Page, KeysetPaginator)
+
+__all__ = [
+    'convert_placeholders', 'Statement', 'StatementRegistry', 'statements',
+    'DeferredStatements', 'split_values_clause', 'BulkRowsMissing',
+    'execute_in_bulk', 'RelationWrapper', 'stream_rows', 'QueryResult',
+    'run_one_query', 'run_queries_concurrently', 'get_transaction_status',
+    'is_broken', 'transaction_is_open', 'transaction_modes',
+    'current_transaction_mode', 'set_transaction_mode', 'PoolTimeout',
+    'ConnectionPool', 'ConnectionLease', 'current_lease',
+    'current_database_role', 'get_replica_lag', 'ReplicaRouter',
+    'DeadlineExceeded', 'RequestDeadline', 'current_deadline',
+    'timeout_errors', 'get_deadline_setting', 'prepend_setting',
+    'apply_deadline', 'normalize_query', 'QueryStats', 'current_query_stats',
+    'explain_slow_query', 'record_query', 'InstrumentedPsycopg2Cursor',
+    'InstrumentedNamedTupleCursor', 'InstrumentedTupleCursor',
+    'InstrumentedCursor', 'InstrumentedAsyncCursor', 'tuple_cursor',
+    'SlotsRecord',
+    'SlotsCompositeCaster', 'register_slots_composite', 'get_row_maker',
+    'compact_row', 'CompactRowCursor', 'dump_json', 'json_dumps', 'json_loads',
+    'Jsonb', 'register_json_adapters', 'BinaryCopyParser', 'fetch_columns',
+    'BadPageToken', 'Page', 'KeysetPaginator',
+    ]
 
 log = logging.getLogger(__name__)
 
+placeholder_pattern = re.compile(r'%\((\w+)\)s|%s|%%')
+
+def convert_placeholders(sql):
+
+    """
+    Turn a query with psycopg placeholders into the body of a PREPARE
+    statement, and return that along with the names of the parameters,
+    in order (or how many there are, for %s placeholders).
+
+    >>> convert_placeholders("select %(a)s, %(b)s, %(a)s where x like 'y%%'")
+    ("select $1, $2, $1 where x like 'y%'", ['a', 'b'])
+
+    >>> convert_placeholders("select %s, %s")
+    ('select $1, $2', 2)
+    """
+
+    names = []
+    count = [0]
+
+    def replace(match):
+
+        if match.group(0) == '%%':
+            return '%'
+
+        elif match.group(1):
+
+            if match.group(1) not in names:
+                names.append(match.group(1))
+
+            return '${0}'.format(names.index(match.group(1)) + 1)
+
+        else:
+            count[0] += 1
+            return '${0}'.format(count[0])
+
+    body = placeholder_pattern.sub(replace, sql)
+
+    if names and count[0]:
+        raise ValueError("Sorry, I can't mix %s and %(name)s placeholders")
+
+    return body, names or count[0]
+
+class Statement(object):
+
+    """
+    A query that gets dedented once, when it gets registered, and
+    prepared on the server once per connection, the first time it runs
+    on that connection.
+
+    Use it like this::
+
+        >>> lookup_session = statements.register( # doctest: +SKIP
+        ...     'lookup_session',
+        ...     "select (s.*)::webapp_sessions as ts "
+        ...     "from webapp_sessions s "
+        ...     "where s.session_uuid = (%s)")
+
+        >>> cursor = pgconn.cursor() # doctest: +SKIP
+        >>> lookup_session.execute(cursor, [session_uuid]) # doctest: +SKIP
+
+    With psycopg (3), this passes prepare=True to execute.  With
+    psycopg2, this sends PREPARE the first time and then EXECUTE.
+    Anything else gets a plain execute.
+    """
+
+    def __init__(self, name, sql):
+
+        self.name = name
+        self.sql = textwrap.dedent(sql).strip()
+
+        # Only psycopg2 needs these.
+        self.prepared_name = 'horsemeat_' + re.sub(r'\W', '_', name)
+        self.prepare_body, self.params = convert_placeholders(self.sql)
+
+        if isinstance(self.params, list):
+
+            self.execute_sql = 'execute {0} ({1})'.format(
+                self.prepared_name,
+                ', '.join('%({0})s'.format(n) for n in self.params))
+
+        elif self.params:
+
+            self.execute_sql = 'execute {0} ({1})'.format(
+                self.prepared_name,
+                ', '.join(['%s'] * self.params))
+
+        else:
+            self.execute_sql = 'execute {0}'.format(self.prepared_name)
+
+        # Remembers which psycopg2 connections already have this one.
+        self.prepared_on = weakref.WeakKeyDictionary()
+
+    def __repr__(self):
+
+        return '<{0}.{1} {2}>'.format(
+            type(self).__module__,
+            type(self).__name__,
+            self.name)
+
+    def execute(self, cursor, params=None):
+
+        pgconn = cursor.connection
+
+        # psycopg (3)
+        if hasattr(pgconn, 'prepare_threshold'):
+            cursor.execute(self.sql, params, prepare=True)
+
+        # psycopg2
+        elif hasattr(pgconn, 'get_transaction_status'):
+
+            if pgconn not in self.prepared_on:
+
+                cursor.execute('prepare {0} as {1}'.format(
+                    self.prepared_name,
+                    self.prepare_body))
+
+                self.prepared_on[pgconn] = True
+
+            cursor.execute(self.execute_sql, params)
+
+        else:
+            cursor.execute(self.sql, params)
+
+        return cursor
+
+class StatementRegistry(object):
+
+    """
+    Holds Statements by name, so the same SQL never gets registered
+    twice under different names, or two queries under one name.
+
+    >>> registry = StatementRegistry()
+    >>> s = registry.register('one', "select 1")
+    >>> registry.register('one', "select 1") is s
+    True
+    >>> registry['one'] is s
+    True
+    >>> registry.register('one', "select 2")
+    Traceback (most recent call last):
+        ...
+    ValueError: Statement one is already registered with different SQL
+    """
+
+    def __init__(self):
+        self.statements = dict()
+        self.lock = threading.Lock()
+
+    def __getitem__(self, name):
+        return self.statements[name]
+
+    def get(self, name):
+        return self.statements.get(name)
+
+    def register(self, name, sql):
+
+        statement = Statement(name, sql)
+
+        with self.lock:
+
+            if name in self.statements:
+
+                if self.statements[name].sql != statement.sql:
+                    raise ValueError("Statement {0} is already registered "
+                        "with different SQL".format(name))
+
+                return self.statements[name]
+
+            self.statements[name] = statement
+
+        return statement
+
+# The framework's own statements live in here, and projects can add
+# theirs too.
+statements = StatementRegistry()
+
+class DeferredStatements(object):
+
+    """
+    Statements nobody needs an answer from, saved up so they go out in
+    the same network exchange as the commit.
+
+    With psycopg (3), flush_and_commit sends them all and the commit in
+    one pipeline.  With psycopg2, they just run one after the other
+    right before the commit, which is no worse than before.
+
+    The dispatcher keeps one of these on each request, as
+    req.deferred_statements, and flushes it instead of just committing.
+    """
+
+    def __init__(self):
+        self.queued = []
+
+    def __len__(self):
+        return len(self.queued)
+
+    def add(self, statement, params=None):
+        self.queued.append((statement, params))
+
+    def flush_and_commit(self, pgconn):
+
+        queued, self.queued = self.queued, []
+
+        # These are writes, and a read only transaction won't take
+        # them, so finish that one first.
+        if getattr(pgconn, 'horsemeat_transaction_mode', None) == 'read only':
+
+            if transaction_is_open(pgconn):
+                pgconn.commit()
+
+            set_transaction_mode(pgconn, None)
+
+        if hasattr(pgconn, 'pipeline'):
+
+            with pgconn.pipeline():
+
+                cursor = pgconn.cursor()
+
+                for statement, params in queued:
+                    statement.execute(cursor, params)
+
+                pgconn.commit()
+
+        else:
+
+            cursor = pgconn.cursor()
+
+            for statement, params in queued:
+                statement.execute(cursor, params)
+
+            pgconn.commit()
+
+values_pattern = re.compile(r'\bvalues\s*\(', re.IGNORECASE)
+returning_pattern = re.compile(r'\breturning\b', re.IGNORECASE)
+
+def split_values_clause(sql):
+
+    """
+    Split an insert with one row of values into the part before the
+    row, the row, and the part after, or return None if there's no
+    values clause.
+
+    >>> split_values_clause(
+    ...     "insert into t (a, b) values (%(a)s, f(%(b)s, ')')) returning id")
+    ('insert into t (a, b) values %s', "(%(a)s, f(%(b)s, ')'))", ' returning id')
+    """
+
+    match = values_pattern.search(sql)
+
+    if not match:
+        return None
+
+    start = match.end() - 1
+    depth = 0
+    in_quotes = False
+
+    for i in range(start, len(sql)):
+
+        c = sql[i]
+
+        if c == "'":
+            in_quotes = not in_quotes
+
+        elif in_quotes:
+            continue
+
+        elif c == '(':
+            depth += 1
+
+        elif c == ')':
+
+            depth -= 1
+
+            if depth == 0:
+
+                return (
+                    sql[:match.start()] + 'values %s',
+                    sql[start:i + 1],
+                    sql[i + 1:])
+
+    return None
+
+class BulkRowsMissing(ValueError):
+
+    """
+    execute_in_bulk raises this when a multi-row insert returns fewer
+    rows than it was sent, so it can't tell which row goes where.
+    """
+
+def execute_in_bulk(pgconn, query_makers, page_size=1000):
+
+    """
+    Run a bunch of objects like UserInserter, SessionInserter, or
+    NewsMessageQueryMaker, which all have an insert_query and
+    bound_variables, in as few round trips as possible::
+
+        >>> results = execute_in_bulk(pgconn, [ # doctest: +SKIP
+        ...     UserInserter(email_address, display_name)
+        ...     for email_address, display_name in people_to_import])
+
+    Objects with the same insert_query get sent together.  With
+    psycopg2, that's one multi-row insert per page_size objects, through
+    execute_values.  With psycopg (3), that's a pipelined executemany,
+    so it's one round trip no matter how many there are.
+
+    This returns what each query returned, in the same order as
+    query_makers, or None for queries without a RETURNING clause.
+    Postgresql hands back RETURNING rows from a multi-row insert in the
+    order of the VALUES list.
+
+    Watch out for inserts that can skip rows, like ON CONFLICT DO
+    NOTHING.  With psycopg (3), each skipped row just comes back as
+    None.  With psycopg2, a multi-row insert only returns the rows it
+    inserted, and there's no telling which ones those were, so I raise
+    BulkRowsMissing instead of guessing.  Roll back and run those one
+    at a time.
+    """
+
+    query_makers = list(query_makers)
+    results = [None] * len(query_makers)
+
+    groups = collections.OrderedDict()
+
+    for i, query_maker in enumerate(query_makers):
+        groups.setdefault(query_maker.insert_query, []).append(i)
+
+    cursor = pgconn.cursor()
+
+    for qry, positions in groups.items():
+
+        params = [query_makers[i].bound_variables for i in positions]
+        returning = bool(returning_pattern.search(qry))
+
+        # psycopg (3)
+        if hasattr(pgconn, 'prepare_threshold'):
+
+            cursor.executemany(qry, params, returning=returning)
+
+            if returning:
+
+                rows = []
+
+                while True:
+
+                    rows.append(cursor.fetchone())
+
+                    if not cursor.nextset():
+                        break
+
+            else:
+                rows = None
+
+        # psycopg2
+        else:
+
+            split = split_values_clause(qry)
+
+            if split is None:
+
+                log.warning("Can't find the values in {0}, so running "
+                    "these one at a time".format(qry))
+
+                rows = []
+
+                for p in params:
+
+                    cursor.execute(qry, p)
+                    rows.append(cursor.fetchone() if returning else None)
+
+            else:
+
+                head, template, tail = split
+
+                rows = psycopg2.extras.execute_values(
+                    cursor,
+                    head + tail,
+                    params,
+                    template=template,
+                    page_size=page_size,
+                    fetch=returning)
+
+                if returning and len(rows) != len(positions):
+
+                    raise BulkRowsMissing("Sent {0} rows, but got {1} "
+                        "back from {2}".format(
+                            len(positions), len(rows), qry))
+
+        if rows is not None:
+            for i, row in zip(positions, rows):
+                results[i] = row
+
+    return results
+
 class RelationWrapper(object):
 
     @property
     def __jsondata__(self):
         return self.__dict__
 
+    @classmethod
+    def get_statement(cls, kind, sql):
+
+        # Each subclass has its own tables, so each gets its own
+        # statements, made the first time they're needed.
+        name = '{0}_{1}_{2}'.format(
+            kind,
+            cls.history_table_name,
+            cls.pk_column_name)
+
+        return statements.get(name) or statements.register(
+            name,
+            sql.format(cls.history_table_name, cls.pk_column_name))
+
     def get_current_status(self, pgconn):
 
         cursor = pgconn.cursor()
 
-        cursor.execute(textwrap.dedent("""
+        self.get_statement('current_status', """
             select {0}.*::{0} as current_status
             from {0}
             where {0}.{1} = %(pk)s
             and current_timestamp <@ {0}.effective
-            """).format(
-                self.history_table_name,
-                self.pk_column_name), dict(pk=self.pk))
+            """).execute(cursor, dict(pk=self.pk))
 
         return cursor.fetchone().current_status
 
     def update_status(self, pgconn, new_status, who_did_it):
 
-        qry = textwrap.dedent("""
+        cursor = pgconn.cursor()
+
+        self.get_statement('update_status', """
             insert into {0}
             ({1}, status, who_did_it)
             values
             (%(pk)s, %(status)s, %(who_did_it)s)
-            """.format(
-                self.history_table_name,
-                self.pk_column_name))
+            """).execute(
+                cursor,
+                dict(
+                    pk=self.pk,
+                    status=new_status,
+                    who_did_it=who_did_it))
 
-        cursor = pgconn.cursor()
+        log.info("Just updated status for {0} to {1}".format(self, new_status))
 
-        cursor.execute(qry,
-            dict(
-                pk=self.pk,
-                status=new_status,
-                who_did_it=who_did_it))
+# Every server-side cursor needs a name that's unique on its connection.
+stream_names = itertools.count()
 
-        log.info("Just updated status for {0} to {1}".format(self, new_status))
+def stream_rows(pgconn, qry, params=None, itersize=2000, batches=False):
+
+    """
+    Run qry on a server-side (named) cursor and yield the rows, fetching
+    itersize of them per round trip, so memory stays the same no matter
+    how many rows come back.  With batches=True, yield lists of up to
+    itersize rows instead, which is handy for writing out CSV chunks::
+
+        >>> for row in stream_rows(pgconn, # doctest: +SKIP
+        ...     "select * from people order by person_id"):
+        ...     writer.writerow(row)
+
+    This works on psycopg2 and psycopg (3) connections.
+
+    Server-side cursors only live as long as the transaction, so don't
+    commit until you're done, and don't use this on an autocommit
+    connection.  The cursor gets closed when the generator finishes or
+    gets thrown away.
+
+    To send the rows out as a response, wrap a generator built on this
+    in horsemeat.webapp.response.Response.stream.  The dispatcher keeps
+    the transaction and the connection until the last chunk goes out.
+    """
+
+    cursor = pgconn.cursor(name='horsemeat_stream_{0}'.format(
+        next(stream_names)))
+
+    try:
+
+        cursor.itersize = itersize
+
+        # psycopg2 connections from ConfigWrapper already hand out
+        # instrumented cursors, but psycopg (3) server-side cursors are
+        # their own class.
+        if hasattr(pgconn, 'prepare_threshold'):
+
+            apply_deadline(cursor, psycopg.ClientCursor)
+
+            started = time.perf_counter()
+            cursor.execute(qry, params)
+            record_query(cursor, None, qry, params, started)
+
+        else:
+            cursor.execute(qry, params)
+
+        if batches:
+
+            while True:
+
+                rows = cursor.fetchmany(itersize)
+
+                if not rows:
+                    break
+
+                yield rows
+
+        else:
+
+            for row in cursor:
+                yield row
+
+    finally:
+        cursor.close()
+
+QueryResult = collections.namedtuple(
+    'QueryResult',
+    'rows seconds')
+
+def run_one_query(config_wrapper, qry, params):
+
+    """
+    This runs in one of the config wrapper's query threads, in a copy
+    of the caller's context, so the request's query stats, deadline,
+    and replica choice all still apply.
+
+    With a connection pool or replicas, the query takes its connections
+    on a lease of its own, rather than the caller's, which is busy.
+    Otherwise, each query thread keeps its own connection.
+    """
+
+    lease = current_lease.get(None)
+    pool = lease.pool if lease else config_wrapper.get_connection_pool()
+
+    if pool or config_wrapper.replicas:
+        lease = ConnectionLease(pool)
+        current_lease.set(lease)
+
+    else:
+        lease = None
+
+    started = time.perf_counter()
+
+    try:
+
+        pgconn = config_wrapper.get_pgconn()
+
+        try:
+
+            cursor = pgconn.cursor()
+            cursor.execute(qry, params)
+            rows = cursor.fetchall()
+
+        # These queries only read, so don't leave the connection idle
+        # in a transaction.
+        finally:
+            pgconn.rollback()
+
+    finally:
+
+        if lease:
+            lease.release()
+
+    return QueryResult(rows, time.perf_counter() - started)
+
+def run_queries_concurrently(config_wrapper, queries):
+
+    """
+    Run a bunch of independent select queries at the same time, each on
+    its own connection, and return a dictionary mapping each name to a
+    QueryResult with the rows and how many seconds that query took::
+
+        >>> results = run_queries_concurrently(cw, dict( # doctest: +SKIP
+        ...     members=("select * from people where club_id = %s", [99]),
+        ...     upcoming_events="select * from events where starts > now()"))
+
+        >>> results['members'].rows # doctest: +SKIP
+
+    The whole thing takes about as long as the slowest query, not the
+    sum of all of them.
+
+    Each query is either a string or a (string, params) pair.  These
+    queries run on other connections, so they can't see anything the
+    caller wrote in its own transaction and hasn't committed yet.
+
+    If any query blows up, this waits for the rest to finish and then
+    raises the first exception.
+    """
+
+    executor = config_wrapper.get_query_executor()
+
+    started = time.perf_counter()
+
+    futures = dict()
+
+    for name, q in queries.items():
+
+        qry, params = (q, None) if isinstance(q, str) else q
+
+        # Each query gets its own copy of the context, so the lease
+        # run_one_query sets stays with that query.
+        futures[name] = executor.submit(
+            contextvars.copy_context().run,
+            run_one_query,
+            config_wrapper,
+            qry,
+            params)
+
+    concurrent.futures.wait(futures.values())
+
+    results = dict(
+        (name, future.result())
+        for name, future in futures.items())
+
+    log.info("Ran {0} queries concurrently in {1:.1f} ms ({2})".format(
+        len(results),
+        (time.perf_counter() - started) * 1000,
+        ', '.join(
+            '{0}: {1:.1f} ms'.format(name, result.seconds * 1000)
+            for name, result in sorted(
+                results.items(),
+                key=lambda pair: -pair[1].seconds))))
+
+    return results
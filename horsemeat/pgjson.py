@@ -0,0 +1,118 @@
+# vim: set expandtab ts=4 sw=4 filetype=python fileencoding=utf8:
+
+"""
+Fast JSON in and out of json and jsonb columns.
+"""
+
+import json
+import logging
+
+import psycopg
+import psycopg.types.json
+import psycopg2.extensions
+import psycopg2.extras
+
+try:
+    import orjson
+
+except ImportError:
+    orjson = None
+
+from horsemeat import HorsemeatJSONEncoder
+
+log = logging.getLogger(__name__)
+
+json_encoder = HorsemeatJSONEncoder(separators=(',', ':'))
+
+def dump_json(obj):
+
+    """
+    Encode obj as JSON bytes, with orjson if it is installed, or the
+    standard library if it isn't.  Anything fancyjsondumps can encode,
+    like objects with a __jsondata__ property, works here too.
+
+    >>> dump_json({'a': [1, 2], 'b': None})
+    b'{"a":[1,2],"b":null}'
+    """
+
+    if orjson is not None:
+
+        try:
+            return orjson.dumps(
+                obj,
+                default=json_encoder.default,
+                option=orjson.OPT_NON_STR_KEYS)
+
+        # orjson gives up on stuff like ints bigger than 64 bits, but
+        # the standard library doesn't.
+        except TypeError:
+            pass
+
+    return json_encoder.encode(obj).encode('utf8')
+
+def json_dumps(obj):
+
+    """
+    Same as dump_json, but a string, which is what psycopg2 wants.
+    """
+
+    return dump_json(obj).decode('utf8')
+
+def json_loads(data):
+
+    """
+    Decode JSON from a string or bytes.
+
+    >>> json_loads(b'{"a": [1, 2]}')
+    {'a': [1, 2]}
+    """
+
+    if orjson is not None:
+
+        try:
+            return orjson.loads(data)
+
+        except orjson.JSONDecodeError:
+            pass
+
+    return json.loads(data)
+
+class Jsonb(psycopg.types.json.Jsonb):
+
+    """
+    Wrap a dictionary (or list, or whatever) in this to write it into a
+    json or jsonb column, with either psycopg2 or psycopg, and it gets
+    encoded by dump_json::
+
+        update_session_data.execute(
+            cursor,
+            [Jsonb(session_data), session_uuid, 'global'])
+
+    Don't just pass the dictionary.  psycopg doesn't know what to do
+    with one, and psycopg2 turns it into an hstore.
+    """
+
+def adapt_jsonb(wrapper):
+    return psycopg2.extras.Json(wrapper.obj, dumps=json_dumps)
+
+# psycopg2 can only register adapters globally, but that's OK, because
+# nothing else uses this class.
+psycopg2.extensions.register_adapter(Jsonb, adapt_jsonb)
+
+def register_json_adapters(pgconn):
+
+    """
+    Read json and jsonb columns with json_loads and write Jsonb objects
+    with dump_json.  ConfigWrapper does this on every connection it
+    makes, including the async ones.
+    """
+
+    # psycopg (3)
+    if hasattr(pgconn, 'prepare_threshold'):
+
+        psycopg.types.json.set_json_dumps(dump_json, pgconn)
+        psycopg.types.json.set_json_loads(json_loads, pgconn)
+
+    else:
+        psycopg2.extras.register_default_json(pgconn, loads=json_loads)
+        psycopg2.extras.register_default_jsonb(pgconn, loads=json_loads)
@@ -0,0 +1,214 @@
+# vim: set expandtab ts=4 sw=4 filetype=python fileencoding=utf8:
+
+"""
+Keyset pagination with tamper-proof page tokens.
+"""
+
+import base64
+import binascii
+import hashlib
+import hmac
+import json
+import logging
+import textwrap
+
+log = logging.getLogger(__name__)
+
+class BadPageToken(ValueError):
+    pass
+
+class Page(object):
+
+    """
+    One page of rows from a KeysetPaginator.  next_token is None on the
+    last page.  Response.json knows what to do with these, through
+    __jsondata__.
+    """
+
+    def __init__(self, rows, next_token):
+        self.rows = rows
+        self.next_token = next_token
+
+    def __repr__(self):
+
+        return '<{0}.{1} ({2} rows, more: {3})>'.format(
+            type(self).__module__,
+            type(self).__name__,
+            len(self.rows),
+            self.next_token is not None)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def __jsondata__(self):
+        return dict(rows=self.rows, next_token=self.next_token)
+
+class KeysetPaginator(object):
+
+    """
+    Pages through qry without OFFSET, so page 1000 costs the same as
+    page 1.  Each page picks up after the key of the last row on the
+    page before, and that key goes back and forth to the browser in a
+    signed token, so nobody can make one up::
+
+        >>> people = KeysetPaginator( # doctest: +SKIP
+        ...     "select * from people where person_status = %(status)s",
+        ...     ['inserted', 'person_id'],
+        ...     cw.app_secret)
+
+        >>> page = people.fetch(pgconn, # doctest: +SKIP
+        ...     dict(status='confirmed'),
+        ...     token=req.wz_req.args.get('after'))
+
+        >>> return Response.json(page) # doctest: +SKIP
+
+    key is a list of output columns of qry that together are unique,
+    like inserted and the primary key, and there ought to be an index
+    on them.  All of them sort the same direction.
+
+    qry gets wrapped in a subquery, so it can have its own where clause
+    and parameters, as a list or a dictionary, but no order by or
+    limit.
+    """
+
+    def __init__(self, qry, key, secret, page_size=50, descending=False):
+
+        self.qry = textwrap.dedent(qry).strip()
+        self.key = list(key)
+        self.secret = str(secret).encode('utf8')
+        self.page_size = page_size
+        self.descending = descending
+
+        # Tokens only work with the paginator that made them.
+        self.scope = '{0}:{1}:{2}'.format(
+            ','.join(self.key),
+            'desc' if descending else 'asc',
+            self.qry).encode('utf8')
+
+    def sign(self, payload):
+
+        return base64.urlsafe_b64encode(hmac.new(
+            self.secret,
+            self.scope + payload,
+            hashlib.sha256).digest()[:16]).rstrip(b'=')
+
+    def make_token(self, row):
+
+        """
+        >>> import collections
+        >>> paginator = KeysetPaginator("select * from t", ['a', 'b'], 'x')
+        >>> Row = collections.namedtuple('Row', 'a b c')
+        >>> token = paginator.make_token(Row(1, 'two', 3))
+        >>> paginator.read_token(token)
+        [1, 'two']
+        >>> paginator.read_token(token[:-1] + 'x')
+        Traceback (most recent call last):
+            ...
+        horsemeat.pgpaging.BadPageToken: That page token has been tampered with
+        """
+
+        payload = json.dumps(
+            [getattr(row, column) for column in self.key],
+            default=str,
+            separators=(',', ':')).encode('utf8')
+
+        return '{0}.{1}'.format(
+            base64.urlsafe_b64encode(payload).rstrip(b'=').decode('ascii'),
+            self.sign(payload).decode('ascii'))
+
+    def read_token(self, token):
+
+        try:
+
+            encoded_payload, signature = token.split('.')
+
+            payload = base64.urlsafe_b64decode(
+                encoded_payload + '=' * (-len(encoded_payload) % 4))
+
+        except (ValueError, TypeError, binascii.Error):
+            raise BadPageToken("That's not a page token")
+
+        if not hmac.compare_digest(
+            self.sign(payload),
+            signature.encode('ascii', 'replace')):
+
+            raise BadPageToken("That page token has been tampered with")
+
+        return json.loads(payload)
+
+    def build_query(self, params, after):
+
+        """
+        Return the query for the page after the key values in after (or
+        the first page, when that's None) and its parameters.
+
+        >>> paginator = KeysetPaginator(
+        ...     "select * from people where person_status = %s",
+        ...     ['inserted', 'person_id'], 'x', page_size=2)
+        >>> qry, params = paginator.build_query(['confirmed'], ['2024-01-01', 9])
+        >>> print(qry)
+        select *
+        from (select * from people where person_status = %s) as keyset_page
+        where (inserted, person_id) > (%s, %s)
+        order by inserted, person_id
+        limit 3
+        >>> params
+        ['confirmed', '2024-01-01', 9]
+        """
+
+        if isinstance(params, dict):
+
+            params = dict(params)
+            names = ['keyset_after_{0}'.format(i) for i in range(len(self.key))]
+            params.update(zip(names, after or []))
+            placeholders = ['%({0})s'.format(name) for name in names]
+
+        else:
+
+            params = list(params or []) + list(after or [])
+            placeholders = ['%s'] * len(self.key)
+
+        direction = ' desc' if self.descending else ''
+
+        lines = [
+            'select *',
+            'from ({0}) as keyset_page'.format(self.qry)]
+
+        if after is not None:
+
+            lines.append('where ({0}) {1} ({2})'.format(
+                ', '.join(self.key),
+                '<' if self.descending else '>',
+                ', '.join(placeholders)))
+
+        lines.append('order by {0}'.format(
+            ', '.join(column + direction for column in self.key)))
+
+        # Get one extra, to find out if there's another page.
+        lines.append('limit {0}'.format(self.page_size + 1))
+
+        return '\n'.join(lines), params
+
+    def fetch(self, pgconn, params=None, token=None):
+
+        after = self.read_token(token) if token else None
+
+        qry, params = self.build_query(params, after)
+
+        cursor = pgconn.cursor()
+        cursor.execute(qry, params)
+
+        rows = cursor.fetchall()
+
+        if len(rows) > self.page_size:
+            rows = rows[:self.page_size]
+            next_token = self.make_token(rows[-1])
+
+        else:
+            next_token = None
+
+        return Page(rows, next_token)
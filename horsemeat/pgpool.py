@@ -0,0 +1,573 @@
+# vim: set expandtab ts=4 sw=4 filetype=python fileencoding=utf8:
+
+"""
+Connection pools, leases, transaction modes, and read replicas.
+"""
+
+import collections
+import contextlib
+import contextvars
+import functools
+import itertools
+import logging
+import textwrap
+import threading
+import time
+
+import psycopg
+import psycopg.pq
+
+log = logging.getLogger(__name__)
+
+def get_transaction_status(pgconn):
+
+    """
+    psycopg2 and psycopg (3) keep this in different spots, but both
+    use the libpq numbers, so compare the answer with
+    psycopg.pq.TransactionStatus.
+    """
+
+    if hasattr(pgconn, 'get_transaction_status'):
+        return psycopg.pq.TransactionStatus(pgconn.get_transaction_status())
+
+    else:
+        return pgconn.info.transaction_status
+
+def is_broken(pgconn):
+
+    """
+    True when the connection is closed or libpq gave up on it.
+    """
+
+    return bool(pgconn.closed) or getattr(pgconn, 'broken', False) \
+    or get_transaction_status(pgconn) == psycopg.pq.TransactionStatus.UNKNOWN
+
+def transaction_is_open(pgconn):
+
+    """
+    False when there's nothing to commit, because nothing ran since the
+    last commit, or because the connection is in autocommit mode.
+    """
+
+    return get_transaction_status(pgconn) != psycopg.pq.TransactionStatus.IDLE
+
+# Handlers set transaction_mode to one of these keys.  None means
+# whatever the connection does by default.
+transaction_modes = {
+    None: dict(autocommit=False, read_only=None, isolation_level=None),
+    'read only': dict(autocommit=False, read_only=True, isolation_level=None),
+    'autocommit': dict(autocommit=True, read_only=None, isolation_level=None),
+    'serializable': dict(autocommit=False, read_only=None,
+        isolation_level='serializable'),
+}
+
+# The dispatcher sets this to the transaction mode of the handler it
+# picked, and ConfigWrapper.get_postgresql_connection applies it.
+current_transaction_mode = contextvars.ContextVar('current_transaction_mode')
+
+def set_transaction_mode(pgconn, mode):
+
+    """
+    Set up pgconn so the next transaction starts in this mode.  Neither
+    psycopg2 nor psycopg talk to the server to do this; they just change
+    the BEGIN they send next.
+
+    Connections remember their mode, so this is cheap to call over and
+    over.
+    """
+
+    if mode not in transaction_modes:
+        raise ValueError("Sorry, I don't know transaction mode {0!r}".format(
+            mode))
+
+    elif getattr(pgconn, 'horsemeat_transaction_mode', None) == mode:
+        return
+
+    # Neither library lets you change this stuff in the middle of a
+    # transaction.
+    elif transaction_is_open(pgconn):
+
+        log.warning("Can't switch {0} to transaction mode {1!r} in the "
+            "middle of a transaction".format(pgconn, mode))
+
+        return
+
+    settings = transaction_modes[mode]
+
+    # psycopg2
+    if hasattr(pgconn, 'set_session'):
+
+        pgconn.set_session(
+            isolation_level=settings['isolation_level'] or 'DEFAULT',
+            readonly='DEFAULT' if settings['read_only'] is None
+                else settings['read_only'],
+            autocommit=settings['autocommit'])
+
+    # psycopg (3)
+    else:
+
+        pgconn.autocommit = settings['autocommit']
+        pgconn.read_only = settings['read_only']
+
+        pgconn.isolation_level = psycopg.IsolationLevel.SERIALIZABLE \
+        if settings['isolation_level'] == 'serializable' else None
+
+    pgconn.horsemeat_transaction_mode = mode
+
+class PoolTimeout(Exception):
+    pass
+
+class ConnectionPool(object):
+
+    """
+    A thread-safe pool of database connections.
+
+    connect is anything that returns a new connection, like
+    ConfigWrapper.make_database_connection, so this works with psycopg2
+    and psycopg (3) both.
+
+    Connections that sat idle longer than check_interval seconds get a
+    select 1 before they get handed out, and broken ones get thrown
+    away, so the pool recovers on its own after postgres restarts.
+    When connecting fails, the pool keeps trying, backing off from
+    0.1 seconds up to 2 seconds between tries, until timeout runs out.
+    """
+
+    def __init__(self, connect, min_size=1, max_size=10, timeout=30.0,
+        check_interval=30.0):
+
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_interval = check_interval
+
+        # Pairs of (connection, when it was put back).
+        self.idle = collections.deque()
+
+        # Idle plus checked out.
+        self.size = 0
+
+        self.condition = threading.Condition()
+
+    def __repr__(self):
+
+        return '<{0}.{1} (idle: {2}, size: {3}, max_size: {4})>'.format(
+            type(self).__module__,
+            type(self).__name__,
+            len(self.idle),
+            self.size,
+            self.max_size)
+
+    def fill(self):
+
+        """
+        Open connections until there are min_size of them.
+        """
+
+        while self.size < self.min_size:
+            self.putconn(self.getconn())
+
+    def getconn(self, timeout=None):
+
+        """
+        Wait up to timeout seconds for a connection, or self.timeout
+        when that's None, and then raise PoolTimeout.  With timeout=0,
+        give up right away when every connection is checked out.
+        """
+
+        if timeout is None:
+            timeout = self.timeout
+
+        deadline = time.monotonic() + timeout
+
+        while True:
+
+            with self.condition:
+
+                while not self.idle and self.size >= self.max_size:
+
+                    remaining = deadline - time.monotonic()
+
+                    if remaining <= 0:
+                        raise PoolTimeout("No connection free after "
+                            "{0} seconds in {1}".format(timeout, self))
+
+                    self.condition.wait(remaining)
+
+                if self.idle:
+                    pgconn, idle_since = self.idle.pop()
+
+                # Hold a spot for the connection we're about to make.
+                else:
+                    self.size += 1
+                    pgconn, idle_since = None, None
+
+            if pgconn is None:
+                return self.connect_with_backoff(deadline)
+
+            elif self.is_healthy(pgconn, idle_since):
+                return pgconn
+
+            else:
+                self.discard(pgconn)
+
+    def connect_with_backoff(self, deadline):
+
+        delay = 0.1
+
+        while True:
+
+            try:
+                return self.connect()
+
+            except Exception as ex:
+
+                if time.monotonic() + delay > deadline:
+                    self.discard(None)
+                    raise
+
+                log.warning("Couldn't connect ({0}); trying again in "
+                    "{1:.1f} seconds".format(ex, delay))
+
+                time.sleep(delay)
+                delay = min(delay * 2, 2.0)
+
+    def is_healthy(self, pgconn, idle_since):
+
+        if is_broken(pgconn):
+            return False
+
+        elif time.monotonic() - idle_since < self.check_interval:
+            return True
+
+        try:
+            cursor = pgconn.cursor()
+            cursor.execute("select 1")
+            pgconn.rollback()
+            return True
+
+        except Exception as ex:
+            log.warning("Throwing away {0}: {1}".format(pgconn, ex))
+            return False
+
+    def putconn(self, pgconn):
+
+        if not is_broken(pgconn) \
+        and get_transaction_status(pgconn) != psycopg.pq.TransactionStatus.IDLE:
+
+            try:
+                pgconn.rollback()
+
+            except Exception:
+                pass
+
+        if is_broken(pgconn):
+            self.discard(pgconn)
+
+        else:
+
+            with self.condition:
+                self.idle.append((pgconn, time.monotonic()))
+                self.condition.notify()
+
+    def discard(self, pgconn):
+
+        if pgconn is not None and not pgconn.closed:
+
+            try:
+                pgconn.close()
+
+            except Exception:
+                pass
+
+        with self.condition:
+            self.size -= 1
+            self.condition.notify()
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+
+        pgconn = self.getconn(timeout)
+
+        try:
+            yield pgconn
+
+        finally:
+            self.putconn(pgconn)
+
+    def close(self):
+
+        with self.condition:
+
+            while self.idle:
+
+                pgconn, _ = self.idle.pop()
+                self.size -= 1
+
+                pgconn.close()
+
+    def forget(self):
+
+        """
+        Empty the pool without closing anything and return the idle
+        connections.  A forked child uses this, since its parent still
+        owns those sockets.
+        """
+
+        with self.condition:
+
+            pgconns = [pgconn for pgconn, _ in self.idle]
+            self.idle.clear()
+            self.size = 0
+
+        return pgconns
+
+class ConnectionLease(object):
+
+    """
+    Checks a connection out of a pool the first time somebody asks for
+    it, and puts it back at release.  The dispatcher makes one of these
+    for each request, so requests that never touch the database never
+    hold a connection.
+
+    ReplicaRouter keeps the request's replica connection here too, so
+    release gives that back as well.  With replicas and no pool for
+    the primary, pool is None, and only the replica connection comes
+    from a lease.
+    """
+
+    def __init__(self, pool):
+
+        self.pool = pool
+        self.pgconn = None
+
+        self.replica_pool = None
+        self.replica_pgconn = None
+
+    @property
+    def checked_out(self):
+        return self.pgconn is not None
+
+    def get(self):
+
+        if self.pgconn is None:
+            self.pgconn = self.pool.getconn()
+
+        return self.pgconn
+
+    def release(self):
+
+        self.release_replica()
+
+        if self.pgconn is not None:
+
+            pgconn, self.pgconn = self.pgconn, None
+            self.pool.putconn(pgconn)
+
+    def release_replica(self):
+
+        if self.replica_pgconn is not None:
+
+            pgconn, self.replica_pgconn = self.replica_pgconn, None
+            self.replica_pool.putconn(pgconn)
+
+# ConfigWrapper.get_postgresql_connection looks here first.
+current_lease = contextvars.ContextVar('current_lease')
+
+# The dispatcher sets this to 'replica' when the handler it picked can
+# read from a replica.  Anything else means the primary.
+current_database_role = contextvars.ContextVar('current_database_role')
+
+# When the replica has replayed everything it received, it's caught up,
+# no matter how long ago the last commit on the primary was.
+replica_lag_query = textwrap.dedent("""
+    select case
+        when pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() then 0
+        else coalesce(
+            extract(epoch from now() - pg_last_xact_replay_timestamp()),
+            0)
+    end::float8 as lag_seconds
+    """)
+
+def get_replica_lag(pgconn):
+
+    """
+    Return how many seconds behind the primary this replica is.  This
+    rolls back afterward, so only call it between transactions.
+    """
+
+    cursor = pgconn.cursor()
+    cursor.execute(replica_lag_query)
+    lag_seconds = cursor.fetchone()[0]
+
+    pgconn.rollback()
+
+    return lag_seconds
+
+class ReplicaRouter(object):
+
+    """
+    Hands out connections to read replicas.
+
+    connect takes one of the replicas, which is whatever the config
+    wrapper wants it to be, and returns a new connection to it.  Each
+    replica gets a ConnectionPool of its own, with up to max_size
+    connections, and requests take turns picking replicas.  The
+    connection stays on the request's lease (see current_lease) until
+    the lease gets released, and then goes back in its pool.
+
+    get returns None when the replica is more than max_lag_seconds
+    behind, when it can't be reached, or when every connection to it is
+    checked out, and then the caller should use the primary instead.
+    The lag gets checked at most every check_interval seconds per
+    connection, and a replica that refused a connection gets left alone
+    for check_interval seconds too.
+    """
+
+    def __init__(self, connect, replicas, max_lag_seconds=5.0,
+        check_interval=5.0, max_size=10):
+
+        self.connect = connect
+        self.replicas = list(replicas)
+        self.max_lag_seconds = max_lag_seconds
+        self.check_interval = check_interval
+
+        self.pools = [
+            ConnectionPool(
+                functools.partial(connect, replica),
+                min_size=0,
+                max_size=max_size)
+            for replica in self.replicas]
+
+        # Position in self.replicas -> when to try connecting again.
+        self.down_until = dict()
+
+        self.turns = itertools.count()
+
+    def __repr__(self):
+
+        return '<{0}.{1} ({2} replicas, max_lag_seconds: {3})>'.format(
+            type(self).__module__,
+            type(self).__name__,
+            len(self.replicas),
+            self.max_lag_seconds)
+
+    def get_if_connected(self):
+
+        lease = current_lease.get(None)
+
+        if lease is not None:
+            return lease.replica_pgconn
+
+    def get(self):
+
+        # Outside of a request, there's nothing to give the connection
+        # back, so stick with the primary.
+        lease = current_lease.get(None)
+
+        if lease is None:
+            return None
+
+        pgconn = lease.replica_pgconn
+
+        if pgconn is not None and is_broken(pgconn):
+
+            log.warning("Throwing away broken replica connection "
+                "{0}".format(pgconn))
+
+            lease.release_replica()
+            pgconn = None
+
+        if pgconn is None:
+            pgconn = self.check_out_next_replica(lease)
+
+        if pgconn is None:
+            return None
+
+        # Don't pull the rug out from under a transaction that already
+        # started on this replica.
+        elif transaction_is_open(pgconn) or self.is_caught_up(pgconn):
+            return pgconn
+
+        else:
+            lease.release_replica()
+            return None
+
+    def check_out_next_replica(self, lease):
+
+        now = time.monotonic()
+
+        for _ in range(len(self.replicas)):
+
+            position = next(self.turns) % len(self.replicas)
+
+            if self.down_until.get(position, 0) > now:
+                continue
+
+            try:
+
+                # The primary is a better bet than waiting in line for
+                # a busy replica.
+                pgconn = self.pools[position].getconn(timeout=0)
+
+            except PoolTimeout:
+                continue
+
+            except Exception as ex:
+
+                log.warning("Couldn't connect to replica {0} ({1}); "
+                    "leaving it alone for {2} seconds".format(
+                        position, ex, self.check_interval))
+
+                self.down_until[position] = now + self.check_interval
+
+            else:
+
+                lease.replica_pool = self.pools[position]
+                lease.replica_pgconn = pgconn
+
+                return pgconn
+
+        return None
+
+    def is_caught_up(self, pgconn):
+
+        checked_at, lag_seconds = getattr(
+            pgconn,
+            'horsemeat_replica_lag',
+            (None, None))
+
+        if checked_at is None \
+        or time.monotonic() - checked_at >= self.check_interval:
+
+            try:
+                lag_seconds = get_replica_lag(pgconn)
+
+            except Exception as ex:
+                log.warning("Couldn't check lag on {0}: {1}".format(pgconn, ex))
+                lag_seconds = None
+
+            pgconn.horsemeat_replica_lag = (time.monotonic(), lag_seconds)
+
+            if lag_seconds is None or lag_seconds > self.max_lag_seconds:
+
+                log.warning("Replica {0} is {1} seconds behind, so using "
+                    "the primary for now".format(pgconn, lag_seconds))
+
+        return lag_seconds is not None \
+        and lag_seconds <= self.max_lag_seconds
+
+    def close(self):
+
+        for pool in self.pools:
+            pool.close()
+
+    def forget(self):
+
+        """
+        Like ConnectionPool.forget, return the idle connections without
+        closing them.
+        """
+
+        return [pgconn for pool in self.pools for pgconn in pool.forget()]
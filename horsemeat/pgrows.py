@@ -0,0 +1,303 @@
+# vim: set expandtab ts=4 sw=4 filetype=python fileencoding=utf8:
+
+"""
+Cheap rows: records with __slots__ for composite types, and namedtuple
+rows that share one class per column list.
+"""
+
+import collections
+import functools
+import logging
+import re
+import threading
+
+import psycopg
+import psycopg.rows
+import psycopg.types.composite
+import psycopg2.extensions
+import psycopg2.extras
+
+log = logging.getLogger(__name__)
+
+class SlotsRecord(object):
+
+    """
+    A base for classes like Session and Person that hold one row of a
+    composite type.  Subclasses list their columns in __slots__, so
+    instances don't each drag a dictionary around.
+
+    SlotsCompositeCaster (for psycopg2) and register_slots_composite
+    (for psycopg) make a subclass for whatever columns the composite
+    type really has, with a positional constructor, so building one
+    from a row is a single call.
+
+    >>> class Thing(SlotsRecord):
+    ...     __slots__ = ('thing_id', 'title')
+    >>> ThingRow = make_record_class(Thing, ['thing_id', 'title', 'inserted'])
+    >>> t = ThingRow(1, 'hat', None)
+    >>> isinstance(t, Thing), t.__jsondata__
+    (True, {'thing_id': 1, 'title': 'hat', 'inserted': None})
+    >>> hasattr(t, '__dict__')
+    False
+    """
+
+    __slots__ = ()
+
+    # Generated classes set this to the columns of the composite type.
+    record_fields = None
+
+    # Columns that never go out in __jsondata__, like password hashes.
+    json_exclude = ()
+
+    @classmethod
+    def get_record_fields(cls):
+
+        if cls.record_fields is not None:
+            return cls.record_fields
+
+        fields = []
+
+        for klass in reversed(cls.__mro__):
+
+            slots = klass.__dict__.get('__slots__', ())
+
+            if isinstance(slots, str):
+                slots = (slots,)
+
+            fields.extend(
+                name for name in slots
+                if name not in fields
+                and name not in ('__dict__', '__weakref__'))
+
+        return tuple(fields)
+
+    @property
+    def __jsondata__(self):
+
+        return dict(
+            (name, getattr(self, name, None))
+            for name in self.get_record_fields()
+            if name not in self.json_exclude)
+
+    def __reduce__(self):
+
+        # Generated classes can't be found by name, so pickles rebuild
+        # them from the base class and the columns.
+        base = type(self).record_base \
+        if type(self).record_fields is not None else type(self)
+
+        fields = self.get_record_fields()
+
+        return (
+            rebuild_record,
+            (base, fields, tuple(getattr(self, name, None) for name in fields)))
+
+# (base class, columns) -> generated class.
+record_classes = dict()
+record_classes_lock = threading.Lock()
+
+def make_record_class(base, attnames):
+
+    """
+    Return a subclass of base, a SlotsRecord, with a slot for every
+    column in attnames and an __init__ that takes them in that order.
+    Classes get made once per base and list of columns.
+    """
+
+    attnames = tuple(attnames)
+    key = (base, attnames)
+
+    if key in record_classes:
+        return record_classes[key]
+
+    if not all(name.isidentifier() for name in attnames):
+        raise ValueError("Sorry, I need column names that are python "
+            "identifiers, not {0}".format(attnames))
+
+    existing = base.get_record_fields()
+
+    # Writing out the assignments is faster than looping over setattr.
+    namespace = dict()
+
+    exec('def __init__(self, {0}):\n{1}\n'.format(
+        ', '.join(attnames),
+        '\n'.join('    self.{0} = {0}'.format(name) for name in attnames)
+        or '    pass'), namespace)
+
+    cls = type(base.__name__, (base,), {
+        '__slots__': tuple(name for name in attnames if name not in existing),
+        '__init__': namespace['__init__'],
+        '__module__': base.__module__,
+        '__qualname__': base.__qualname__,
+        'record_fields': attnames,
+        'record_base': base,
+    })
+
+    with record_classes_lock:
+        return record_classes.setdefault(key, cls)
+
+def rebuild_record(base, attnames, values):
+    return make_record_class(base, attnames)(*values)
+
+class SlotsCompositeCaster(psycopg2.extras.CompositeCaster):
+
+    """
+    Set record_class to a SlotsRecord subclass, and register this like
+    any other psycopg2 composite caster::
+
+        >>> class PersonFactory(SlotsCompositeCaster): # doctest: +SKIP
+        ...     record_class = Person
+
+        >>> psycopg2.extras.register_composite( # doctest: +SKIP
+        ...     'people', pgconn, factory=PersonFactory)
+    """
+
+    record_class = None
+
+    def __init__(self, *args, **kwargs):
+
+        super(SlotsCompositeCaster, self).__init__(*args, **kwargs)
+
+        self.row_class = make_record_class(self.record_class, self.attnames)
+
+    def make(self, values):
+        return self.row_class(*values)
+
+def register_slots_composite(pgconn, type_name, record_class):
+
+    """
+    The psycopg (3) version of SlotsCompositeCaster.  Call this in
+    ConfigWrapper.register_psycopg_composite_types.
+    """
+
+    info = psycopg.types.composite.CompositeInfo.fetch(pgconn, type_name)
+
+    psycopg.types.composite.register_composite(
+        info,
+        pgconn,
+        make_record_class(record_class, info.field_names))
+
+identifier_pattern = re.compile(r'\W')
+
+def python_identifier(column_name):
+
+    """
+    Mangle a column name into a namedtuple field name the same way
+    psycopg2 and psycopg do.
+
+    >>> python_identifier('?column?'), python_identifier('2nd'), python_identifier('_x')
+    ('f_column_', 'f2nd', 'f_x')
+    """
+
+    s = identifier_pattern.sub('_', column_name)
+
+    if s[0] == '_' or s[0].isdigit():
+        s = 'f' + s
+
+    return s
+
+# Column names -> function that makes a row out of a tuple of values.
+row_makers = dict()
+
+def get_row_maker(column_names):
+
+    """
+    Return a function that turns a sequence of values into a namedtuple
+    with these fields.
+
+    The namedtuple classes are the same as what psycopg2 and psycopg
+    make, but the function is tuple.__new__ with the class already
+    filled in, so it runs entirely in C.  namedtuple._make is a python
+    function, and calling it once per row adds up.
+
+    >>> make_row = get_row_maker(('person_id', 'display_name'))
+    >>> make_row([1, 'Matt'])
+    Row(person_id=1, display_name='Matt')
+    >>> get_row_maker(('person_id', 'display_name')) is make_row
+    True
+    """
+
+    try:
+        return row_makers[column_names]
+
+    except KeyError:
+
+        Row = collections.namedtuple(
+            'Row',
+            [python_identifier(name) for name in column_names],
+            rename=True)
+
+        return row_makers.setdefault(
+            column_names,
+            functools.partial(tuple.__new__, Row))
+
+def compact_row(cursor):
+
+    """
+    A psycopg (3) row factory that works like psycopg.rows.namedtuple_row,
+    but with get_row_maker.  The psycopg connections from ConfigWrapper
+    use this.
+
+    For hot loops that don't need column names, use tuple_cursor.
+    """
+
+    description = cursor.description
+
+    if description is None:
+        return psycopg.rows.no_result
+
+    return get_row_maker(tuple(column.name for column in description))
+
+class CompactRowCursor(psycopg2.extras.NamedTupleCursor):
+
+    """
+    The psycopg2 version of compact_row.  Rows are still namedtuples.
+    """
+
+    # NamedTupleCursor sets Record to None every time it executes
+    # something, so the row maker goes in there too.
+    def get_row_maker(self):
+
+        if self.Record is None:
+
+            self.Record = get_row_maker(
+                tuple(column[0] for column in self.description or ()))
+
+        return self.Record
+
+    def fetchone(self):
+
+        t = psycopg2.extensions.cursor.fetchone(self)
+
+        if t is not None:
+            return self.get_row_maker()(t)
+
+    def fetchmany(self, size=None):
+
+        ts = psycopg2.extensions.cursor.fetchmany(self, size) \
+        if size is not None else psycopg2.extensions.cursor.fetchmany(self)
+
+        return list(map(self.get_row_maker(), ts))
+
+    def fetchall(self):
+
+        return list(map(
+            self.get_row_maker(),
+            psycopg2.extensions.cursor.fetchall(self)))
+
+    def __iter__(self):
+
+        it = psycopg2.extensions.cursor.__iter__(self)
+
+        try:
+            first = next(it)
+
+        except StopIteration:
+            return
+
+        make_row = self.get_row_maker()
+
+        yield make_row(first)
+
+        for t in it:
+            yield make_row(t)
@@ -0,0 +1,507 @@
+# vim: set expandtab ts=4 sw=4 filetype=python fileencoding=utf8:
+
+"""
+Request deadlines, per-request query stats, slow query plans, and the
+instrumented cursors that keep track of all of it.
+"""
+
+import collections
+import contextvars
+import json
+import logging
+import re
+import threading
+import time
+
+import psycopg
+import psycopg.rows
+import psycopg2.extensions
+
+from horsemeat.pgpool import transaction_is_open
+from horsemeat.pgrows import CompactRowCursor
+
+log = logging.getLogger(__name__)
+
+# Slow queries and their plans go here, so they can go to their own
+# file.
+slow_query_log = logging.getLogger('horsemeat.slowqueries')
+
+class DeadlineExceeded(Exception):
+    pass
+
+class RequestDeadline(object):
+
+    """
+    Remembers when a request has to be done by.
+
+    >>> deadline = RequestDeadline(2.5, started=100.0)
+    >>> deadline.remaining(now=101.0)
+    1.5
+    >>> deadline.statement_timeout(now=101.0)
+    '1500'
+    >>> deadline.check(now=103.0)
+    Traceback (most recent call last):
+        ...
+    horsemeat.pgstats.DeadlineExceeded: Request used up its 2.5 second budget
+    """
+
+    def __init__(self, budget_seconds, started=None):
+
+        self.budget_seconds = budget_seconds
+
+        self.started = time.monotonic() if started is None else started
+
+    def remaining(self, now=None):
+
+        if now is None:
+            now = time.monotonic()
+
+        return self.started + self.budget_seconds - now
+
+    def check(self, now=None):
+
+        if self.remaining(now) <= 0:
+            raise DeadlineExceeded("Request used up its {0} second "
+                "budget".format(self.budget_seconds))
+
+    def statement_timeout(self, now=None):
+
+        """
+        What's left, in milliseconds, the way statement_timeout wants
+        it.  Zero would mean no timeout, so never go below 1.
+        """
+
+        return str(max(1, int(self.remaining(now) * 1000)))
+
+# The dispatcher sets this after it picks the handler, and the
+# instrumented cursors below use it.
+current_deadline = contextvars.ContextVar('current_deadline')
+
+# Handlers that run out of time raise one of these.
+timeout_errors = (
+    DeadlineExceeded,
+    psycopg.errors.QueryCanceled,
+    psycopg2.extensions.QueryCanceledError)
+
+def get_deadline_setting(cursor):
+
+    """
+    Give up if the request is out of time.  Otherwise, return a SET
+    LOCAL that gives the transaction a statement_timeout of whatever
+    time the request has left, so postgresql cancels a runaway query
+    instead of gunicorn killing the worker.  Return None when there's
+    nothing to set.
+
+    The connection remembers the last timeout it got, and a timeout
+    covers each statement from when that statement starts.  So the
+    second query in a transaction that started a while ago gets a new,
+    smaller timeout, and so does every query after it.
+
+    SET LOCAL goes away with the transaction.  It can't do anything for
+    autocommit connections, which never start one.
+    """
+
+    deadline = current_deadline.get(None)
+
+    if deadline is None:
+        return
+
+    deadline.check()
+
+    pgconn = cursor.connection
+
+    if pgconn.autocommit:
+        return
+
+    statement_timeout = deadline.statement_timeout()
+
+    # A timeout from an earlier transaction, or an earlier request,
+    # is already gone.
+    last_deadline, last_timeout = getattr(
+        pgconn,
+        'horsemeat_statement_timeout',
+        (None, None))
+
+    if not transaction_is_open(pgconn) \
+    or last_deadline is not deadline \
+    or int(statement_timeout) < int(last_timeout):
+
+        pgconn.horsemeat_statement_timeout = (deadline, statement_timeout)
+
+        # statement_timeout is always digits, so this is safe.
+        return 'set local statement_timeout = {0}'.format(statement_timeout)
+
+def prepend_setting(setting, qry):
+
+    """
+    Stick setting in front of qry, so they go to the server together,
+    or return None when qry isn't plain text, like a psycopg2.sql
+    Composable.
+
+    >>> prepend_setting('set local statement_timeout = 1500', 'select 1')
+    'set local statement_timeout = 1500; select 1'
+    """
+
+    if isinstance(qry, str):
+        return setting + '; ' + qry
+
+    elif isinstance(qry, bytes):
+        return setting.encode('ascii') + b'; ' + qry
+
+def apply_deadline(cursor, plain_cursor_class):
+
+    """
+    Send the deadline setting on its own, for cursors that can't send
+    it along with their query.  That costs a round trip, so the
+    instrumented cursors only do this as a last resort.
+    """
+
+    setting = get_deadline_setting(cursor)
+
+    if setting:
+        plain_cursor_class(cursor.connection).execute(setting)
+
+normalize_pattern = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|\s+")
+
+def normalize_query(qry):
+
+    """
+    Squash whitespace and swap literals for ?, so the same statement
+    with different values counts as one statement.
+
+    >>> normalize_query('''select *
+    ...     from people where person_id = 99 and name = 'O''Hara' ''')
+    'select * from people where person_id = ? and name = ?'
+    """
+
+    def replace(match):
+        return ' ' if match.group(0).isspace() else '?'
+
+    return normalize_pattern.sub(replace, qry).strip()
+
+class QueryStats(object):
+
+    """
+    Counts the queries one request runs, and how long they take.
+
+    The dispatcher makes one of these for each request and puts it in
+    current_query_stats, and the instrumented cursors below record
+    into it.
+    """
+
+    def __init__(self, slow_query_seconds=None, n_plus_one_threshold=None,
+        keep_slowest=3):
+
+        self.slow_query_seconds = slow_query_seconds
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.keep_slowest = keep_slowest
+
+        self.count = 0
+        self.seconds = 0.0
+        self.slowest = []
+        self.counts_by_statement = collections.Counter()
+
+        # run_queries_concurrently records from several threads at once.
+        self.lock = threading.Lock()
+
+    def record(self, qry, seconds):
+
+        normalized = normalize_query(qry)
+
+        with self.lock:
+
+            self.count += 1
+            self.seconds += seconds
+
+            self.counts_by_statement[normalized] += 1
+
+            if len(self.slowest) < self.keep_slowest \
+            or seconds > self.slowest[-1][0]:
+
+                self.slowest.append((seconds, normalized))
+                self.slowest.sort(reverse=True)
+                del self.slowest[self.keep_slowest:]
+
+    def is_slow(self, seconds):
+
+        return self.slow_query_seconds is not None \
+        and seconds >= self.slow_query_seconds
+
+    @property
+    def repeated_statements(self):
+
+        """
+        Statements that ran more than n_plus_one_threshold times, which
+        usually means somebody queried inside a loop.
+        """
+
+        if self.n_plus_one_threshold is None:
+            return []
+
+        return [(n, normalized)
+            for normalized, n in self.counts_by_statement.most_common()
+            if n > self.n_plus_one_threshold]
+
+    def describe(self):
+
+        """
+        >>> stats = QueryStats()
+        >>> stats.record("select 1", 0.0015)
+        >>> stats.describe()
+        '1 queries, 1.5 ms in the database'
+        """
+
+        return '{0} queries, {1:.1f} ms in the database'.format(
+            self.count,
+            self.seconds * 1000)
+
+    def log_problems(self, line_one=None):
+
+        for n, normalized in self.repeated_statements:
+
+            log.warning("Possible N+1 in {0}: ran this {1} times: "
+                "{2}".format(line_one, n, normalized[:300]))
+
+current_query_stats = contextvars.ContextVar('current_query_stats')
+
+explainable_pattern = re.compile(
+    r'\s*(select|insert|update|delete|with|values|table|execute)\b',
+    re.IGNORECASE)
+
+def explain_slow_query(pgconn, cursor_class, qry, params, seconds):
+
+    """
+    Log the plan for a slow query.  EXPLAIN without ANALYZE doesn't run
+    the query again.
+
+    This happens inside a savepoint when there's a transaction open,
+    so if EXPLAIN blows up, the caller's transaction doesn't.
+    """
+
+    if not explainable_pattern.match(qry):
+        slow_query_log.warning("Slow query ({0:.1f} ms): {1}".format(
+            seconds * 1000, qry))
+        return
+
+    in_transaction = transaction_is_open(pgconn)
+
+    cursor = pgconn.cursor() if cursor_class is None \
+    else cursor_class(pgconn)
+
+    try:
+
+        if in_transaction:
+            cursor.execute("savepoint horsemeat_explain")
+
+        cursor.execute("explain (format json) " + qry, params)
+        plan = cursor.fetchone()[0]
+
+        if in_transaction:
+            cursor.execute("release savepoint horsemeat_explain")
+
+    except Exception as ex:
+
+        if in_transaction:
+            cursor.execute("rollback to savepoint horsemeat_explain")
+
+        plan = "couldn't explain: {0}".format(ex)
+
+    slow_query_log.warning("Slow query ({0:.1f} ms): {1}\n{2}".format(
+        seconds * 1000,
+        qry,
+        plan if isinstance(plan, str) else json.dumps(plan, indent=2)))
+
+def record_query(cursor, explain_cursor_class, qry, params, started):
+
+    stats = current_query_stats.get(None)
+
+    if stats is not None:
+
+        seconds = time.perf_counter() - started
+
+        if isinstance(qry, bytes):
+            qry = qry.decode('utf8')
+
+        elif not isinstance(qry, str):
+            qry = qry.as_string(cursor)
+
+        stats.record(qry, seconds)
+
+        if stats.is_slow(seconds):
+            explain_slow_query(
+                cursor.connection,
+                explain_cursor_class,
+                qry,
+                params,
+                seconds)
+
+class InstrumentedPsycopg2Cursor(object):
+
+    """
+    Records every query into current_query_stats.  Mix this into a
+    psycopg2 cursor class.
+    """
+
+    def execute(self, qry, params=None):
+
+        setting = get_deadline_setting(self)
+
+        # psycopg2 sends a query and its parameters as one string, so
+        # the setting can go in front of it, and it doesn't cost a
+        # round trip.  Named cursors wrap the query in a DECLARE,
+        # though, so they can't.
+        sql = prepend_setting(setting, qry) \
+        if setting and not self.name else None
+
+        if setting and sql is None:
+            psycopg2.extensions.cursor(self.connection).execute(setting)
+
+        started = time.perf_counter()
+
+        result = super(InstrumentedPsycopg2Cursor, self).execute(
+            sql or qry, params)
+
+        record_query(
+            self,
+            psycopg2.extensions.cursor,
+            qry,
+            params,
+            started)
+
+        return result
+
+    def executemany(self, qry, params_seq):
+
+        apply_deadline(self, psycopg2.extensions.cursor)
+
+        started = time.perf_counter()
+
+        result = super(InstrumentedPsycopg2Cursor, self).executemany(
+            qry, params_seq)
+
+        record_query(self, None, qry, None, started)
+
+        return result
+
+class InstrumentedNamedTupleCursor(InstrumentedPsycopg2Cursor,
+    CompactRowCursor):
+
+    """
+    The psycopg2 connections from ConfigWrapper use this.
+    """
+
+class InstrumentedTupleCursor(InstrumentedPsycopg2Cursor,
+    psycopg2.extensions.cursor):
+
+    """
+    What tuple_cursor uses on instrumented psycopg2 connections.
+    """
+
+class InstrumentedCursor(psycopg.Cursor):
+
+    """
+    Same thing as InstrumentedNamedTupleCursor, for psycopg (3).
+    """
+
+    def execute(self, qry, params=None, **kwargs):
+
+        pgconn = self.connection
+
+        setting = get_deadline_setting(self) \
+        if pgconn._pipeline is None else None
+
+        started = time.perf_counter()
+
+        # psycopg can't send two statements with parameters in one
+        # string, but in a pipeline, the setting and the query go to the
+        # server together, and the answers come back together when the
+        # pipeline block ends.
+        if setting and psycopg.Pipeline.is_supported():
+
+            with pgconn.pipeline():
+
+                psycopg.Cursor(pgconn).execute(setting)
+
+                result = super(InstrumentedCursor, self).execute(
+                    qry, params, **kwargs)
+
+        else:
+
+            if setting:
+                psycopg.ClientCursor(pgconn).execute(setting)
+
+            result = super(InstrumentedCursor, self).execute(
+                qry, params, **kwargs)
+
+        # In a pipeline, execute returns before the server answers, so
+        # there's nothing worth timing, and nothing to explain.
+        if self.connection._pipeline is None:
+            record_query(self, psycopg.ClientCursor, qry, params, started)
+
+        return result
+
+    def executemany(self, qry, params_seq, **kwargs):
+
+        if self.connection._pipeline is None:
+            apply_deadline(self, psycopg.ClientCursor)
+
+        started = time.perf_counter()
+
+        result = super(InstrumentedCursor, self).executemany(
+            qry, params_seq, **kwargs)
+
+        if self.connection._pipeline is None:
+            record_query(self, None, qry, None, started)
+
+        return result
+
+class InstrumentedAsyncCursor(psycopg.AsyncCursor):
+
+    """
+    Same deadline as InstrumentedCursor, for async handlers.  These
+    queries don't get counted or explained, because explaining a slow
+    query would block the event loop.
+    """
+
+    async def execute(self, qry, params=None, **kwargs):
+
+        pgconn = self.connection
+
+        setting = get_deadline_setting(self) \
+        if pgconn._pipeline is None else None
+
+        if setting and psycopg.Pipeline.is_supported():
+
+            async with pgconn.pipeline():
+
+                await psycopg.AsyncCursor(pgconn).execute(setting)
+
+                return await super(InstrumentedAsyncCursor, self).execute(
+                    qry, params, **kwargs)
+
+        else:
+
+            if setting:
+                await psycopg.AsyncClientCursor(pgconn).execute(setting)
+
+            return await super(InstrumentedAsyncCursor, self).execute(
+                qry, params, **kwargs)
+
+def tuple_cursor(pgconn):
+
+    """
+    Return a cursor that hands back plain tuples, for loops over lots
+    of rows that only use row[0], row[1], and so on.  It's still
+    instrumented if pgconn's cursors are.
+    """
+
+    # psycopg (3)
+    if hasattr(pgconn, 'prepare_threshold'):
+        return pgconn.cursor(row_factory=psycopg.rows.tuple_row)
+
+    elif isinstance(pgconn.cursor_factory, type) \
+    and issubclass(pgconn.cursor_factory, InstrumentedPsycopg2Cursor):
+        return pgconn.cursor(cursor_factory=InstrumentedTupleCursor)
+
+    else:
+        return pgconn.cursor(cursor_factory=psycopg2.extensions.cursor)
@@ -0,0 +1,230 @@
+# vim: set expandtab ts=4 sw=4 filetype=python fileencoding=utf8:
+
+"""
+One fake database connection for all the tests that don't have a real
+one.
+
+Every query a cursor runs lands in connection.executed as a (qry,
+params, kwargs) tuple, along with 'commit' and 'rollback', so tests can
+check what went to the server and in what order.
+
+Pipelines show up in there too, as 'pipeline starts' and 'pipeline
+syncs'.
+
+The rows a query gets back come from connection.answer, which gets
+called with the query and its parameters.  By default, that's every row
+in connection.rows.
+
+Psycopg2Connection and Psycopg3Connection only have the parts of their
+libraries that horsemeat.pg looks for when it decides which one it's
+talking to.
+"""
+
+import contextlib
+
+import psycopg
+
+class Cursor(object):
+
+    # Named cursors fetch this many rows per round trip.
+    itersize = 1
+
+    def __init__(self, connection, name=None, **kwargs):
+
+        self.connection = connection
+        self.name = name
+        self.kwargs = kwargs
+
+        self.rows = []
+        self.results = []
+        self.fetches = 0
+        self.closed = False
+
+    @property
+    def description(self):
+        return self.connection.description
+
+    def execute(self, qry, params=None, **kwargs):
+
+        pgconn = self.connection
+
+        if isinstance(qry, bytes):
+            qry = qry.decode('utf8')
+
+        pgconn.executed.append((qry, params, kwargs))
+
+        if pgconn.fail_next_query:
+            pgconn.closed = 2
+            raise Exception("server closed the connection unexpectedly")
+
+        if not pgconn.autocommit:
+            pgconn.status = psycopg.pq.TransactionStatus.INTRANS
+
+        self.rows = list(pgconn.answer(qry, params))
+
+    def executemany(self, qry, params_seq, **kwargs):
+
+        pgconn = self.connection
+
+        pgconn.executed.append((qry, params_seq, kwargs))
+
+        if not pgconn.autocommit:
+            pgconn.status = psycopg.pq.TransactionStatus.INTRANS
+
+        # With returning=True, psycopg keeps one result set for each
+        # set of parameters.
+        self.results = [
+            list(pgconn.answer(qry, params))
+            for params in params_seq]
+
+        self.rows = self.results.pop(0) if self.results else []
+
+    def nextset(self):
+
+        if self.results:
+            self.rows = self.results.pop(0)
+            return True
+
+    def fetchone(self):
+
+        if self.rows:
+            return self.rows.pop(0)
+
+    def fetchmany(self, size):
+
+        self.fetches += 1
+        batch, self.rows = self.rows[:size], self.rows[size:]
+
+        return batch
+
+    def fetchall(self):
+        return self.fetchmany(len(self.rows))
+
+    def __iter__(self):
+
+        while True:
+
+            batch = self.fetchmany(self.itersize)
+
+            if not batch:
+                return
+
+            for row in batch:
+                yield row
+
+    def mogrify(self, qry, params):
+
+        if isinstance(params, dict):
+            quoted = dict((k, repr(v)) for k, v in params.items())
+
+        else:
+            quoted = tuple(map(repr, params))
+
+        return (qry % quoted).encode('utf8')
+
+    def copy_expert(self, qry, f):
+
+        self.connection.executed.append((qry, None, {}))
+
+        data = self.connection.copy_data
+
+        # Hand it over in awkward pieces, like a socket would.
+        for i in range(0, len(data), 7):
+            f.write(data[i:i + 7])
+
+    def close(self):
+        self.closed = True
+
+class Connection(object):
+
+    """
+    The parts both libraries have.  Use Psycopg2Connection or
+    Psycopg3Connection unless the test is about connections that look
+    like neither.
+    """
+
+    autocommit = False
+    closed = 0
+
+    # For queries that look at cursor.description.
+    description = None
+
+    # For COPY ... TO STDOUT.
+    copy_data = b''
+
+    def __init__(self, rows=(), answer=None):
+
+        self.rows = list(rows)
+
+        if answer is not None:
+            self.answer = answer
+
+        self.executed = []
+        self.cursors = []
+
+        self.status = psycopg.pq.TransactionStatus.IDLE
+        self.commits = 0
+        self.rollbacks = 0
+        self.fail_next_query = False
+
+    def answer(self, qry, params):
+        return self.rows
+
+    def cursor(self, name=None, **kwargs):
+
+        self.cursors.append(Cursor(self, name, **kwargs))
+
+        return self.cursors[-1]
+
+    def commit(self):
+
+        self.executed.append('commit')
+        self.commits += 1
+        self.status = psycopg.pq.TransactionStatus.IDLE
+
+    def rollback(self):
+
+        self.executed.append('rollback')
+        self.rollbacks += 1
+        self.status = psycopg.pq.TransactionStatus.IDLE
+
+    def close(self):
+        self.closed = 1
+
+class Psycopg2Connection(Connection):
+
+    encoding = 'UTF8'
+    cursor_factory = None
+
+    def get_transaction_status(self):
+        return self.status
+
+    def set_session(self, **kwargs):
+
+        if self.status:
+            raise Exception("set_session cannot be used inside a transaction")
+
+        self.session = kwargs
+
+class Psycopg3Connection(Connection):
+
+    prepare_threshold = 5
+
+    read_only = None
+    isolation_level = None
+
+    # psycopg keeps the transaction status in pgconn.info.
+    @property
+    def info(self):
+        return self
+
+    @property
+    def transaction_status(self):
+        return self.status
+
+    @contextlib.contextmanager
+    def pipeline(self):
+
+        self.executed.append('pipeline starts')
+        yield
+        self.executed.append('pipeline syncs')
@@ -0,0 +1,49 @@
+# vim: set expandtab ts=4 sw=4 filetype=python fileencoding=utf8:
+
+"""
+A few handlers for the dispatcher tests to load with
+make_handlers_from_module_string.
+"""
+
+import re
+
+from horsemeat.webapp import frameworkhandlers
+from horsemeat.webapp.handler import Handler
+
+class Login(Handler):
+
+    route = Handler.check_route_strings
+    route_strings = set(['GET /login', 'POST /login'])
+
+    def handle(self, req):
+        pass
+
+class ClubDetails(Handler):
+
+    route = Handler.check_route_patterns
+
+    route_patterns = [
+        re.compile(r'GET /club/(?P<club_number>\d+)$'),
+        'GET /club/featured',
+    ]
+
+    def handle(self, req):
+        pass
+
+class StartsUpEarly(Handler):
+
+    route = Handler.check_route_strings
+    route_strings = set(['GET /early'])
+
+    started_up = False
+
+    def on_startup(self):
+        StartsUpEarly.started_up = True
+
+    def handle(self, req):
+        pass
+
+# Subclass NotFound in here so we don't go looking for the framework
+# template folder.  The Z is so inspect.getmembers puts it last.
+class ZNotFound(frameworkhandlers.NotFound):
+    pass
@@ -0,0 +1,407 @@
+# vim: set expandtab ts=4 sw=4 filetype=python fileencoding=utf8:
+
+import asyncio
+import threading
+import types
+import unittest
+
+import jinja2
+
+from horsemeat import pg
+from horsemeat.webapp import asgi
+from horsemeat.webapp.handler import Handler
+from horsemeat.webapp.request import Request
+from horsemeat.webapp.response import Response
+from horsemeat.tests.test_dispatcher import \
+    ProbedConfigWrapper, StreamsRows, SubclassConfigWrapper, \
+    SubclassDispatcher
+
+class BogusAsyncConnection(object):
+
+    closed = False
+
+    def __init__(self):
+        self.commits = 0
+
+    async def commit(self):
+        self.commits += 1
+
+    async def rollback(self):
+        pass
+
+class BogusAsyncConnections(asgi.AsyncConnections):
+
+    async def get(self):
+        self.apgconn = BogusAsyncConnection()
+        return self.apgconn
+
+    async def put(self, apgconn):
+        pass
+
+class SyncPage(Handler):
+
+    route = Handler.check_route_strings
+    route_strings = set(['GET /sync'])
+
+    def handle(self, req):
+
+        return Response.html([
+            'sync in {0}'.format(threading.current_thread().name).encode()])
+
+class AsyncPage(Handler):
+
+    route = Handler.check_route_strings
+    route_strings = set(['POST /async'])
+
+    async def handle(self, req):
+
+        await asyncio.sleep(0)
+
+        x = await self.cw.get_async_jinja2_environment().get_template(
+            'test/async.html').render_async()
+
+        return Response.html([x.encode()])
+
+class AsyncQuery(Handler):
+
+    route = Handler.check_route_strings
+    route_strings = set(['GET /async-query'])
+    latency_budget = 2
+
+    async def handle(self, req):
+
+        apgconn = await req.apgconn
+
+        # Awaiting it again doesn't check out another one.
+        self.same = apgconn is await req.apgconn
+
+        self.deadline = pg.current_deadline.get(None)
+
+        return Response.plain('ok')
+
+class ASGIRequest(Request):
+
+    @property
+    def user(self):
+        return None
+
+class TestASGI(unittest.TestCase):
+
+    def setUp(self):
+
+        self.cw = SubclassConfigWrapper({'app': {}})
+
+        self.cw.j.loader.mapping['test'] = jinja2.DictLoader({
+            'async.html': '{{ req.line_one }} said {{ req.body.decode() }}'})
+
+        dispatcher = SubclassDispatcher(
+            [SyncPage, AsyncPage, AsyncQuery],
+            self.cw)
+        dispatcher.request_class = ASGIRequest
+
+        self.app = asgi.ASGIDispatcher(dispatcher, max_threads=2)
+        self.app.async_connections = BogusAsyncConnections(self.cw)
+
+    def tearDown(self):
+        self.app.executor.shutdown()
+
+    def call(self, method, path, body=b''):
+
+        messages = [
+            dict(type='http.request', body=body, more_body=False)]
+
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = dict(
+            type='http',
+            method=method,
+            path=path,
+            query_string=b'',
+            headers=[(b'content-type', b'text/plain')])
+
+        asyncio.run(self.app(scope, receive, send))
+
+        return sent
+
+    def test_sync_handler_runs_in_a_thread(self):
+
+        sent = self.call('GET', '/sync')
+
+        self.assertEqual(sent[0]['status'], 200)
+
+        self.assertIn(
+            (b'content-type', b'text/html; charset=utf-8'),
+            sent[0]['headers'])
+
+        self.assertTrue(sent[1]['body'].startswith(b'sync in horsemeat'))
+        self.assertEqual(sent[-1], dict(type='http.response.body', body=b''))
+
+    def test_async_handler(self):
+
+        sent = self.call('POST', '/async', b'hi')
+
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertEqual(sent[1]['body'], b'POST /async said hi')
+
+        # AsyncPage never asked for a connection, so it didn't get one.
+        self.assertFalse(hasattr(self.app.async_connections, 'apgconn'))
+
+    def test_async_handler_with_a_connection(self):
+
+        sent = self.call('GET', '/async-query')
+
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertEqual(self.app.async_connections.apgconn.commits, 1)
+
+        handler = self.app.dispatcher.handlers[2]
+        self.assertTrue(handler.same)
+
+        # The thread that routed the request set the deadline in its own
+        # context, but the handler still sees it.
+        self.assertEqual(handler.deadline.budget_seconds, 2)
+
+class IdleAsyncConnection(object):
+
+    closed = False
+
+    info = types.SimpleNamespace(
+        transaction_status=asgi.psycopg.pq.TransactionStatus.IDLE)
+
+class MakesAsyncConnections(object):
+
+    async def make_async_database_connection(self):
+        return IdleAsyncConnection()
+
+class TestAsyncConnections(unittest.TestCase):
+
+    def test_bounded(self):
+
+        connections = asgi.AsyncConnections(
+            MakesAsyncConnections(),
+            max_size=1,
+            timeout=0.01)
+
+        async def go():
+
+            apgconn = await connections.get()
+
+            with self.assertRaises(pg.PoolTimeout):
+                await connections.get()
+
+            await connections.put(apgconn)
+
+            # Now there's room again, and the idle one gets reused.
+            self.assertIs(await connections.get(), apgconn)
+
+        asyncio.run(go())
+
+class RecordingConfigWrapper(ProbedConfigWrapper):
+
+    """
+    Remembers every connection it makes.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(RecordingConfigWrapper, self).__init__(*args, **kwargs)
+        self.made = []
+
+    def make_database_connection(self, register_composite_types=True):
+
+        pgconn = super(RecordingConfigWrapper, self).make_database_connection(
+            register_composite_types)
+
+        self.made.append(pgconn)
+
+        return pgconn
+
+class LooksUpTheUser(Request):
+
+    """
+    Runs a query on the sync side before the handler, like looking up
+    the session does.
+    """
+
+    @property
+    def user(self):
+
+        if 'user' not in self:
+
+            self.primary_pgconn.cursor().execute("select 1")
+            self['user'] = None
+            self['routed on'] = threading.current_thread().name
+
+        return self['user']
+
+    def route(self):
+        return self.user
+
+class HogsTheRoutingThread(Handler):
+
+    route_strings = set(['GET /hog'])
+
+    def route(self, req):
+        req.route()
+        return self.check_route_strings(req)
+
+    async def handle(self, req):
+
+        # The thread that routed this request is idle now, so the pool
+        # hands it this job, and finish_response has to go somewhere
+        # else.
+        loop = asyncio.get_running_loop()
+        self.hogging = threading.Event()
+        self.release = threading.Event()
+
+        def hog():
+            self.hogging.set()
+            self.release.wait(5)
+
+        self.hog = loop.run_in_executor(self.dispatcher.asgi.executor, hog)
+        await loop.run_in_executor(None, self.hogging.wait, 5)
+
+        return Response.plain('done')
+
+class BrokenRequest(Request):
+
+    def __init__(self, *args, **kwargs):
+        raise ValueError("this environ is garbage")
+
+class TestASGIThreads(unittest.TestCase):
+
+    def setUp(self):
+
+        self.cw = RecordingConfigWrapper({'app': {}})
+
+        self.dispatcher = SubclassDispatcher(
+            [HogsTheRoutingThread, StreamsRows],
+            self.cw)
+
+        self.dispatcher.request_class = LooksUpTheUser
+        self.dispatcher.error_page = types.SimpleNamespace(
+            render=lambda: 'oops')
+
+        self.app = asgi.ASGIDispatcher(self.dispatcher, max_threads=2)
+        self.app.async_connections = BogusAsyncConnections(self.cw)
+        self.dispatcher.asgi = self.app
+
+        # Building the dispatcher used a connection of its own.
+        self.cw.made = []
+
+    def tearDown(self):
+        self.app.executor.shutdown()
+
+    def test_finishing_on_another_thread(self):
+
+        handler = self.dispatcher.handlers[0]
+
+        async def go():
+
+            sent = []
+
+            async def receive():
+                return dict(type='http.request', body=b'', more_body=False)
+
+            async def send(message):
+                sent.append(message)
+
+            scope = dict(type='http', method='GET', path='/hog',
+                query_string=b'', headers=[])
+
+            threads = []
+            original = self.dispatcher.finish_response
+
+            def finish_response(req, resp):
+
+                threads.append(
+                    (req['routed on'], threading.current_thread().name))
+
+                return original(req, resp)
+
+            self.dispatcher.finish_response = finish_response
+
+            await self.app(scope, receive, send)
+
+            handler.release.set()
+            await handler.hog
+
+            return sent, threads
+
+        sent, threads = asyncio.run(go())
+
+        self.assertEqual(sent[0]['status'], 200)
+
+        # This is the situation that used to go wrong.
+        [(routed_on, finished_on)] = threads
+        self.assertNotEqual(routed_on, finished_on)
+
+        self.assertEqual(len(self.cw.made), 1)
+
+        # The connection that looked up the user got committed, and
+        # nothing is left idle in a transaction.
+        pgconn = self.cw.made[0]
+        self.assertEqual(pgconn.queries, 1)
+        self.assertEqual(pgconn.commits, 1)
+        self.assertEqual(pgconn.status, 0)
+
+        # It went back to the pool.
+        self.assertEqual(len(self.app.connection_pool.idle), 1)
+
+    def test_streaming(self):
+
+        sent = []
+
+        async def receive():
+            return dict(type='http.request', body=b'', more_body=False)
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(self.app(
+            dict(type='http', method='GET', path='/export',
+                query_string=b'', headers=[]),
+            receive,
+            send))
+
+        self.assertEqual(sent[0]['status'], 200)
+
+        self.assertEqual(
+            [message['body'] for message in sent[1:]],
+            [b'0\n', b'1\n', b'2\n', b''])
+
+        # The stream ran on one connection, in one transaction, which
+        # got committed, and the connection went back.
+        [pgconn] = self.cw.made
+        self.assertEqual(pgconn.commits, 1)
+        self.assertEqual(len(self.app.connection_pool.idle), 1)
+
+    def test_request_blows_up(self):
+
+        self.dispatcher.request_class = BrokenRequest
+
+        sent = []
+
+        async def receive():
+            return dict(type='http.request', body=b'', more_body=False)
+
+        async def send(message):
+            sent.append(message)
+
+        with self.assertLogs('horsemeat.webapp.dispatcher', 'CRITICAL'):
+
+            asyncio.run(self.app(
+                dict(type='http', method='GET', path='/hog',
+                    query_string=b'', headers=[]),
+                receive,
+                send))
+
+        self.assertEqual(sent[0]['status'], 500)
+        self.assertEqual(sent[1]['body'], b'oops')
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,14 @@
 # vim: set expandtab ts=4 sw=4 filetype=python fileencoding=utf8:
 
+import contextvars
+import gc
+import threading
 import unittest
 
+import jinja2
+
 from horsemeat import configwrapper
+from horsemeat.webapp.request import current_request
 
 class SubclassConfigWrapper(configwrapper.ConfigWrapper):
 
@@ -43,6 +49,121 @@ class Test1(unittest.TestCase):
 
         cw.j
 
+class ClosesLikeAConnection(object):
+
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+class TestFork(unittest.TestCase):
+
+    def test_prepare_for_fork(self):
+
+        cw = SubclassConfigWrapper({'app': {'preload_app': True}})
+        pgconn = cw.postgresql_connection = ClosesLikeAConnection()
+
+        self.assertTrue(cw.preload_app)
+
+        cw.prepare_for_fork()
+
+        self.assertTrue(pgconn.closed)
+        self.assertIsNone(cw.postgresql_connection)
+        self.assertGreater(gc.get_freeze_count(), 0)
+
+    def test_reset_after_fork(self):
+
+        cw = SubclassConfigWrapper({'app': {}})
+        pgconn = cw.postgresql_connection = ClosesLikeAConnection()
+
+        cw.reset_after_fork()
+
+        # The parent still owns that socket, so the child must not
+        # close it.
+        self.assertFalse(pgconn.closed)
+        self.assertIsNone(cw.postgresql_connection)
+        self.assertIn(pgconn, configwrapper.inherited_connections)
+
+    def tearDown(self):
+
+        gc.unfreeze()
+        del configwrapper.inherited_connections[:]
+
+class TestThreads(unittest.TestCase):
+
+    def test_one_connection_per_thread(self):
+
+        cw = SubclassConfigWrapper({'app': {}})
+        cw.make_database_connection = \
+        lambda register_composite_types: ClosesLikeAConnection()
+
+        pgconns = dict()
+
+        # Keep all three threads alive at once, or they might reuse
+        # each other's idents.
+        barrier = threading.Barrier(3)
+
+        def f(name):
+            pgconns[name] = cw.get_pgconn()
+            self.assertIs(cw.get_pgconn(), pgconns[name])
+            barrier.wait()
+
+        threads = [threading.Thread(target=f, args=(i,)) for i in range(3)]
+
+        for t in threads:
+            t.start()
+
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(set(map(id, pgconns.values()))), 3)
+        self.assertEqual(len(cw.postgresql_connections), 3)
+
+        cw.disconnect_everything()
+
+        self.assertTrue(all(pgconn.closed for pgconn in pgconns.values()))
+        self.assertEqual(cw.postgresql_connections, {})
+
+    def test_templates_see_the_current_request(self):
+
+        cw = SubclassConfigWrapper({'app': {}})
+
+        cw.j.loader.mapping['test'] = jinja2.DictLoader({
+            'page.html': '{{ request }} {{ req }} {{ m.show() }}',
+            'macros.html': '{% macro show() %}{{ request }}{% endmacro %}',
+            'with-import.html':
+                '{% import "test/macros.html" as m %}{{ m.show() }}'})
+
+        results = dict()
+
+        def render(name):
+
+            current_request.set(name)
+
+            results[name] = [
+                cw.j.get_template('test/with-import.html').render(),
+                cw.j.get_template('test/page.html').render(
+                    m=dict(show=lambda: 'x')),
+                cw.j.get_template('test/page.html').render(
+                    request='mine', m=dict(show=lambda: 'x'))]
+
+        threads = [
+            threading.Thread(
+                target=contextvars.copy_context().run,
+                args=(render, name))
+            for name in ['alice', 'bob']]
+
+        for t in threads:
+            t.start()
+
+        for t in threads:
+            t.join()
+
+        self.assertEqual(results['alice'], [
+            'alice', 'alice alice x', 'mine alice x'])
+
+        self.assertEqual(results['bob'], [
+            'bob', 'bob bob x', 'mine bob x'])
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,937 @@
+# vim: set expandtab ts=4 sw=4 filetype=python fileencoding=utf8:
+
+import os
+import re
+import tempfile
+import threading
+import unittest
+
+import psycopg2.extensions
+
+from horsemeat import configwrapper
+from horsemeat import pg
+from horsemeat.webapp import frameworkhandlers
+from horsemeat.webapp.dispatcher import Dispatcher
+from horsemeat.webapp.handler import Handler
+from horsemeat.webapp.handlermanifest import LazyHandler
+from horsemeat.webapp.request import Request
+from horsemeat.webapp.response import Response
+
+class BogusConnection(object):
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+class SubclassConfigWrapper(configwrapper.ConfigWrapper):
+
+    @property
+    def dispatcher_class(self):
+        return SubclassDispatcher
+
+    def get_postgresql_connection(self, register_composite_types=True):
+        return BogusConnection()
+
+    get_pgconn = get_postgresql_connection
+
+class ModuleStringDispatcher(Dispatcher):
+
+    request_class = None
+    error_page = None
+
+    def make_handlers(self):
+        self.handlers = self.make_handlers_from_module_string(
+            'horsemeat.tests.samplehandlers')
+
+class SubclassDispatcher(Dispatcher):
+
+    request_class = None
+    error_page = None
+
+    def __init__(self, handler_classes, config_wrapper):
+        self.handler_classes = handler_classes
+        super(SubclassDispatcher, self).__init__(None, None, config_wrapper)
+
+    def make_handlers(self):
+        self.handlers = [cls(self.config_wrapper, self)
+            for cls in self.handler_classes]
+
+class Login(Handler):
+
+    route = Handler.check_route_strings
+    route_strings = set(['GET /login', 'POST /login'])
+
+    def handle(self, req):
+        pass
+
+class AlsoLogin(Handler):
+
+    route = Handler.check_route_strings
+    route_strings = set(['GET /login', 'GET /also-login'])
+
+    def handle(self, req):
+        pass
+
+class StealsLogin(Handler):
+
+    def route(self, req):
+        if req.line_one == 'GET /login':
+            return self.handle
+
+    def handle(self, req):
+        pass
+
+class ClubDetails(Handler):
+
+    route = Handler.check_route_patterns
+
+    route_patterns = [
+        re.compile(r'GET /club/(?P<club_number>\d+)$'),
+        'GET /club/featured',
+    ]
+
+    def handle(self, req):
+        pass
+
+class ClubMembers(Handler):
+
+    route = Handler.check_route_patterns
+
+    route_patterns = [
+        re.compile(r'GET /club/(?P<club_number>\d+)/(?P<member_id>\d+)$'),
+        re.compile(r'GET /club/(?P<club_number>\d+)/members'
+            r'|POST /club/(?P<club_id>\d+)/members', re.I),
+    ]
+
+    def handle(self, req):
+        pass
+
+class CountsClubMembers(Handler):
+
+    route = Handler.check_route_patterns
+
+    # This one can't be merged into the big regular expression, so the
+    # dispatcher has to call check_route_patterns on it.
+    route_patterns = [
+        re.compile(r'GET /club/(\d+)/members/\1$'),
+    ]
+
+    def handle(self, req):
+        pass
+
+# Subclass this here, so we don't go looking for the framework template
+# folder.
+class NotFound(frameworkhandlers.NotFound):
+    pass
+
+class TestDispatch(unittest.TestCase):
+
+    def make_dispatcher(self, *handler_classes):
+        return SubclassDispatcher(
+            handler_classes,
+            SubclassConfigWrapper({'app': {}}))
+
+    def dispatch_to(self, dispatcher, line_one):
+
+        REQUEST_METHOD, PATH_INFO = line_one.split(' ')
+
+        f = dispatcher.dispatch(Request(None, None, dict(
+            REQUEST_METHOD=REQUEST_METHOD,
+            PATH_INFO=PATH_INFO)))
+
+        return f.__self__.__class__
+
+    def test_exact_routes_get_indexed(self):
+
+        d = self.make_dispatcher(Login, AlsoLogin, NotFound)
+
+        self.assertEqual(len(d.route_table.unindexed_handlers), 1)
+        self.assertIs(self.dispatch_to(d, 'POST /login'), Login)
+        self.assertIs(self.dispatch_to(d, 'GET /also-login'), AlsoLogin)
+
+    def test_first_handler_wins(self):
+
+        d = self.make_dispatcher(Login, AlsoLogin, NotFound)
+
+        self.assertIs(self.dispatch_to(d, 'GET /login'), Login)
+
+        d = self.make_dispatcher(StealsLogin, Login, NotFound)
+
+        self.assertIs(self.dispatch_to(d, 'GET /login'), StealsLogin)
+        self.assertIs(self.dispatch_to(d, 'POST /login'), Login)
+
+    def test_unmatched_requests_fall_through(self):
+
+        d = self.make_dispatcher(Login, StealsLogin, NotFound)
+
+        self.assertIs(
+            self.dispatch_to(d, 'GET /not-a-page'), NotFound)
+
+    def test_route_patterns_get_merged(self):
+
+        d = self.make_dispatcher(ClubDetails, ClubMembers, NotFound)
+
+        self.assertEqual(len(d.route_table.unindexed_handlers), 1)
+
+        req = Request(None, None, dict(
+            REQUEST_METHOD='GET',
+            PATH_INFO='/club/7/99'))
+
+        f = d.dispatch(req)
+
+        self.assertIs(f.__self__.__class__, ClubMembers)
+        self.assertEqual(req['club_number'], '7')
+        self.assertEqual(req['member_id'], '99')
+
+        req = Request(None, None, dict(
+            REQUEST_METHOD='post',
+            PATH_INFO='/club/8/members'))
+
+        f = d.dispatch(req)
+
+        self.assertIs(f.__self__.__class__, ClubMembers)
+        self.assertEqual(req['club_id'], '8')
+        self.assertIsNone(req['club_number'])
+
+        self.assertIs(self.dispatch_to(d, 'GET /club/featured'), ClubDetails)
+        self.assertIs(self.dispatch_to(d, 'GET /club/featured/2'), NotFound)
+
+    def test_unmergeable_patterns_still_work(self):
+
+        d = self.make_dispatcher(CountsClubMembers, ClubMembers, NotFound)
+
+        self.assertEqual(len(d.route_table.unindexed_handlers), 2)
+
+        self.assertIs(
+            self.dispatch_to(d, 'GET /club/3/members/3'),
+            CountsClubMembers)
+
+        self.assertIs(
+            self.dispatch_to(d, 'GET /club/3/members/4'),
+            ClubMembers)
+
+    def test_pattern_handler_in_front_of_string_handler(self):
+
+        class AllPosts(Handler):
+            route = Handler.check_route_patterns
+            route_patterns = [re.compile(r'POST /')]
+            handle = lambda self, req: None
+
+        d = self.make_dispatcher(AllPosts, Login, NotFound)
+
+        self.assertIs(self.dispatch_to(d, 'POST /login'), AllPosts)
+        self.assertIs(self.dispatch_to(d, 'GET /login'), Login)
+
+    def test_dispatch_cache(self):
+
+        d = self.make_dispatcher(StealsLogin, Login, ClubDetails, NotFound)
+
+        self.assertIs(self.dispatch_to(d, 'POST /login'), Login)
+        self.assertIs(self.dispatch_to(d, 'POST /login'), Login)
+
+        # StealsLogin didn't promise to only read the line one, so
+        # nothing got remembered.
+        self.assertEqual(d.dispatch_cache.cache_info().currsize, 0)
+
+        StealsLogin.route_only_reads_line_one = True
+
+        try:
+
+            self.assertIs(self.dispatch_to(d, 'GET /login'), StealsLogin)
+            self.assertIs(self.dispatch_to(d, 'GET /login'), StealsLogin)
+            self.assertIs(self.dispatch_to(d, 'GET /nope'), NotFound)
+            self.assertIs(self.dispatch_to(d, 'GET /nope'), NotFound)
+
+            req = Request(None, None, dict(
+                REQUEST_METHOD='GET',
+                PATH_INFO='/club/12'))
+
+            d.dispatch(req)
+            d.dispatch(req)
+
+            self.assertEqual(req['club_number'], '12')
+
+            info = d.dispatch_cache.cache_info()
+
+            self.assertEqual(info.currsize, 3)
+            self.assertEqual(info.hits, 3)
+            self.assertEqual(info.negative_hits, 1)
+
+        finally:
+            StealsLogin.route_only_reads_line_one = False
+
+    def test_dispatch_cache_can_be_turned_off(self):
+
+        d = SubclassDispatcher([Login, NotFound],
+            SubclassConfigWrapper({'app': {'dispatch_cache_size': 0}}))
+
+        self.assertIsNone(d.dispatch_cache)
+        self.assertIs(self.dispatch_to(d, 'GET /login'), Login)
+
+    def tearDown(self):
+        configwrapper.ConfigWrapper.default_instance = None
+
+class TestHandlerManifest(unittest.TestCase):
+
+    def setUp(self):
+
+        fd, self.manifest_path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+
+        self.cw = SubclassConfigWrapper({'app': {
+            'handler_manifest': self.manifest_path}})
+
+    def test_lazy_handlers(self):
+
+        eager = ModuleStringDispatcher(None, None, self.cw)
+
+        self.assertFalse(
+            any(isinstance(h, LazyHandler) for h in eager.handlers))
+
+        eager.write_handler_manifest()
+
+        lazy = ModuleStringDispatcher(None, None, self.cw)
+
+        self.assertEqual(len(lazy.handlers), len(eager.handlers))
+        self.assertTrue(
+            all(isinstance(h, LazyHandler) for h in lazy.handlers))
+
+        loaded = dict((h.description['name'], h.loaded_handler is not None)
+            for h in lazy.handlers)
+
+        # Only the handler with an on_startup method got built.
+        self.assertEqual(loaded, dict(
+            ClubDetails=False,
+            Login=False,
+            StartsUpEarly=True,
+            ZNotFound=False))
+
+        self.assertEqual(
+            len(lazy.route_table.unindexed_handlers),
+            len(eager.route_table.unindexed_handlers))
+
+        req = Request(None, None, dict(
+            REQUEST_METHOD='GET',
+            PATH_INFO='/club/99'))
+
+        f = lazy.dispatch(req)
+
+        self.assertEqual(f.__self__.__class__.__name__, 'ClubDetails')
+        self.assertEqual(req['club_number'], '99')
+
+        loaded = dict((h.description['name'], h.loaded_handler is not None)
+            for h in lazy.handlers)
+
+        self.assertEqual(loaded, dict(
+            ClubDetails=True,
+            Login=False,
+            StartsUpEarly=True,
+            ZNotFound=False))
+
+        # Loading the real handler doesn't make the LazyHandler pretend
+        # to be it.
+        for h in lazy.handlers:
+            self.assertIs(type(h), LazyHandler)
+            self.assertIs(h.__class__, LazyHandler)
+
+    def test_lazy_not_found(self):
+
+        eager = ModuleStringDispatcher(None, None, self.cw)
+        eager.write_handler_manifest()
+
+        lazy = ModuleStringDispatcher(None, None, self.cw)
+
+        self.assertEqual(
+            [h.handler_name for h in lazy.handlers if h.is_not_found],
+            ['ZNotFound'])
+
+        req = Request(None, None, dict(
+            REQUEST_METHOD='GET',
+            PATH_INFO='/wp-login.php'))
+
+        lazy.dispatch(req)
+
+        # The manifest, not the real handler, says this was a negative
+        # decision.
+        self.assertTrue(
+            lazy.dispatch_cache.get('GET /wp-login.php').is_negative)
+
+    def test_stale_manifest_gets_ignored(self):
+
+        eager = ModuleStringDispatcher(None, None, self.cw)
+        eager.write_handler_manifest()
+
+        manifest = eager.current_handler_manifest
+        source_files = manifest.modules['horsemeat.tests.samplehandlers'][
+            'source_files']
+
+        source_files[0]['mtime'] -= 1
+        manifest.write(self.manifest_path)
+
+        d = ModuleStringDispatcher(None, None, self.cw)
+
+        self.assertFalse(
+            any(isinstance(h, LazyHandler) for h in d.handlers))
+
+    def tearDown(self):
+        os.remove(self.manifest_path)
+        configwrapper.ConfigWrapper.default_instance = None
+
+
+class CountingCursor(object):
+
+    def __init__(self, pgconn, name=None):
+        self.pgconn = pgconn
+        self.name = name
+        self.closed = False
+
+    def execute(self, qry, params=None):
+
+        self.pgconn.queries += 1
+        self.pgconn.status = 2
+
+        if self.pgconn.broken:
+            raise Exception("server closed the connection unexpectedly")
+
+    def fetchone(self):
+        return (1,)
+
+    def __iter__(self):
+
+        # Named cursors only work inside a transaction.
+        for i in range(3):
+
+            if self.pgconn.status != 2:
+                raise Exception("cursor does not exist")
+
+            yield (i,)
+
+    def close(self):
+        self.closed = True
+
+class CountingConnection(BogusConnection):
+
+    queries = 0
+    broken = False
+    closed = False
+
+    commits = 0
+    status = 0
+
+    def cursor(self, name=None):
+        return CountingCursor(self, name)
+
+    def commit(self):
+        self.commits += 1
+        self.status = 0
+
+    def rollback(self):
+        self.status = 0
+
+    def close(self):
+        self.closed = True
+
+    # Looks like psycopg2.
+    def get_transaction_status(self):
+        return self.status
+
+    def set_session(self, **kwargs):
+        self.session = kwargs
+
+class ProbedConfigWrapper(configwrapper.ConfigWrapper):
+
+    dispatcher_class = None
+
+    def make_database_connection(self, register_composite_types=True):
+        return CountingConnection()
+
+class TestProbes(unittest.TestCase):
+
+    def setUp(self):
+
+        self.cw = ProbedConfigWrapper({'app': {
+            'liveness_path': '/healthz',
+            'readiness_path': '/readyz',
+            'readiness_cache_seconds': 60}})
+
+        # request_class is None, so this blows up if a probe ever
+        # builds a request.
+        self.dispatcher = SubclassDispatcher([Login], self.cw)
+
+    def probe(self, path):
+
+        replies = []
+
+        body = self.dispatcher(
+            dict(REQUEST_METHOD='GET', PATH_INFO=path),
+            lambda status, headers: replies.append(status))
+
+        return replies[0], b''.join(body)
+
+    def test_liveness(self):
+        self.assertEqual(self.probe('/healthz'), ('200 OK', b'ok'))
+
+    def test_readiness_is_cached(self):
+
+        self.assertEqual(self.probe('/readyz'), ('200 OK', b'ok'))
+        self.assertEqual(self.probe('/readyz'), ('200 OK', b'ok'))
+
+        self.assertEqual(self.cw.get_pgconn().queries, 1)
+
+    def test_not_ready(self):
+
+        pgconn = self.cw.get_pgconn()
+        pgconn.broken = True
+
+        self.assertEqual(
+            self.probe('/readyz'),
+            ('503 SERVICE UNAVAILABLE', b'not ready'))
+
+        # The broken connection got thrown away.
+        self.assertTrue(pgconn.closed)
+        self.assertIsNot(self.cw.get_pgconn(), pgconn)
+
+    def test_not_ready_when_the_pool_is_busy(self):
+
+        self.cw = ProbedConfigWrapper({
+            'app': {'readiness_path': '/readyz'},
+            'postgresql': {'pool': {'max_size': 1, 'timeout': 30}}})
+
+        self.dispatcher = SubclassDispatcher([Login], self.cw)
+
+        pool = self.cw.get_connection_pool()
+        pgconn = pool.getconn()
+
+        # This would sit out the pool's 30 second timeout if the probe
+        # waited for a connection.
+        self.assertEqual(
+            self.probe('/readyz'),
+            ('503 SERVICE UNAVAILABLE', b'not ready'))
+
+        pool.putconn(pgconn)
+
+class UsesTheDatabase(Handler):
+
+    route = Handler.check_route_strings
+    route_strings = set(['GET /database'])
+
+    def handle(self, req):
+        req.pgconn.cursor().execute("select 1")
+        return Response.plain('used the database')
+
+class ReadsOnly(UsesTheDatabase):
+
+    route_strings = set(['GET /read-only'])
+    transaction_mode = 'read only'
+
+class RoutesWithTheDatabase(ReadsOnly):
+
+    route_strings = set(['GET /read-only-after-routing'])
+
+    def route(self, req):
+
+        # Like looking up req.user.
+        req.pgconn.cursor().execute("select 1")
+
+        return self.check_route_strings(req)
+
+class JustLooks(Handler):
+
+    route = Handler.check_route_strings
+    route_strings = set(['GET /just-looks'])
+
+    def handle(self, req):
+        return Response.plain(repr(req.pgconn))
+
+class StaysAway(Handler):
+
+    route = Handler.check_route_strings
+    route_strings = set(['GET /static'])
+
+    def handle(self, req):
+        return Response.plain('never touched the database')
+
+class TakesForever(UsesTheDatabase):
+
+    route_strings = set(['GET /slow'])
+
+    def handle(self, req):
+        req.pgconn.cursor().execute("select 1")
+        raise psycopg2.extensions.QueryCanceledError(
+            "canceling statement due to statement timeout")
+
+class HasItsOwnBudget(Handler):
+
+    route = Handler.check_route_strings
+    route_strings = set(['GET /budget'])
+
+    latency_budget = 2
+
+    def handle(self, req):
+        return Response.plain(str(pg.current_deadline.get().budget_seconds))
+
+class NobodyRequest(Request):
+
+    @property
+    def user(self):
+        return None
+
+class StreamsRows(Handler):
+
+    route = Handler.check_route_strings
+    route_strings = set(['GET /export', 'GET /broken-export'])
+
+    def handle(self, req):
+
+        def make_lines():
+
+            for row in pg.stream_rows(req.pgconn, "select i from rows"):
+                yield '{0}\n'.format(row[0])
+
+            if req.line_one == 'GET /broken-export':
+                raise ValueError("disk full")
+
+        return Response.stream(make_lines())
+
+class TestLazyCheckout(unittest.TestCase):
+
+    def setUp(self):
+
+        self.cw = ProbedConfigWrapper({
+            'app': {},
+            'postgresql': {'pool': {'min_size': 0, 'max_size': 1}}})
+
+        self.dispatcher = SubclassDispatcher(
+            [UsesTheDatabase, ReadsOnly, JustLooks, StaysAway,
+                TakesForever, HasItsOwnBudget, StreamsRows,
+                RoutesWithTheDatabase],
+            self.cw)
+
+        self.dispatcher.request_class = NobodyRequest
+
+    def get(self, path):
+
+        replies = []
+
+        body = self.dispatcher(
+            dict(REQUEST_METHOD='GET', PATH_INFO=path),
+            lambda status, headers: replies.append(status))
+
+        return replies[0], b''.join(body)
+
+    def test_static_requests_never_check_out(self):
+
+        with self.assertLogs('horsemeat.webapp.dispatcher', 'INFO') as logs:
+            self.assertEqual(self.get('/static')[0], '200 OK')
+
+        self.assertIn(
+            'Replying with status 200 OK '
+            '(0 queries, 0.0 ms in the database).',
+            logs.output[-1])
+
+        pool = self.cw.get_connection_pool()
+        self.assertEqual(pool.size, 0)
+
+    def test_connection_goes_back_to_the_pool(self):
+
+        self.assertEqual(self.get('/database')[0], '200 OK')
+        self.assertEqual(self.get('/database')[0], '200 OK')
+
+        pool = self.cw.get_connection_pool()
+
+        self.assertEqual(pool.size, 1)
+        self.assertEqual(len(pool.idle), 1)
+        self.assertEqual(pool.idle[0][0].commits, 2)
+
+    def test_no_commit_without_a_transaction(self):
+
+        self.assertEqual(self.get('/just-looks')[0], '200 OK')
+
+        pgconn = self.cw.get_connection_pool().idle[0][0]
+        self.assertEqual(pgconn.commits, 0)
+
+    def test_timeouts(self):
+
+        with self.assertLogs('horsemeat.webapp.dispatcher', 'WARNING'):
+            status, body = self.get('/slow')
+
+        self.assertEqual(status, '504 GATEWAY TIMEOUT')
+        self.assertIn(b'took too long', body)
+
+        # The connection went back to the pool rolled back.
+        pgconn = self.cw.get_connection_pool().idle[0][0]
+        self.assertEqual(pgconn.status, 0)
+        self.assertEqual(pgconn.commits, 0)
+
+    def test_latency_budgets(self):
+
+        # webapp_timeout defaults to 30.
+        self.assertEqual(self.cw.latency_budget_secs, 27)
+
+        self.assertEqual(self.get('/budget'), ('200 OK', b'2'))
+
+    def start_stream(self, path):
+
+        replies = []
+
+        body = self.dispatcher(
+            dict(REQUEST_METHOD='GET', PATH_INFO=path),
+            lambda status, headers: replies.append(status))
+
+        self.assertEqual(replies, ['200 OK'])
+
+        return body
+
+    def test_streaming(self):
+
+        pool = self.cw.get_connection_pool()
+
+        body = self.start_stream('/export')
+
+        # Nothing ran yet.
+        self.assertEqual(pool.size, 0)
+
+        # This is what the WSGI server does.
+        try:
+
+            chunks = [next(body)]
+
+            # The body checked out a connection and has a transaction
+            # open.
+            self.assertEqual(len(pool.idle), 0)
+            self.assertEqual(pool.size, 1)
+
+            chunks.extend(body)
+
+        finally:
+            body.close()
+
+        self.assertEqual(chunks, [b'0\n', b'1\n', b'2\n'])
+
+        # Now the transaction got committed and the connection went
+        # back.
+        self.assertEqual(len(pool.idle), 1)
+
+        pgconn = pool.idle[0][0]
+        self.assertEqual(pgconn.commits, 1)
+        self.assertEqual(pgconn.status, 0)
+
+        # A regular request after that gets the connection.
+        self.assertEqual(self.get('/database')[0], '200 OK')
+
+    def test_broken_stream(self):
+
+        pool = self.cw.get_connection_pool()
+
+        body = self.start_stream('/broken-export')
+
+        with self.assertRaises(ValueError):
+
+            try:
+                list(body)
+
+            finally:
+                body.close()
+
+        pgconn = pool.idle[0][0]
+        self.assertEqual(pgconn.commits, 0)
+        self.assertEqual(pgconn.status, 0)
+
+    def test_autocommitting_connection_under_a_lease(self):
+
+        pool = self.cw.get_connection_pool()
+        lease = pg.ConnectionLease(pool)
+        token = pg.current_lease.set(lease)
+
+        try:
+
+            with self.cw.get_autocommitting_postgresql_connection() \
+            as pgconn:
+                pgconn.cursor().execute("select 1")
+
+            self.assertIs(pgconn, lease.pgconn)
+            self.assertEqual(pgconn.commits, 1)
+
+        finally:
+            lease.release()
+            pg.current_lease.reset(token)
+
+    def test_transaction_mode(self):
+
+        self.assertEqual(self.get('/read-only')[0], '200 OK')
+
+        pgconn = self.cw.get_connection_pool().idle[0][0]
+        self.assertEqual(pgconn.session['readonly'], True)
+
+        # The next handler puts it back.
+        self.assertEqual(self.get('/database')[0], '200 OK')
+        self.assertEqual(pgconn.session['readonly'], 'DEFAULT')
+
+    def test_transaction_mode_after_routing(self):
+
+        self.assertEqual(
+            self.get('/read-only-after-routing')[0],
+            '200 OK')
+
+        pgconn = self.cw.get_connection_pool().idle[0][0]
+
+        # The routing transaction got committed, so the handler's
+        # transaction was read only.
+        self.assertEqual(pgconn.session['readonly'], True)
+        self.assertEqual(pgconn.commits, 2)
+
+class Writes(UsesTheDatabase):
+
+    route_strings = set(['POST /database'])
+
+class WritesOnAGet(UsesTheDatabase):
+
+    route_strings = set(['GET /logout'])
+    use_replica = False
+
+class ReadsOnlyOnAPost(ReadsOnly):
+
+    route_strings = set(['POST /report'])
+
+class ReplicatedConfigWrapper(ProbedConfigWrapper):
+
+    def make_replica_connection(self, replica):
+
+        if replica.get('down'):
+            raise Exception("could not connect to server")
+
+        pgconn = CountingConnection()
+        pgconn.host = replica['host']
+
+        return pgconn
+
+class TestReplicas(unittest.TestCase):
+
+    def make_dispatcher(self, replicas, **settings):
+
+        settings['replicas'] = replicas
+
+        self.cw = ReplicatedConfigWrapper({
+            'app': {},
+            'postgresql': settings})
+
+        self.dispatcher = SubclassDispatcher(
+            [UsesTheDatabase, Writes, WritesOnAGet, ReadsOnlyOnAPost],
+            self.cw)
+
+        self.dispatcher.request_class = NobodyRequest
+
+    def request(self, line_one):
+
+        method, path = line_one.split()
+        replies = []
+
+        body = self.dispatcher(
+            dict(REQUEST_METHOD=method, PATH_INFO=path),
+            lambda status, headers: replies.append(status))
+
+        self.assertEqual(replies[0], '200 OK')
+
+        return b''.join(body)
+
+    @property
+    def primary(self):
+        return self.cw.get_pgconn_if_connected()
+
+    @property
+    def replica(self):
+
+        # The request gave its replica connection back to the pool.
+        [pgconn] = [
+            pgconn
+            for pool in self.cw.get_replica_router().pools
+            for pgconn, _ in pool.idle]
+
+        return pgconn
+
+    def test_gets_read_from_the_replica(self):
+
+        self.make_dispatcher([{'host': 'db2'}])
+
+        self.request('GET /database')
+
+        self.assertEqual(self.primary.queries, 0)
+
+        # One lag check and one select 1, then the commit.
+        self.assertEqual(self.replica.queries, 2)
+        self.assertEqual(self.replica.commits, 1)
+
+        # The lag check is good for a while.
+        self.request('GET /database')
+        self.assertEqual(self.replica.queries, 3)
+
+    def test_replica_connections_get_pooled(self):
+
+        self.make_dispatcher([{'host': 'db2'}])
+
+        threads = [
+            threading.Thread(target=self.request, args=['GET /database'])
+            for _ in range(3)]
+
+        for t in threads:
+            t.start()
+            t.join()
+
+        # Three threads, one after another, all used the same
+        # connection, and none of them kept it.
+        [pool] = self.cw.get_replica_router().pools
+        self.assertEqual(pool.size, 1)
+        self.assertEqual(len(pool.idle), 1)
+
+    def test_writes_go_to_the_primary(self):
+
+        self.make_dispatcher([{'host': 'db2'}])
+
+        self.request('POST /database')
+        self.request('GET /logout')
+
+        self.assertEqual(self.primary.queries, 2)
+        self.assertIsNone(self.cw.replica_router)
+
+    def test_read_only_posts_use_the_replica(self):
+
+        self.make_dispatcher([{'host': 'db2'}],
+            route_safe_methods_to_replicas=False)
+
+        self.request('POST /report')
+
+        self.assertEqual(self.primary.queries, 0)
+        self.assertEqual(self.replica.session['readonly'], True)
+
+        # And with safe methods turned off, this goes to the primary.
+        self.request('GET /database')
+        self.assertEqual(self.primary.queries, 1)
+
+    def test_lagging_replica(self):
+
+        # CountingCursor says everything is 1 second behind.
+        self.make_dispatcher([{'host': 'db2'}], replica_max_lag_seconds=0.5)
+
+        with self.assertLogs('horsemeat.pgpool', 'WARNING'):
+            self.request('GET /database')
+
+        self.assertEqual(self.primary.queries, 1)
+        self.assertEqual(self.replica.queries, 1)
+
+    def test_replica_down(self):
+
+        self.make_dispatcher([{'host': 'db2', 'down': True}, {'host': 'db3'}])
+
+        with self.assertLogs('horsemeat.pgpool', 'WARNING'):
+            self.request('GET /database')
+
+        self.assertEqual(self.replica.host, 'db3')
+        self.assertEqual(self.cw.get_replica_router().down_until.keys(), {0})
+
+    def tearDown(self):
+        self.cw.disconnect_everything()
+
+if __name__ == "__main__":
+    unittest.main()
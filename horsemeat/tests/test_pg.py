@@ -0,0 +1,1133 @@
+# vim: set expandtab ts=4 sw=4 filetype=python fileencoding=utf8:
+
+import array
+import collections
+import contextvars
+import datetime
+import decimal
+import itertools
+import json
+import math
+import pickle
+import struct
+import threading
+import time
+import types
+import unittest
+import uuid
+
+import psycopg
+import psycopg.adapt
+import psycopg.rows
+import psycopg2.extensions
+import psycopg2.sql
+
+import horsemeat
+from horsemeat import pg
+from horsemeat import pgcopy
+from horsemeat import pgjson
+from horsemeat.model import session
+from horsemeat.model import user
+from horsemeat.webapp.response import Response
+from horsemeat.tests import fakepg
+from horsemeat.tests.test_configwrapper import SubclassConfigWrapper
+
+def sleep(qry, params):
+
+    """
+    Answer a query like '0.2' by sleeping that long, and say where it
+    ran.
+    """
+
+    seconds = float(qry)
+
+    if seconds < 0:
+        raise ValueError("negative sleep")
+
+    time.sleep(seconds)
+
+    return [(
+        seconds,
+        threading.get_ident(),
+        pg.current_query_stats.get(None))]
+
+def make_sleepy_connection(register_composite_types=True):
+    return fakepg.Psycopg2Connection(answer=sleep)
+
+class TestRunQueriesConcurrently(unittest.TestCase):
+
+    def setUp(self):
+
+        self.cw = SubclassConfigWrapper({
+            'app': {},
+            'postgresql': {'query_threads': 3}})
+
+        self.cw.make_database_connection = make_sleepy_connection
+
+    def tearDown(self):
+        self.cw.get_query_executor().shutdown()
+
+    def test_takes_as_long_as_the_slowest(self):
+
+        started = time.perf_counter()
+
+        results = pg.run_queries_concurrently(self.cw, dict(
+            a='0.2',
+            b=('0.2', None),
+            c='0.1'))
+
+        elapsed = time.perf_counter() - started
+
+        self.assertLess(elapsed, 0.4)
+        self.assertEqual(results['a'].rows[0][0], 0.2)
+        self.assertGreaterEqual(results['a'].seconds, 0.2)
+
+        # Each query ran on its own thread and connection.
+        self.assertEqual(len(set(r.rows[0][1] for r in results.values())), 3)
+
+        self.assertEqual(
+            sum(pgconn.rollbacks
+                for pgconn in self.cw.postgresql_connections.values()),
+            3)
+
+    def test_raises_the_first_error(self):
+
+        self.assertRaises(
+            ValueError,
+            pg.run_queries_concurrently,
+            self.cw,
+            dict(a='0.01', b='-1'))
+
+class TestRunQueriesOnAPool(unittest.TestCase):
+
+    def setUp(self):
+
+        self.cw = SubclassConfigWrapper({
+            'app': {},
+            'postgresql': {
+                'query_threads': 3,
+                'pool': {'min_size': 0, 'max_size': 2}}})
+
+        self.cw.make_database_connection = make_sleepy_connection
+
+    def tearDown(self):
+        self.cw.get_query_executor().shutdown()
+
+    def test_pool(self):
+
+        pool = self.cw.get_connection_pool()
+
+        # Pretend this is a request with a connection checked out.
+        lease = pg.ConnectionLease(pool)
+        lease.get()
+
+        stats = pg.QueryStats()
+
+        def run():
+
+            pg.current_lease.set(lease)
+            pg.current_query_stats.set(stats)
+
+            return pg.run_queries_concurrently(self.cw, dict(
+                a='0.05',
+                b='0.05',
+                c='0.05'))
+
+        results = contextvars.copy_context().run(run)
+
+        # Nobody borrowed the request's connection, and nobody went
+        # around the pool.
+        self.assertEqual(pool.size, 2)
+        self.assertEqual(len(pool.idle), 1)
+        self.assertEqual(self.cw.postgresql_connections, {})
+        self.assertEqual(lease.pgconn.rollbacks, 0)
+
+        # The queries ran in the request's context.
+        self.assertTrue(all(r.rows[0][2] is stats for r in results.values()))
+
+        lease.release()
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+
+        self.made = []
+
+        def connect():
+            self.made.append(fakepg.Psycopg2Connection())
+            return self.made[-1]
+
+        self.pool = pg.ConnectionPool(connect, min_size=1, max_size=2,
+            timeout=0.2, check_interval=60)
+
+    def test_reuses_connections(self):
+
+        self.pool.fill()
+
+        with self.pool.connection() as pgconn:
+            pgconn.cursor().execute("update stuff")
+
+        # Putting it back rolled back the open transaction.
+        self.assertEqual(pgconn.rollbacks, 1)
+
+        with self.pool.connection() as pgconn2:
+            self.assertIs(pgconn2, pgconn)
+
+        self.assertEqual(len(self.made), 1)
+
+    def test_max_size(self):
+
+        self.pool.getconn()
+        b = self.pool.getconn()
+
+        self.assertRaises(pg.PoolTimeout, self.pool.getconn)
+
+        self.pool.putconn(b)
+        self.assertIs(self.pool.getconn(), b)
+
+    def test_throws_away_broken_connections(self):
+
+        a = self.pool.getconn()
+        a.closed = 2
+        self.pool.putconn(a)
+
+        self.assertEqual(self.pool.size, 0)
+
+        b = self.pool.getconn()
+        self.assertIsNot(a, b)
+
+    def test_checks_stale_connections(self):
+
+        self.pool.check_interval = 0
+
+        a = self.pool.getconn()
+        self.pool.putconn(a)
+
+        # Postgres restarted while a sat in the pool.
+        a.fail_next_query = True
+
+        b = self.pool.getconn()
+
+        self.assertIsNot(a, b)
+        self.assertEqual(self.pool.size, 1)
+
+    def test_backoff(self):
+
+        failures = [Exception("the database system is starting up")] * 2
+
+        def connect():
+
+            if failures:
+                raise failures.pop()
+
+            return fakepg.Psycopg2Connection()
+
+        pool = pg.ConnectionPool(connect, timeout=5)
+
+        started = time.perf_counter()
+        pool.getconn()
+
+        # Slept 0.1 then 0.2 seconds.
+        self.assertGreaterEqual(time.perf_counter() - started, 0.3)
+
+    def test_lease_is_lazy(self):
+
+        lease = pg.ConnectionLease(self.pool)
+        lease.release()
+
+        self.assertEqual(self.made, [])
+
+        self.assertIs(lease.get(), lease.get())
+        lease.release()
+
+        self.assertEqual(len(self.pool.idle), 1)
+
+class TestTransactionModes(unittest.TestCase):
+
+    def test_psycopg2(self):
+
+        pgconn = fakepg.Psycopg2Connection()
+
+        pg.set_transaction_mode(pgconn, 'read only')
+
+        self.assertEqual(pgconn.session, dict(
+            isolation_level='DEFAULT', readonly=True, autocommit=False))
+
+        pg.set_transaction_mode(pgconn, None)
+
+        self.assertEqual(pgconn.session, dict(
+            isolation_level='DEFAULT', readonly='DEFAULT', autocommit=False))
+
+    def test_psycopg3(self):
+
+        pgconn = fakepg.Psycopg3Connection()
+
+        pg.set_transaction_mode(pgconn, 'serializable')
+
+        self.assertEqual(
+            pgconn.isolation_level,
+            psycopg.IsolationLevel.SERIALIZABLE)
+
+        pg.set_transaction_mode(pgconn, 'autocommit')
+
+        self.assertTrue(pgconn.autocommit)
+        self.assertIsNone(pgconn.isolation_level)
+
+    def test_not_in_the_middle_of_a_transaction(self):
+
+        pgconn = fakepg.Psycopg2Connection()
+        pgconn.status = 2
+
+        pg.set_transaction_mode(pgconn, 'read only')
+
+        self.assertFalse(hasattr(pgconn, 'session'))
+
+    def test_unknown_mode(self):
+
+        self.assertRaises(
+            ValueError,
+            pg.set_transaction_mode,
+            fakepg.Psycopg2Connection(),
+            'read mostly')
+
+class TestStatements(unittest.TestCase):
+
+    def setUp(self):
+
+        self.statement = pg.StatementRegistry().register(
+            'lookup thing', """
+            select *
+            from things
+            where thing_id = %(thing_id)s
+            and owner = %(owner)s
+            """)
+
+    def test_psycopg2_prepares_once_per_connection(self):
+
+        pgconn = fakepg.Psycopg2Connection()
+        params = dict(thing_id=1, owner='matt')
+
+        self.statement.execute(pgconn.cursor(), params)
+        self.statement.execute(pgconn.cursor(), params)
+
+        self.assertEqual(pgconn.executed, [
+            ('prepare horsemeat_lookup_thing as select *\n'
+                'from things\n'
+                'where thing_id = $1\n'
+                'and owner = $2', None, {}),
+            ('execute horsemeat_lookup_thing '
+                '(%(thing_id)s, %(owner)s)', params, {}),
+            ('execute horsemeat_lookup_thing '
+                '(%(thing_id)s, %(owner)s)', params, {})])
+
+        # A new connection needs its own PREPARE.
+        other = fakepg.Psycopg2Connection()
+        self.statement.execute(other.cursor(), params)
+        self.assertEqual(len(other.executed), 2)
+
+    def test_psycopg3_uses_prepare_true(self):
+
+        pgconn = fakepg.Psycopg3Connection()
+
+        self.statement.execute(pgconn.cursor(), dict(thing_id=1, owner='x'))
+
+        self.assertEqual(pgconn.executed, [
+            (self.statement.sql, dict(thing_id=1, owner='x'),
+                dict(prepare=True))])
+
+class TestDeferredStatements(unittest.TestCase):
+
+    def test_flush_in_one_pipeline(self):
+
+        registry = pg.StatementRegistry()
+        a = registry.register('a', "update a set x = %s")
+        b = registry.register('b', "insert into b values (%s)")
+
+        deferred = pg.DeferredStatements()
+        deferred.add(a, [1])
+        deferred.add(b, [2])
+
+        pgconn = fakepg.Psycopg3Connection()
+        deferred.flush_and_commit(pgconn)
+
+        self.assertEqual(pgconn.executed, [
+            'pipeline starts',
+            (a.sql, [1], dict(prepare=True)),
+            (b.sql, [2], dict(prepare=True)),
+            'commit',
+            'pipeline syncs'])
+
+        self.assertEqual(len(deferred), 0)
+
+    def test_read_only_connections_get_switched_back(self):
+
+        registry = pg.StatementRegistry()
+        a = registry.register('a', "update a set x = %s")
+
+        deferred = pg.DeferredStatements()
+        deferred.add(a, [1])
+
+        pgconn = fakepg.Psycopg2Connection()
+        pg.set_transaction_mode(pgconn, 'read only')
+
+        # Something already read in that read only transaction.
+        pgconn.status = 2
+
+        deferred.flush_and_commit(pgconn)
+
+        self.assertEqual(pgconn.session['readonly'], 'DEFAULT')
+        self.assertEqual(pgconn.commits, 2)
+
+class TestStreamRows(unittest.TestCase):
+
+    def test_rows(self):
+
+        for connection_class in (
+            fakepg.Psycopg2Connection,
+            fakepg.Psycopg3Connection):
+
+            pgconn = connection_class(range(25))
+
+            rows = list(pg.stream_rows(pgconn, "select x", itersize=10))
+
+            self.assertEqual(rows, list(range(25)))
+
+            [cursor] = pgconn.cursors
+            self.assertTrue(cursor.name.startswith('horsemeat_stream_'))
+            self.assertEqual(cursor.fetches, 4)
+            self.assertTrue(cursor.closed)
+
+    def test_batches(self):
+
+        pgconn = fakepg.Psycopg2Connection(range(25))
+
+        batches = list(pg.stream_rows(
+            pgconn, "select x", itersize=10, batches=True))
+
+        self.assertEqual(list(map(len, batches)), [10, 10, 5])
+
+    def test_stopping_early_closes_the_cursor(self):
+
+        pgconn = fakepg.Psycopg2Connection(range(25))
+
+        stream = pg.stream_rows(pgconn, "select x", itersize=10)
+
+        self.assertEqual(next(stream), 0)
+        stream.close()
+
+        self.assertTrue(pgconn.cursors[0].closed)
+        self.assertEqual(pgconn.cursors[0].fetches, 1)
+
+def make_binary_copy(rows):
+
+    """
+    Build what COPY ... TO STDOUT (FORMAT binary) would send for rows of
+    (int4, float8, text, bool).
+    """
+
+    out = bytearray(pgcopy.copy_signature)
+    out += struct.pack('>ii', 0, 0)
+
+    for person_id, score, name, active in rows:
+
+        out += struct.pack('>h', 4)
+        out += struct.pack('>ii', 4, person_id)
+
+        if score is None:
+            out += struct.pack('>i', -1)
+
+        else:
+            out += struct.pack('>id', 8, score)
+
+        encoded = name.encode('utf8')
+        out += struct.pack('>i', len(encoded)) + encoded
+
+        out += struct.pack('>ib', 1, active)
+
+    out += struct.pack('>h', -1)
+
+    return bytes(out)
+
+copy_columns = [('person_id', 23), ('score', 701), ('name', 25), ('active', 16)]
+
+class TestFetchColumns(unittest.TestCase):
+
+    rows = [
+        (1, 2.5, 'Matt', True),
+        (2, None, 'Rob', False),
+        (300000, -1.0, 'Jürgen', True)]
+
+    def test_parser(self):
+
+        parser = pg.BinaryCopyParser(copy_columns)
+
+        data = make_binary_copy(self.rows)
+
+        for i in range(len(data)):
+            parser.write(data[i:i + 1])
+
+        columns = parser.get_columns()
+
+        self.assertEqual(list(columns), ['person_id', 'score', 'name', 'active'])
+
+        self.assertIsInstance(columns['person_id'], array.array)
+        self.assertEqual(list(columns['person_id']), [1, 2, 300000])
+
+        self.assertEqual(columns['score'][0], 2.5)
+        self.assertTrue(math.isnan(columns['score'][1]))
+        self.assertEqual(columns['score'][2], -1.0)
+
+        self.assertEqual(columns['name'], ['Matt', 'Rob', 'Jürgen'])
+        self.assertEqual(list(columns['active']), [1, 0, 1])
+
+    def test_fetch_columns(self):
+
+        pgconn = fakepg.Psycopg2Connection()
+
+        pgconn.description = [
+            types.SimpleNamespace(name=name, type_code=oid)
+            for name, oid in copy_columns]
+
+        pgconn.copy_data = make_binary_copy(self.rows)
+
+        columns = pg.fetch_columns(
+            pgconn,
+            "select * from people where person_id > %s",
+            [0])
+
+        self.assertEqual([qry for qry, _, _ in pgconn.executed], [
+            'select * from (select * from people where person_id > %s) '
+            'as fetch_columns limit 0',
+            'copy (select * from people where person_id > 0) '
+            'to stdout (format binary)'])
+
+        self.assertEqual(sum(columns['person_id']), 300003)
+
+    def test_unfinished_copy(self):
+
+        parser = pg.BinaryCopyParser(copy_columns)
+        parser.write(make_binary_copy(self.rows)[:-2])
+
+        with self.assertRaises(ValueError):
+            parser.get_columns()
+
+    def test_unsupported_types(self):
+
+        # numeric
+        with self.assertRaises(ValueError):
+            pg.BinaryCopyParser([('amount', 1700)])
+
+    def test_no_nulls_in_int_columns(self):
+
+        parser = pg.BinaryCopyParser([('person_id', 23)])
+
+        with self.assertRaises(ValueError):
+
+            parser.write(
+                pgcopy.copy_signature
+                + struct.pack('>iihi', 0, 0, 1, -1))
+
+Person = collections.namedtuple('Person', 'person_id inserted display_name')
+
+class JSONResponse(Response):
+    fancyjsondumps = horsemeat.fancyjsondumps
+
+class TestKeysetPaginator(unittest.TestCase):
+
+    def setUp(self):
+
+        self.paginator = pg.KeysetPaginator(
+            "select * from people where person_status = %(status)s",
+            ['inserted', 'person_id'],
+            'secret',
+            page_size=2)
+
+        self.people = [
+            Person(1, datetime.datetime(2024, 1, 1), 'Matt'),
+            Person(2, datetime.datetime(2024, 1, 2), 'Rob'),
+            Person(3, datetime.datetime(2024, 1, 3), 'Jack')]
+
+    def test_pages(self):
+
+        # The query asks for one more than a page.
+        pgconn = fakepg.Psycopg2Connection(self.people)
+
+        page = self.paginator.fetch(pgconn, dict(status='confirmed'))
+
+        self.assertEqual([p.person_id for p in page], [1, 2])
+        self.assertNotIn('offset', pgconn.executed[0][0])
+
+        pgconn = fakepg.Psycopg2Connection(self.people[2:])
+
+        page = self.paginator.fetch(
+            pgconn,
+            dict(status='confirmed'),
+            token=page.next_token)
+
+        qry, params, kwargs = pgconn.executed[0]
+
+        self.assertIn(
+            '(inserted, person_id) > '
+            '(%(keyset_after_0)s, %(keyset_after_1)s)',
+            qry)
+
+        self.assertEqual(params, dict(
+            status='confirmed',
+            keyset_after_0='2024-01-02 00:00:00',
+            keyset_after_1=2))
+
+        self.assertEqual([p.person_id for p in page], [3])
+        self.assertIsNone(page.next_token)
+
+    def test_tokens_only_work_where_they_came_from(self):
+
+        page = self.paginator.fetch(
+            fakepg.Psycopg2Connection(self.people),
+            dict(status='confirmed'))
+
+        other = pg.KeysetPaginator(
+            "select * from webapp_sessions",
+            ['inserted', 'person_id'],
+            'secret')
+
+        with self.assertRaises(pg.BadPageToken):
+            other.read_token(page.next_token)
+
+        with self.assertRaises(pg.BadPageToken):
+            self.paginator.read_token('garbage')
+
+    def test_json(self):
+
+        page = pg.Page([dict(person_id=1)], 'abc.def')
+
+        self.assertEqual(
+            json.loads(JSONResponse.json(page).body[0]),
+            dict(rows=[dict(person_id=1)], next_token='abc.def'))
+
+def number_the_rows(conflicts=()):
+
+    """
+    Answer each query with one row per row of values, numbered from 1,
+    except for the numbers in conflicts, like on conflict do nothing.
+    """
+
+    numbers = itertools.count(1)
+
+    def answer(qry, params):
+
+        return [
+            (n,) for n in itertools.islice(numbers, qry.count('),(') + 1)
+            if n not in conflicts]
+
+    return answer
+
+def echo_the_keys(qry, params):
+    return [(params.get('email_address') or params.get('person_id'),)]
+
+class TestExecuteInBulk(unittest.TestCase):
+
+    def make_query_makers(self):
+
+        return [
+            user.UserInserter('a@example.com', 'A', password='x'),
+            user.UserInserter('b@example.com', 'B'),
+            user.UserInserter('c@example.com', 'C', password='y'),
+            session.SessionInserter(99)]
+
+    def test_psycopg2(self):
+
+        pgconn = fakepg.Psycopg2Connection(answer=number_the_rows())
+
+        results = pg.execute_in_bulk(pgconn, self.make_query_makers())
+
+        # Three groups, so three round trips, and the rows come back
+        # where they started.
+        self.assertEqual(len(pgconn.executed), 3)
+        self.assertEqual(results, [(1,), (3,), (2,), (4,)])
+
+        qry, params, kwargs = pgconn.executed[0]
+
+        self.assertIn("'a@example.com'", qry)
+        self.assertIn("'c@example.com'", qry)
+        self.assertIn("crypt('x', gen_salt('md5'))", qry)
+        self.assertIn('returning person_id', qry)
+
+    def test_psycopg2_skipped_rows(self):
+
+        pgconn = fakepg.Psycopg2Connection(
+            answer=number_the_rows(conflicts=[2]))
+
+        with self.assertRaises(pg.BulkRowsMissing):
+            pg.execute_in_bulk(pgconn, self.make_query_makers())
+
+    def test_psycopg(self):
+
+        pgconn = fakepg.Psycopg3Connection(answer=echo_the_keys)
+
+        results = pg.execute_in_bulk(pgconn, self.make_query_makers())
+
+        self.assertEqual([
+            (qry, len(params_seq), kwargs['returning'])
+            for qry, params_seq, kwargs in pgconn.executed], [
+            (user.insert_person_with_password.sql, 2, True),
+            (user.insert_person.sql, 1, True),
+            (session.insert_session.sql, 1, True)])
+
+        self.assertEqual(results, [
+            ('a@example.com',),
+            ('b@example.com',),
+            ('c@example.com',),
+            (99,)])
+
+class TestSlotsRecords(unittest.TestCase):
+
+    people_columns = ['person_id', 'email_address', 'salted_hashed_password',
+        'person_status', 'display_name', 'is_superuser', 'inserted',
+        'updated', 'person_uuid']
+
+    def make_person(self):
+
+        factory = user.PersonFactory(
+            'people',
+            16384,
+            [(name, 25) for name in self.people_columns])
+
+        return factory.make([
+            1, 'matt@example.com', None, 'confirmed', 'Matt', False,
+            datetime.datetime(2024, 1, 1), None,
+            'f9d37fd0-6fb3-4c41-9a56-c0e6e1c1e7b5'])
+
+    def test_people(self):
+
+        person = self.make_person()
+
+        self.assertIsInstance(person, user.Person)
+        self.assertFalse(hasattr(person, '__dict__'))
+
+        # The table has a column the class didn't know about.
+        self.assertEqual(person.person_uuid,
+            'f9d37fd0-6fb3-4c41-9a56-c0e6e1c1e7b5')
+
+        self.assertEqual(person, user.Person(1, None, None, None, None,
+            None, None, None))
+
+        self.assertIs(type(person), type(self.make_person()))
+
+    def test_json(self):
+
+        person = self.make_person()
+
+        self.assertEqual(
+            json.loads(horsemeat.fancyjsondumps(person))['inserted'],
+            '2024-01-01T00:00:00')
+
+        sesh = session.Session(1, None, 2, None, None, None, None)
+
+        self.assertEqual(sesh.__jsondata__['person_id'], 2)
+
+    def test_password_hashes_stay_home(self):
+
+        person = self.make_person()
+        person.salted_hashed_password = '$1$abcdefgh$secret'
+
+        self.assertNotIn('salted_hashed_password', person.__jsondata__)
+
+        for encoded in [
+            horsemeat.fancyjsondumps(person),
+            horsemeat.fancyjsondumps(dict(user=person)),
+            pg.dump_json(dict(user=person)).decode('utf8'),
+            JSONResponse.json(dict(user=person)).body[0]]:
+
+            if isinstance(encoded, bytes):
+                encoded = encoded.decode('utf8')
+
+            self.assertNotIn('secret', encoded)
+            self.assertIn('matt@example.com', encoded)
+
+    def test_pickle(self):
+
+        person = pickle.loads(pickle.dumps(self.make_person()))
+
+        self.assertEqual(person.person_uuid,
+            'f9d37fd0-6fb3-4c41-9a56-c0e6e1c1e7b5')
+
+        self.assertIsInstance(person, user.Person)
+
+class TestRowMakers(unittest.TestCase):
+
+    def test_caching(self):
+
+        make_row = pg.get_row_maker(('person_id', 'display_name'))
+
+        self.assertIs(pg.get_row_maker(('person_id', 'display_name')),
+            make_row)
+
+        self.assertIsNot(pg.get_row_maker(('display_name', 'person_id')),
+            make_row)
+
+    def test_rows_are_namedtuples(self):
+
+        row = pg.get_row_maker(('person_id', 'display_name'))([1, 'Matt'])
+
+        self.assertEqual(row, (1, 'Matt'))
+        self.assertEqual(row.display_name, 'Matt')
+        self.assertEqual(row._asdict(), dict(person_id=1, display_name='Matt'))
+
+    def test_weird_column_names(self):
+
+        row = pg.get_row_maker(('?column?', 'exists', 'exists', 'class'))(
+            [1, True, False, 'x'])
+
+        self.assertEqual(row.f_column_, 1)
+        self.assertEqual(row.exists, True)
+
+        # Duplicates and keywords get renamed by position.
+        self.assertEqual(row._2, False)
+        self.assertEqual(row._3, 'x')
+
+    def test_compact_row(self):
+
+        cursor = types.SimpleNamespace(description=[
+            types.SimpleNamespace(name='person_id'),
+            types.SimpleNamespace(name='display_name')])
+
+        self.assertIs(pg.compact_row(cursor),
+            pg.get_row_maker(('person_id', 'display_name')))
+
+        cursor.description = None
+
+        self.assertIs(pg.compact_row(cursor), psycopg.rows.no_result)
+
+    def test_tuple_cursor(self):
+
+        self.assertEqual(
+            pg.tuple_cursor(fakepg.Psycopg3Connection()).kwargs,
+            dict(row_factory=psycopg.rows.tuple_row))
+
+        pgconn = fakepg.Psycopg2Connection()
+
+        pgconn.cursor_factory = pg.InstrumentedNamedTupleCursor
+
+        self.assertEqual(
+            pg.tuple_cursor(pgconn).kwargs,
+            dict(cursor_factory=pg.InstrumentedTupleCursor))
+
+        pgconn.cursor_factory = pg.CompactRowCursor
+
+        self.assertEqual(
+            pg.tuple_cursor(pgconn).kwargs,
+            dict(cursor_factory=psycopg2.extensions.cursor))
+
+class TestJSONAdapters(unittest.TestCase):
+
+    session_data = {
+        'binder_id': str(uuid.UUID(int=1)),
+        'when': datetime.datetime(2024, 1, 1),
+        'amount': decimal.Decimal('1.5'),
+        'big': 2 ** 70}
+
+    def check_round_trip(self):
+
+        self.assertEqual(
+            pg.json_loads(pg.dump_json(self.session_data)),
+            {
+                'binder_id': '00000000-0000-0000-0000-000000000001',
+                'when': '2024-01-01T00:00:00',
+                'amount': 1.5,
+                'big': 2 ** 70})
+
+        self.assertEqual(pg.json_loads('[1, 2]'), [1, 2])
+
+        with self.assertRaises(json.JSONDecodeError):
+            pg.json_loads(b'{')
+
+    def test_round_trip(self):
+        self.check_round_trip()
+
+    def test_without_orjson(self):
+
+        orjson, pgjson.orjson = pgjson.orjson, None
+
+        try:
+            self.check_round_trip()
+
+        finally:
+            pgjson.orjson = orjson
+
+    def test_psycopg(self):
+
+        context = types.SimpleNamespace(
+            adapters=psycopg.adapt.AdaptersMap(psycopg.adapters),
+            connection=None,
+            prepare_threshold=5)
+
+        pg.register_json_adapters(context)
+
+        tx = psycopg.adapt.Transformer(context)
+
+        data = pg.Jsonb({'when': datetime.date(2024, 1, 1)})
+        dumper = tx.get_dumper(data, psycopg.adapt.PyFormat.TEXT)
+
+        self.assertEqual(bytes(dumper.dump(data)), b'{"when":"2024-01-01"}')
+
+        loader = tx.get_loader(
+            psycopg.adapters.types['jsonb'].oid,
+            psycopg.pq.Format.TEXT)
+
+        self.assertEqual(loader.load(b'{"a": 1}'), {'a': 1})
+
+    def test_psycopg2(self):
+
+        self.assertEqual(
+            psycopg2.extensions.adapt(
+                pg.Jsonb({'binder_id': "o'brien"})).getquoted(),
+            b"""'{"binder_id":"o''brien"}'""")
+
+class TestPersonLoader(unittest.TestCase):
+
+    def setUp(self):
+
+        self.people = [
+            user.PersonFactory(
+                'people',
+                16384,
+                [(name, 25) for name in TestSlotsRecords.people_columns]
+            ).make([
+                person_id, None, None, 'confirmed', 'Person {0}'.format(
+                    person_id), False, None, None, uuid.UUID(int=person_id)])
+            for person_id in range(1, 6)]
+
+        # Neither psycopg2 nor psycopg, so statements run as they are.
+        self.pgconn = fakepg.Connection(answer=self.find_people)
+        self.loader = user.PersonLoader(lambda: self.pgconn)
+
+    def find_people(self, qry, params):
+
+        return [
+            types.SimpleNamespace(p=person)
+            for person in self.people
+            if person.person_id in params.get('person_ids', [])
+            or person.person_uuid in params.get('person_uuids', [])]
+
+    @property
+    def queries(self):
+        return [params for qry, params, kwargs in self.pgconn.executed]
+
+    def test_one_query(self):
+
+        self.loader.want(1, 2, 2, 3, None).want_uuids(str(uuid.UUID(int=4)))
+
+        self.assertEqual(self.queries, [])
+
+        self.assertEqual(self.loader.get(2).display_name, 'Person 2')
+        self.assertIs(self.loader.get_by_uuid(uuid.UUID(int=4)),
+            self.people[3])
+        self.assertIs(self.loader.get(4), self.people[3])
+        self.assertIs(self.loader.get(1), self.people[0])
+
+        self.assertEqual(self.queries, [
+            {'person_ids': [1, 2, 3]},
+            {'person_uuids': [uuid.UUID(int=4)]}])
+
+    def test_only_ids(self):
+
+        self.loader.get(1)
+
+        self.assertEqual(self.queries, [{'person_ids': [1]}])
+
+    def test_ids_from_urls(self):
+
+        self.assertIs(self.loader.get('5'), self.people[4])
+        self.assertIs(self.loader.get(5), self.people[4])
+
+        self.assertEqual(
+            self.loader.get_many([5, '3', None]),
+            [self.people[4], self.people[2], None])
+
+        self.assertEqual(self.queries, [
+            {'person_ids': [5]},
+            {'person_ids': [3]}])
+
+    def test_get_many(self):
+
+        self.assertEqual(
+            self.loader.get_many([3, 99, 1, 3]),
+            [self.people[2], None, self.people[0], self.people[2]])
+
+        # Misses get remembered too.
+        self.assertIsNone(self.loader.get(99))
+        self.assertIsNone(self.loader.get(None))
+
+        self.assertEqual(len(self.queries), 1)
+
+        self.loader.get(5)
+
+        self.assertEqual(self.queries[-1]['person_ids'], [5])
+
+    def test_remember(self):
+
+        self.loader.remember(self.people[4])
+
+        self.assertIs(self.loader.get(5), self.people[4])
+        self.assertIs(self.loader.get_by_uuid(str(uuid.UUID(int=5))),
+            self.people[4])
+
+        self.assertEqual(self.queries, [])
+
+class TestDeadlines(unittest.TestCase):
+
+    def setUp(self):
+
+        self.pgconn = fakepg.Psycopg2Connection()
+        self.cursor = self.pgconn.cursor()
+
+    def run_with_deadline(self, deadline):
+
+        context = contextvars.copy_context()
+
+        def f():
+            pg.current_deadline.set(deadline)
+            pg.apply_deadline(self.cursor, fakepg.Cursor)
+
+        context.run(f)
+
+    def test_statement_timeout_at_transaction_start(self):
+
+        self.run_with_deadline(pg.RequestDeadline(10))
+
+        [(qry, params, kwargs)] = self.pgconn.executed
+
+        self.assertTrue(qry.startswith('set local statement_timeout = '))
+        self.assertTrue(9000 < int(qry.split()[-1]) <= 10000)
+
+    def test_setting_rides_along(self):
+
+        context = contextvars.copy_context()
+
+        def f():
+            pg.current_deadline.set(pg.RequestDeadline(10))
+            return pg.get_deadline_setting(self.cursor)
+
+        setting = context.run(f)
+
+        self.assertEqual(
+            pg.prepend_setting(setting, b'select 1'),
+            setting.encode('ascii') + b'; select 1')
+
+        self.assertIsNone(
+            pg.prepend_setting(setting, psycopg2.sql.SQL('select 1')))
+
+        # Working out the setting doesn't send anything.
+        self.assertEqual(self.pgconn.executed, [])
+
+    def test_smaller_timeout_later_in_the_transaction(self):
+
+        deadline = pg.RequestDeadline(10)
+
+        self.run_with_deadline(deadline)
+
+        # The first query took two seconds, and the transaction is
+        # still open.
+        deadline.started -= 2
+
+        self.run_with_deadline(deadline)
+
+        first, second = [
+            int(qry.split()[-1])
+            for qry, params, kwargs in self.pgconn.executed]
+
+        self.assertGreaterEqual(first - second, 2000)
+
+    def test_not_again_with_as_much_time_left(self):
+
+        deadline = pg.RequestDeadline(10)
+
+        # Time stands still.
+        deadline.statement_timeout = lambda: '5000'
+
+        self.run_with_deadline(deadline)
+        self.run_with_deadline(deadline)
+
+        self.assertEqual(len(self.pgconn.executed), 1)
+
+    def test_transaction_started_before_the_deadline(self):
+
+        self.pgconn.status = 2
+
+        self.run_with_deadline(pg.RequestDeadline(10))
+
+        [(qry, params, kwargs)] = self.pgconn.executed
+
+        self.assertTrue(qry.startswith('set local statement_timeout = '))
+
+    def test_out_of_time(self):
+
+        with self.assertRaises(pg.DeadlineExceeded):
+            self.run_with_deadline(
+                pg.RequestDeadline(1, started=time.monotonic() - 2))
+
+        self.assertEqual(self.pgconn.executed, [])
+
+    def test_no_deadline(self):
+
+        self.run_with_deadline(None)
+
+        self.assertEqual(self.pgconn.executed, [])
+
+def explain(qry, params):
+
+    if qry.startswith('explain'):
+        return [[[{'Plan': {'Node Type': 'Seq Scan'}}]]]
+
+    else:
+        return []
+
+class TestQueryStats(unittest.TestCase):
+
+    def test_n_plus_one(self):
+
+        stats = pg.QueryStats(n_plus_one_threshold=2)
+
+        for person_id in range(3):
+            stats.record(
+                "select * from people where person_id = {0}".format(
+                    person_id),
+                0.001)
+
+        stats.record("select 1", 0.5)
+
+        self.assertEqual(stats.count, 4)
+        self.assertEqual(stats.slowest[0], (0.5, 'select ?'))
+
+        self.assertEqual(stats.repeated_statements, [
+            (3, 'select * from people where person_id = ?')])
+
+        with self.assertLogs('horsemeat.pgstats', 'WARNING') as logs:
+            stats.log_problems('GET /people')
+
+        self.assertIn('Possible N+1 in GET /people', logs.output[0])
+
+    def test_explain_inside_a_savepoint(self):
+
+        pgconn = fakepg.Psycopg2Connection(answer=explain)
+        pgconn.status = 2
+
+        with self.assertLogs('horsemeat.slowqueries', 'WARNING') as logs:
+
+            pg.explain_slow_query(
+                pgconn,
+                fakepg.Cursor,
+                "select * from people where person_id = %s",
+                [99],
+                2.0)
+
+        self.assertEqual([qry for qry, _, _ in pgconn.executed], [
+            "savepoint horsemeat_explain",
+            "explain (format json) select * from people "
+                "where person_id = %s",
+            "release savepoint horsemeat_explain"])
+
+        self.assertIn('Seq Scan', logs.output[0])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,267 @@
+# vim: set expandtab ts=4 sw=4 filetype=python fileencoding=utf8:
+
+"""
+The parts of horsemeat.pg that depend on what postgresql actually sends
+back, run against a real database.  Set HORSEMEAT_TEST_DSN to a
+connection string, like this::
+
+    $ HORSEMEAT_TEST_DSN="dbname=horsemeat_test" python -m pytest horsemeat
+
+Everything happens in temporary tables inside one transaction that gets
+rolled back, so any database you can connect to will do.
+"""
+
+import asyncio
+import datetime
+import hashlib
+import math
+import os
+import random
+import types
+import unittest
+import uuid
+
+import psycopg
+import psycopg2
+
+from horsemeat import pg
+
+dsn = os.environ.get('HORSEMEAT_TEST_DSN')
+
+insert_thing = """
+    insert into things
+    (name)
+    values
+    (%(name)s)
+    returning thing_id, name
+    """
+
+insert_thing_unless_there = """
+    insert into things
+    (name)
+    values
+    (%(name)s)
+    on conflict (name) do nothing
+    returning thing_id, name
+    """
+
+def make_inserter(qry, name):
+
+    return types.SimpleNamespace(
+        insert_query=qry,
+        bound_variables=dict(name=name))
+
+@unittest.skipUnless(dsn, "Set HORSEMEAT_TEST_DSN to run these")
+class TestWithPsycopg2(unittest.TestCase):
+
+    def connect(self):
+        return psycopg2.connect(dsn, cursor_factory=pg.CompactRowCursor)
+
+    def setUp(self):
+
+        self.pgconn = self.connect()
+
+        cursor = self.pgconn.cursor()
+
+        cursor.execute("""
+            create temporary table things
+            (
+                thing_id serial primary key,
+                name text not null unique,
+                inserted timestamptz not null default now()
+            )
+            on commit drop
+            """)
+
+    def tearDown(self):
+
+        self.pgconn.rollback()
+        self.pgconn.close()
+
+    def insert_names(self, names):
+
+        pg.execute_in_bulk(
+            self.pgconn,
+            [make_inserter(insert_thing, name) for name in names])
+
+    def test_bulk_insert_keeps_returning_order(self):
+
+        names = ['thing {0}'.format(i) for i in range(250)]
+        random.shuffle(names)
+
+        # A small page size, so it takes a few round trips.
+        results = pg.execute_in_bulk(
+            self.pgconn,
+            [make_inserter(insert_thing, name) for name in names],
+            page_size=100)
+
+        self.assertEqual([row.name for row in results], names)
+
+        self.assertEqual(
+            len(set(row.thing_id for row in results)),
+            len(names))
+
+    def test_bulk_insert_with_conflicts(self):
+
+        self.insert_names(['b'])
+
+        with self.assertRaises(pg.BulkRowsMissing):
+
+            pg.execute_in_bulk(
+                self.pgconn,
+                [make_inserter(insert_thing_unless_there, name)
+                    for name in ['a', 'b', 'c']])
+
+    def test_keyset_pages(self):
+
+        cursor = self.pgconn.cursor()
+
+        cursor.execute("""
+            insert into things
+            (name)
+            select 'thing ' || i
+            from generate_series(0, 22) as i
+            """)
+
+        # Lots of ties on inserted, so the primary key has to break
+        # them.
+        cursor.execute("""
+            update things
+            set inserted = %s + (thing_id / 5) * interval '1 minute'
+            """,
+            [datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)])
+
+        paginator = pg.KeysetPaginator(
+            "select thing_id, name, inserted from things where name like %s",
+            ['inserted', 'thing_id'],
+            'secret',
+            page_size=5)
+
+        seen = []
+        token = None
+
+        while True:
+
+            page = paginator.fetch(self.pgconn, ['thing %'], token=token)
+
+            seen.extend(row.thing_id for row in page)
+
+            token = page.next_token
+
+            if token is None:
+                break
+
+        cursor.execute("""
+            select thing_id
+            from things
+            order by inserted, thing_id
+            """)
+
+        self.assertEqual(seen, [row.thing_id for row in cursor.fetchall()])
+
+    def test_copy_parsing(self):
+
+        columns = pg.fetch_columns(self.pgconn, """
+            select
+            i as int4_column,
+            i::int8 * 10000000000 as int8_column,
+            case when i = 2 then null else i / 4.0 end::float8
+                as float8_column,
+            case when i = 3 then null else 'row ' || i end as text_column,
+            mod(i, 2) = 0 as bool_column,
+            md5(i::text)::uuid as uuid_column
+            from generate_series(1, %s) as i
+            """, [4])
+
+        self.assertEqual(list(columns['int4_column']), [1, 2, 3, 4])
+
+        self.assertEqual(
+            list(columns['int8_column']),
+            [i * 10000000000 for i in range(1, 5)])
+
+        self.assertEqual(columns['float8_column'][0], 0.25)
+        self.assertTrue(math.isnan(columns['float8_column'][1]))
+
+        self.assertEqual(
+            columns['text_column'],
+            ['row 1', 'row 2', None, 'row 4'])
+
+        self.assertEqual(list(columns['bool_column']), [0, 1, 0, 1])
+
+        self.assertEqual(
+            uuid.UUID(str(columns['uuid_column'][0])),
+            uuid.UUID(hashlib.md5(b'1').hexdigest()))
+
+    def test_named_cursors(self):
+
+        qry = "select i from generate_series(1, %s) as i"
+
+        rows = list(pg.stream_rows(self.pgconn, qry, [2500], itersize=1000))
+
+        self.assertEqual([row.i for row in rows], list(range(1, 2501)))
+
+        batches = list(pg.stream_rows(
+            self.pgconn, qry, [2500], itersize=1000, batches=True))
+
+        self.assertEqual(list(map(len, batches)), [1000, 1000, 500])
+
+        # The stream closed its cursor, so the transaction is still
+        # good for more queries.
+        cursor = self.pgconn.cursor()
+        cursor.execute("select 1 as one")
+        self.assertEqual(cursor.fetchone().one, 1)
+
+class TestWithPsycopg(TestWithPsycopg2):
+
+    def connect(self):
+        return psycopg.connect(dsn, row_factory=pg.compact_row)
+
+    def test_bulk_insert_with_conflicts(self):
+
+        self.insert_names(['b'])
+
+        results = pg.execute_in_bulk(
+            self.pgconn,
+            [make_inserter(insert_thing_unless_there, name)
+                for name in ['a', 'b', 'c']])
+
+        # psycopg keeps each row's answer separate, so the skipped row
+        # comes back as None.
+        self.assertEqual(
+            [row and row.name for row in results],
+            ['a', None, 'c'])
+
+@unittest.skipUnless(dsn, "Set HORSEMEAT_TEST_DSN to run these")
+class TestAsyncDeadline(unittest.TestCase):
+
+    def test_statement_timeout(self):
+
+        async def go():
+
+            apgconn = await psycopg.AsyncConnection.connect(
+                dsn,
+                cursor_factory=pg.InstrumentedAsyncCursor)
+
+            try:
+
+                token = pg.current_deadline.set(pg.RequestDeadline(5))
+
+                try:
+                    cursor = apgconn.cursor()
+                    await cursor.execute("show statement_timeout")
+                    return (await cursor.fetchone())[0]
+
+                finally:
+                    pg.current_deadline.reset(token)
+
+            finally:
+                await apgconn.rollback()
+                await apgconn.close()
+
+        statement_timeout = asyncio.run(go())
+
+        # Without the deadline, this would be 0.
+        self.assertNotEqual(statement_timeout, '0')
+
+if __name__ == "__main__":
+    unittest.main()
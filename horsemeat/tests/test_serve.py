@@ -0,0 +1,53 @@
+# vim: set expandtab ts=4 sw=4 filetype=python fileencoding=utf8:
+
+import os
+import unittest
+
+from horsemeat.webapp import gunicornhooks, serve
+from horsemeat.tests.test_configwrapper import SubclassConfigWrapper
+
+class TestGunicornOptions(unittest.TestCase):
+
+    def test_defaults(self):
+
+        cw = SubclassConfigWrapper({'app': {'webapp_port': 8000}})
+
+        options = serve.make_gunicorn_options(cw)
+
+        self.assertEqual(options['bind'], '127.0.0.1:8000')
+        self.assertEqual(options['workers'], 1)
+        self.assertEqual(options['threads'], 1)
+        self.assertTrue(options['reuse_port'])
+        self.assertFalse(options['preload_app'])
+        self.assertIs(options['post_fork'], gunicornhooks.post_fork)
+        self.assertNotIn('pidfile', options)
+
+    def test_auto_sizing(self):
+
+        cw = SubclassConfigWrapper({'app': {
+            'webapp_port': 8000,
+            'num_webapp_workers': 'auto',
+            'num_webapp_threads': 'auto',
+            'preload_app': True,
+            'pidfile': '/tmp/horsemeat.pid'}})
+
+        options = serve.make_gunicorn_options(cw)
+
+        cpus = os.cpu_count() or 1
+
+        self.assertEqual(options['workers'], cpus * 2 + 1)
+        self.assertEqual(options['threads'], cpus)
+        self.assertTrue(options['preload_app'])
+        self.assertEqual(options['pidfile'], '/tmp/horsemeat.pid')
+
+    def test_gunicorn_takes_the_options(self):
+
+        cw = SubclassConfigWrapper({'app': {'webapp_port': 8000}})
+
+        app = serve.HorsemeatApplication(cw, serve.make_gunicorn_options(cw))
+
+        self.assertEqual(app.cfg.bind, ['127.0.0.1:8000'])
+        self.assertTrue(app.cfg.reuse_port)
+
+if __name__ == "__main__":
+    unittest.main()
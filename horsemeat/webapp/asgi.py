@@ -0,0 +1,591 @@
+# vim: set expandtab ts=4 sw=4 filetype=python fileencoding=utf8:
+
+"""
+An ASGI front door for a regular Dispatcher, so one worker can hold
+thousands of slow connections open at once.
+
+Wrap your dispatcher like this::
+
+    >>> from horsemeat.webapp.asgi import ASGIDispatcher
+    >>> app = ASGIDispatcher(cw.build_webapp()) # doctest: +SKIP
+
+and run app with any ASGI server, like uvicorn.
+
+Handlers with a regular handle method don't have to change.  They run
+in a thread pool, and each thread has its own database connection, just
+like under gthread workers.
+
+Handlers can also have an async def handle method instead.  Those run
+on the event loop.  Await req.apgconn to get a psycopg AsyncConnection,
+which gets committed after handle returns.  Use Response.tmpl_async to
+render templates from them::
+
+    class SlowReport(Handler):
+
+        route_strings = set(['GET /slow-report'])
+        route = Handler.check_route_strings
+
+        async def handle(self, req):
+
+            apgconn = await req.apgconn
+
+            cursor = apgconn.cursor()
+            await cursor.execute("select pg_sleep(5)")
+
+            return await self.Response.tmpl_async('slow-report.html')
+
+Only asgi_max_async_connections (10 unless you set it under app) async
+connections go out at once, and the rest of the async handlers wait
+for one.  Their queries get the same statement_timeout from the
+request's latency budget as everybody else's.
+
+Don't touch req.pgconn from an async handle method.  That's a blocking
+connection, and it's for the sync parts of the request.
+
+The sync parts of one request can run on different threads, so every
+request gets a lease on a pooled connection, even without a pool
+section in the yaml file.  See ASGIDispatcher.start_lease.
+"""
+
+import asyncio
+import concurrent.futures
+import contextvars
+import inspect
+import io
+import logging
+import os
+import sys
+import time
+
+import psycopg
+
+from horsemeat import pg
+from horsemeat.webapp.request import current_request
+
+log = logging.getLogger(__name__)
+
+def environ_from_scope(scope, body):
+
+    """
+    Build a WSGI environ dictionary out of an ASGI http scope, so the
+    Request class doesn't have to know the difference.
+
+    >>> environ = environ_from_scope(
+    ...     dict(
+    ...         type='http',
+    ...         http_version='1.1',
+    ...         method='POST',
+    ...         scheme='https',
+    ...         path='/login',
+    ...         query_string=b'next=%2F',
+    ...         root_path='',
+    ...         headers=[
+    ...             (b'host', b'example.com'),
+    ...             (b'content-type', b'application/x-www-form-urlencoded'),
+    ...             (b'cookie', b'a=1'),
+    ...             (b'cookie', b'b=2')],
+    ...         client=('10.0.0.1', 5000),
+    ...         server=('127.0.0.1', 8000)),
+    ...     b'email=a@example.com')
+
+    >>> environ['REQUEST_METHOD'], environ['PATH_INFO'], environ['QUERY_STRING']
+    ('POST', '/login', 'next=%2F')
+
+    >>> environ['CONTENT_TYPE'], environ['CONTENT_LENGTH']
+    ('application/x-www-form-urlencoded', '19')
+
+    >>> environ['HTTP_COOKIE']
+    'a=1; b=2'
+
+    >>> environ['wsgi.input'].read()
+    b'email=a@example.com'
+    """
+
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+
+        # ASGI hands us the decoded path, but WSGI wants it as latin-1.
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/{0}'.format(scope.get('http_version', '1.1')),
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in scope.get('headers', []):
+
+        name = name.decode('latin1').upper().replace('-', '_')
+        value = value.decode('latin1')
+
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+
+        # We already know how long the body is.
+        elif name == 'CONTENT_LENGTH':
+            continue
+
+        else:
+
+            k = 'HTTP_' + name
+
+            if k in environ:
+                separator = '; ' if k == 'HTTP_COOKIE' else ','
+                environ[k] = environ[k] + separator + value
+
+            else:
+                environ[k] = value
+
+    return environ
+
+async def read_body(receive):
+
+    chunks = []
+
+    while True:
+
+        message = await receive()
+
+        if message['type'] == 'http.disconnect':
+            break
+
+        chunks.append(message.get('body', b''))
+
+        if not message.get('more_body'):
+            break
+
+    return b''.join(chunks)
+
+class AsyncConnections(object):
+
+    """
+    Keeps idle psycopg AsyncConnections around so async handlers don't
+    have to connect every time, and never lets out more than max_size at
+    once, so a burst of slow requests can't run postgresql out of
+    connections.  Past that, get waits up to timeout seconds for one to
+    come back, and then raises pg.PoolTimeout.
+    """
+
+    def __init__(self, config_wrapper, max_size=10, timeout=30.0):
+
+        self.config_wrapper = config_wrapper
+        self.max_size = max_size
+        self.timeout = timeout
+        self.idle = []
+        self.slots = asyncio.Semaphore(max_size)
+
+    def __repr__(self):
+        return '<{0}.{1} max_size={2}>'.format(
+            self.__class__.__module__,
+            self.__class__.__name__,
+            self.max_size)
+
+    async def get(self):
+
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.timeout)
+
+        except asyncio.TimeoutError:
+            raise pg.PoolTimeout("No async connection free after "
+                "{0} seconds in {1}".format(self.timeout, self))
+
+        try:
+
+            while self.idle:
+
+                apgconn = self.idle.pop()
+
+                if not apgconn.closed:
+                    return apgconn
+
+            return await self.config_wrapper.make_async_database_connection()
+
+        except BaseException:
+            self.slots.release()
+            raise
+
+    async def put(self, apgconn):
+
+        try:
+
+            if apgconn.closed:
+                return
+
+            elif apgconn.info.transaction_status \
+            != psycopg.pq.TransactionStatus.IDLE:
+
+                await apgconn.close()
+
+            else:
+                self.idle.append(apgconn)
+
+        finally:
+            self.slots.release()
+
+    async def close(self):
+
+        while self.idle:
+            await self.idle.pop().close()
+
+class AsyncConnectionLease(object):
+
+    """
+    This is req.apgconn.  It doesn't check out a connection until the
+    handler awaits it::
+
+        apgconn = await req.apgconn
+
+    so async handlers that never touch the database never wait on the
+    bound in AsyncConnections.
+    """
+
+    def __init__(self, connections):
+        self.connections = connections
+        self.apgconn = None
+
+    def __await__(self):
+        return self.get().__await__()
+
+    async def get(self):
+
+        if self.apgconn is None:
+            self.apgconn = await self.connections.get()
+
+        return self.apgconn
+
+    async def commit(self):
+
+        if self.apgconn is not None:
+            await self.apgconn.commit()
+
+    async def rollback(self):
+
+        if self.apgconn is not None:
+            await self.apgconn.rollback()
+
+    async def release(self):
+
+        if self.apgconn is not None:
+            apgconn, self.apgconn = self.apgconn, None
+            await self.connections.put(apgconn)
+
+class ASGIDispatcher(object):
+
+    def __init__(self, dispatcher, max_threads=None):
+
+        self.dispatcher = dispatcher
+
+        # This is what concurrent.futures would pick, but the pool
+        # below needs to know it too.
+        max_threads = max_threads or dispatcher.cw.asgi_max_threads \
+        or min(32, (os.cpu_count() or 1) + 4)
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_threads,
+            thread_name_prefix='horsemeat')
+
+        self.async_connections = AsyncConnections(
+            dispatcher.cw,
+            max_size=dispatcher.cw.asgi_max_async_connections,
+            timeout=dispatcher.cw.asgi_async_connection_timeout)
+
+        # Only used when the config wrapper doesn't have a pool.  Each
+        # thread holds at most one of these at a time, so this never
+        # makes more connections than the per-thread ones would have.
+        # Streaming responses hold theirs until the last chunk goes
+        # out, though, so apps that stream a lot should set up a pool
+        # section in the yaml file.
+        self.connection_pool = pg.ConnectionPool(
+            dispatcher.cw.make_database_connection,
+            min_size=0,
+            max_size=max_threads)
+
+    async def __call__(self, scope, receive, send):
+
+        if scope['type'] == 'http':
+            await self.handle_http(scope, receive, send)
+
+        elif scope['type'] == 'lifespan':
+            await self.handle_lifespan(receive, send)
+
+        else:
+            raise ValueError("Sorry, I don't do {0}".format(scope['type']))
+
+    async def handle_lifespan(self, receive, send):
+
+        while True:
+
+            message = await receive()
+
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+
+            elif message['type'] == 'lifespan.shutdown':
+
+                await self.async_connections.close()
+                self.executor.shutdown(wait=True)
+                self.connection_pool.close()
+
+                await send({'type': 'lifespan.shutdown.complete'})
+
+                return
+
+    async def run_in_thread(self, f, *args):
+
+        # Copy the context so current_request set in the thread stays
+        # in this request's context.
+        context = contextvars.copy_context()
+
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor,
+            context.run,
+            f,
+            *args)
+
+    async def handle_http(self, scope, receive, send):
+
+        started = time.monotonic()
+
+        environ = environ_from_scope(scope, await read_body(receive))
+
+        reply = dict()
+
+        def start_response(status, headers, exc_info=None):
+            reply['status'] = status
+            reply['headers'] = headers
+
+        probe = self.dispatcher.probes.get(environ['PATH_INFO'])
+
+        if probe:
+            body = await self.run_in_thread(probe, environ, start_response)
+            await self.send_reply(reply, body, send)
+            return
+
+        # The threads below all run in copies of this context, so they
+        # all see this lease.  Each trip to a thread gives the
+        # connection back before it returns.
+        self.start_lease()
+        self.dispatcher.start_query_stats()
+
+        # All the sync work happens in one trip to the thread pool:
+        # build the request, route it, and if the handler isn't async,
+        # run it and finish up.
+        handle_function, req, body = await self.run_in_thread(
+            self.run_and_release,
+            self.route_and_maybe_handle,
+            environ,
+            start_response,
+            started)
+
+        if handle_function:
+
+            body = await self.handle_async(
+                handle_function,
+                req,
+                environ,
+                start_response,
+                started)
+
+        await self.send_reply(reply, body, send)
+
+    def start_lease(self):
+
+        """
+        The sync parts of a request, like building it, finishing it, or
+        handling an exception, each run on whatever thread in the pool
+        is free.  The per-thread connections would mix up requests, so
+        every request leases a connection instead, from the config
+        wrapper's pool if it has one, and from our own otherwise.
+        """
+
+        pool = self.dispatcher.cw.get_connection_pool() \
+        or self.connection_pool
+
+        lease = pg.ConnectionLease(pool)
+        pg.current_lease.set(lease)
+
+        return lease
+
+    def run_and_release(self, f, *args):
+
+        """
+        Run f, and then give back the connection, if f checked one out,
+        before this thread goes off to work on some other request.
+        """
+
+        try:
+            return f(*args)
+
+        finally:
+            pg.current_lease.get().release()
+
+    def end_transactions(self):
+
+        """
+        Before an async handler runs, commit whatever the routing and
+        session lookups started, so the request doesn't hold a
+        connection while it waits around.
+        """
+
+        for pgconn in self.dispatcher.cw.get_pgconns_if_connected():
+
+            if pg.transaction_is_open(pgconn):
+                pgconn.commit()
+
+    def route_and_maybe_handle(self, environ, start_response, started):
+
+        d = self.dispatcher
+
+        req = None
+
+        try:
+
+            req = d.make_request(environ)
+
+            handle_function = d.dispatch(req)
+
+            d.set_transaction_mode(handle_function)
+            d.choose_database(req, handle_function)
+            d.start_deadline(handle_function, started)
+
+            if inspect.iscoroutinefunction(handle_function):
+                self.end_transactions()
+                return handle_function, req, None
+
+            resp = d.finish_response(req, handle_function(req))
+
+            start_response(resp.status, resp.headers)
+
+            d.log_response(resp)
+
+            return None, req, resp.body
+
+        except Exception as ex:
+
+            return None, None, d.handle_exception(
+                req, environ, ex, start_response)
+
+    async def handle_async(self, handle_function, req, environ,
+        start_response, started):
+
+        d = self.dispatcher
+
+        # The thread that made req set these in its own copy of the
+        # context, so set them again in here, for the templates and for
+        # the async connection's statement_timeout.
+        current_request.set(req)
+        d.start_deadline(handle_function, started)
+
+        req.apgconn = AsyncConnectionLease(self.async_connections)
+
+        try:
+
+            resp = await handle_function(req)
+
+            await req.apgconn.commit()
+
+            # This commits the regular connection too, in case the
+            # session expires time got bumped.
+            resp = await self.run_in_thread(
+                self.run_and_release,
+                d.finish_response,
+                req,
+                resp)
+
+            start_response(resp.status, resp.headers)
+
+            d.log_response(resp)
+
+            return resp.body
+
+        except Exception as ex:
+
+            await req.apgconn.rollback()
+
+            return await self.run_in_thread(
+                self.run_and_release,
+                self.handle_exception_in_thread,
+                req,
+                environ,
+                ex,
+                sys.exc_info(),
+                start_response)
+
+        finally:
+            await req.apgconn.release()
+
+    def handle_exception_in_thread(self, req, environ, ex, exc_info,
+        start_response):
+
+        # handle_exception wants to be inside the except block, and
+        # this thread isn't.
+        try:
+            raise ex.with_traceback(exc_info[2])
+
+        except Exception as ex:
+            return self.dispatcher.handle_exception(
+                req, environ, ex, start_response)
+
+    async def send_reply(self, reply, body, send):
+
+        await send({
+            'type': 'http.response.start',
+            'status': int(reply['status'].split(' ', 1)[0]),
+            'headers': [
+                (k.lower().encode('latin1'), v.encode('latin1'))
+                for k, v in reply['headers']]})
+
+        try:
+
+            if isinstance(body, (list, tuple)):
+
+                for chunk in body:
+                    await self.send_chunk(chunk, send)
+
+            # Generators, file wrappers, and streaming bodies might
+            # block, so read them in the thread pool, one chunk at a
+            # time, so a big export never sits in memory all at once.
+            else:
+
+                chunks = iter(body)
+
+                while True:
+
+                    chunk = await self.run_in_thread(next, chunks, None)
+
+                    if chunk is None:
+                        break
+
+                    await self.send_chunk(chunk, send)
+
+            await send({'type': 'http.response.body', 'body': b''})
+
+        finally:
+
+            # Closing a streaming body commits, so that can block too.
+            if hasattr(body, 'close'):
+                await self.run_in_thread(body.close)
+
+    async def send_chunk(self, chunk, send):
+
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf8')
+
+        await send({
+            'type': 'http.response.body',
+            'body': chunk,
+            'more_body': True})
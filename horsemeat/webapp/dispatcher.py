@@ -2,11 +2,14 @@
 # -*- coding: utf-8 -*-
 
 import abc
+import contextvars
 import datetime
+import functools
 import importlib
 import inspect
 import logging
 import sys
+import time
 import warnings
 import textwrap
 import traceback
@@ -15,8 +18,18 @@ import jinja2
 import werkzeug.debug
 
 from horsemeat import configwrapper
+from horsemeat import pg
 from horsemeat.webapp.handler import Handler
+from horsemeat.webapp.request import current_request
 from horsemeat.webapp.response import Response
+from horsemeat.webapp.response import StreamingBody
+from horsemeat.webapp import frameworkhandlers
+from horsemeat.webapp import probes
+from horsemeat.webapp.handlermanifest import HandlerManifest
+from horsemeat.webapp.handlermanifest import LazyHandler
+from horsemeat.webapp.routetable import DispatchCache
+from horsemeat.webapp.routetable import DispatchDecision
+from horsemeat.webapp.routetable import RouteTable
 
 log = logging.getLogger(__name__)
 
@@ -49,14 +62,25 @@ class Dispatcher(object):
     def __init__(self, jinja2_environment, pgconn, config_wrapper,
         enable_access_control=False):
 
+        # Don't hang on to pgconn.  Under gunicorn with preload_app,
+        # the master closes it before forking, and every worker makes
+        # its own.  See the pgconn property below.
         self.jinja2_environment = jinja2_environment
-        self.pgconn = pgconn
         self.config_wrapper = config_wrapper
 
         self.enable_access_control = enable_access_control
 
+        # This one came from the yaml file, if there is one.
+        self.handler_manifest = self.load_handler_manifest()
+
+        # And this one describes the handlers we actually made.
+        self.current_handler_manifest = HandlerManifest()
+
         self.handlers = []
         self.make_handlers()
+        self.route_table = self.make_route_table()
+        self.dispatch_cache = self.make_dispatch_cache()
+        self.probes = self.make_probes()
         self.run_all_on_startup_methods()
 
         log.info("Dispatcher __init__ complete!  Framework is ready.")
@@ -65,6 +89,10 @@ class Dispatcher(object):
     def cw(self):
         return self.config_wrapper
 
+    @property
+    def pgconn(self):
+        return self.cw.get_pgconn()
+
 
     def __call__(self, environ, start_response):
 
@@ -72,83 +100,347 @@ class Dispatcher(object):
         This is the WSGI app interface.
 
         Every time a request hits gunicorn, this method fires.
+
+        Each request gets handled in its own copy of the context, so
+        setting current_request doesn't leak into the next request this
+        thread handles.
         """
 
-        try:
+        # Health checks skip everything else, including the logging.
+        if self.probes and environ.get('PATH_INFO') in self.probes:
+            return self.probes[environ['PATH_INFO']](environ, start_response)
+
+        return contextvars.copy_context().run(
+            self.handle_request,
+            environ,
+            start_response)
+
+    def handle_request(self, environ, start_response):
 
-            req = self.request_class(
-                self.pgconn,
-                self.config_wrapper,
-                environ)
+        started = time.monotonic()
 
-            # TODO: Figure out if there is some more elegant approach to
-            # making the request object visible in the template.
-            self.jinja2_environment.globals['request'] = req
-            self.jinja2_environment.globals['req'] = req
+        self.start_lease()
+        self.start_query_stats()
 
-            log.info('Got request {0} {1} from {2}'.format(
-                req.REQUEST_METHOD,
-                req.path_and_qs,
-                req.client_IP_address))
+        req = None
+
+        try:
+
+            req = self.make_request(environ)
 
             handle_function = self.dispatch(req)
 
-            resp = handle_function(req)
+            self.set_transaction_mode(handle_function)
+            self.choose_database(req, handle_function)
+            self.start_deadline(handle_function, started)
 
-            if not isinstance(resp, Response):
-                raise Exception("Handler didn't return a response object!")
+            resp = self.finish_response(req, handle_function(req))
 
-            # TODO: make this happen as an automatic side effect of
-            # reading the data, so that there is absolutely no risk at
-            # all of forgetting to do this.
-            if req.news_message_cookie_popped:
-                resp.mark_news_message_as_expired()
+            start_response(resp.status, resp.headers)
 
-            # Update the signed-in user's session expires column.
-            # TODO: bring this back, but make it controlled by a setting
-            # in the yaml file, like:
+            self.log_response(resp)
 
-            if req.user and self.cw.update_expires:
+            return resp.body
 
-                new_expires_time = req.session.maybe_update_session_expires_time(
-                   self.pgconn)
+        except Exception as ex:
+            return self.handle_exception(req, environ, ex, start_response)
 
-            # This is to commit all the changes made in the handlers.
-            self.pgconn.commit()
+        finally:
 
-            if self.enable_access_control:
+            # A streaming response swaps in an empty lease and gives
+            # the real one back itself, once the server closes it.
+            lease = pg.current_lease.get(None)
 
-                # Don't add it redundantly!
-                if 'Access-Control-Allow-Origin' not in [key for (key, val) in resp.headers]:
+            if lease:
+                lease.release()
 
-                    resp.headers.append(('Access-Control-Allow-Origin',
-                        dict(req.wz_req.headers).get('Origin', '*')))
+    def start_lease(self):
 
-                    resp.headers.append(('Access-Control-Allow-Credentials',
-                        'true'))
+        """
+        With a connection pool, make a lease for this request, so the
+        request checks out a connection only if it needs one.  Call
+        this in the request's own context.
 
-            start_response(resp.status, resp.headers)
+        Replica connections always come from pools, so with replicas,
+        every request gets a lease, pool or no pool.
+        """
+
+        pool = self.cw.get_connection_pool()
+
+        if pool or self.cw.replicas:
+            lease = pg.ConnectionLease(pool)
+            pg.current_lease.set(lease)
+            return lease
+
+    @staticmethod
+    def get_handler_setting(handle_function, name):
+
+        """
+        Look for a setting like transaction_mode on handle_function
+        first, and then on the handler that owns it.
+        """
+
+        value = getattr(handle_function, name, None)
+
+        if value is None:
+
+            value = getattr(
+                getattr(handle_function, '__self__', None),
+                name,
+                None)
+
+        return value
+
+    def set_transaction_mode(self, handle_function):
+
+        """
+        Look up the transaction_mode of the handler that owns
+        handle_function, so the connection gets set up that way when
+        the handler first asks for it.
+
+        Looking up req.user or req.session in a route method starts a
+        transaction before anybody knows which handler wins, and the
+        mode can't change in the middle of one.  So when that happened,
+        and the handler wants something different, I commit what the
+        routing did, and the handler's first query starts fresh.
+        """
+
+        mode = self.get_handler_setting(handle_function, 'transaction_mode')
+
+        pg.current_transaction_mode.set(mode)
+
+        for pgconn in self.cw.get_pgconns_if_connected():
+
+            if getattr(pgconn, 'horsemeat_transaction_mode', None) != mode \
+            and pg.transaction_is_open(pgconn):
+
+                pgconn.commit()
+
+    def choose_database(self, req, handle_function):
+
+        """
+        Decide whether this request reads from a replica.  Only bother
+        when the yaml file lists some.
+        """
+
+        if not self.cw.replicas:
+            return
+
+        use_replica = self.get_handler_setting(handle_function, 'use_replica')
+
+        if use_replica is None:
+
+            use_replica = \
+            pg.current_transaction_mode.get(None) == 'read only' \
+            or (
+                self.cw.route_safe_methods_to_replicas
+                and req.REQUEST_METHOD in ('GET', 'HEAD'))
+
+        pg.current_database_role.set('replica' if use_replica else 'primary')
+
+    def start_deadline(self, handle_function, started):
+
+        """
+        Give the request until started plus the handler's latency
+        budget.  The instrumented cursors in horsemeat.pg turn that into
+        a statement_timeout.
+        """
+
+        budget = self.get_handler_setting(handle_function, 'latency_budget')
+
+        if budget is None:
+            budget = self.cw.latency_budget_secs
+
+        if budget:
+            pg.current_deadline.set(pg.RequestDeadline(budget, started))
+
+    def start_query_stats(self):
+
+        """
+        Start counting queries for this request.  Like start_lease,
+        call this in the request's own context.
+        """
+
+        pg.current_query_stats.set(pg.QueryStats(
+            slow_query_seconds=self.cw.slow_query_seconds,
+            n_plus_one_threshold=self.cw.n_plus_one_threshold))
+
+    def make_request(self, environ):
+
+        # Don't pass in a connection.  The request gets one from the
+        # config wrapper the first time it needs one.
+        req = self.request_class(
+            None,
+            self.config_wrapper,
+            environ)
+
+        # Templates find the request through this.  See
+        # configwrapper.RequestAwareTemplate.
+        current_request.set(req)
+
+        log.info('Got request {0} {1} from {2}'.format(
+            req.REQUEST_METHOD,
+            req.path_and_qs,
+            req.client_IP_address))
+
+        return req
+
+    def finish_response(self, req, resp):
+
+        """
+        Do all the stuff that happens after the handler returns and
+        before the response goes out, including the commit.
+        """
+
+        if not isinstance(resp, Response):
+            raise Exception("Handler didn't return a response object!")
+
+        # The handler is done, so don't hold the commit to its deadline.
+        pg.current_deadline.set(None)
+
+        # TODO: make this happen as an automatic side effect of
+        # reading the data, so that there is absolutely no risk at
+        # all of forgetting to do this.
+        if req.news_message_cookie_popped:
+            resp.mark_news_message_as_expired()
+
+        # Update the signed-in user's session expires column.  This
+        # goes out with the commit.
+
+        if req.user and self.cw.update_expires:
+            req.session.update_session_expires_time_later(
+                req.deferred_statements)
 
-            if resp.status.startswith('4'):
-                log.warning('Replying with status %s.\n' % resp.status)
+        # A streaming body hasn't even started yet, so it commits
+        # after the last chunk instead.
+        if isinstance(resp.body, StreamingBody):
+            self.start_streaming(req, resp.body)
 
-            elif resp.status.startswith('5'):
-                log.critical('Replying with status %s.\n' % resp.status)
+        else:
+            self.commit_everything(req)
 
-            elif resp.status.startswith('30'):
-                log.info('Redirecting to {0}.'.format(resp.headers))
+        if self.enable_access_control:
+
+            # Don't add it redundantly!
+            if 'Access-Control-Allow-Origin' not in [key for (key, val) in resp.headers]:
+
+                resp.headers.append(('Access-Control-Allow-Origin',
+                    dict(req.wz_req.headers).get('Origin', '*')))
+
+                resp.headers.append(('Access-Control-Allow-Credentials',
+                    'true'))
+
+        return resp
+
+    def commit_everything(self, req):
+
+        """
+        This is to commit all the changes made in the handlers.  Skip
+        it if there's no transaction open, which saves a round trip.
+        Deferred statements are writes, so they always go to the
+        primary.
+        """
+
+        deferred_statements = req.get('horsemeat.deferred_statements')
+
+        if deferred_statements:
+            deferred_statements.flush_and_commit(req.primary_pgconn)
+
+        for pgconn in self.cw.get_pgconns_if_connected():
+
+            if pg.transaction_is_open(pgconn):
+                pgconn.commit()
+
+    def start_streaming(self, req, body):
+
+        """
+        Hand this request's context, lease and all, to body, so the
+        chunks get made on the same connection, in the same transaction,
+        after the handler returns.  The request itself ends up with an
+        empty lease, so whoever releases that doesn't pull the
+        connection out from under the body.
+        """
+
+        body.start(
+            contextvars.copy_context(),
+            functools.partial(self.finish_stream, req))
+
+        lease = pg.current_lease.get(None)
+
+        if lease is not None:
+            pg.current_lease.set(pg.ConnectionLease(lease.pool))
+
+    def finish_stream(self, req, finished):
+
+        """
+        The server closed a streaming body.  Commit if every chunk went
+        out, roll back otherwise, and give back the connection.
+        """
+
+        try:
+
+            if finished:
+                self.commit_everything(req)
 
             else:
-                log.info('Replying with status %s.\n' % resp.status)
 
-            return resp.body
+                for pgconn in self.cw.get_pgconns_if_connected():
+                    pgconn.rollback()
 
-        except Exception as ex:
+        finally:
 
-            self.pgconn.rollback()
-            #log.critical(ex, exc_info=1)
+            lease = pg.current_lease.get(None)
+
+            if lease is not None:
+                lease.release()
+
+    @staticmethod
+    def log_response(resp):
+
+        stats = pg.current_query_stats.get(None)
+
+        if stats:
+
+            queries = ' ({0})'.format(stats.describe())
+
+            req = current_request.get(None)
+            stats.log_problems(req.line_one if req else None)
+
+        else:
+            queries = ''
+
+        if resp.status.startswith('4'):
+            log.warning('Replying with status %s%s.\n' % (resp.status, queries))
+
+        elif resp.status.startswith('5'):
+            log.critical('Replying with status %s%s.\n' % (resp.status, queries))
+
+        elif resp.status.startswith('30'):
+            log.info('Redirecting to {0}{1}.'.format(resp.headers, queries))
+
+        else:
+            log.info('Replying with status %s%s.\n' % (resp.status, queries))
+
+    def handle_exception(self, req, environ, ex, start_response):
+
+        """
+        Roll back, log everything, and reply with an error page.
+
+        Only call this from inside an except block.  req is None when
+        building the request is what blew up.
+        """
+
+        for pgconn in self.cw.get_pgconns_if_connected():
+            pgconn.rollback()
+
+        if req is not None and isinstance(ex, pg.timeout_errors):
+            return self.handle_timeout(req, ex, start_response)
+
+        #log.critical(ex, exc_info=1)
+
+        # let's build up the error
+        if req is not None:
 
-            # let's build up the error
             error_text = textwrap.dedent(f"""
                 address bar : {req.address_bar}
                 post body: {req.wz_req.form}
@@ -161,52 +453,109 @@ class Dispatcher(object):
 
             """)
 
-            log.critical(error_text)
+        else:
+
+            error_text = textwrap.dedent(f"""
+                couldn't build a request out of this environ: {environ}
+
+                exception traceback:
+
+                {traceback.format_exc()}
+
+            """)
+
+        log.critical(error_text)
+
+        if self.cw.launch_debugger_on_error:
+            raise
+
+        else:
+
+            #log.critical('address bar: {0}'.format(req.address_bar))
+            #log.critical('post body: {0}'.format(req.wz_req.form))
+
+            #log.critical(environ)
+            #log.critical(ex, exc_info=1)
+
+            if req is not None and req.is_JSON and self.response_class:
+
+                resp = self.response_class.json(dict(
+                    reply_timestamp=datetime.datetime.now(),
+                    message="Error encountered '{0}'".format(ex),
+                    success=False))
+
+                resp.status = '500 ERROR'
+
+                if self.enable_access_control:
+                    resp.headers.append(('Access-Control-Allow-Origin',
+                        dict(req.wz_req.headers).get('Origin', '*')))
+
+                    resp.headers.append(('Access-Control-Allow-Credentials',
+                        'true'))
+
 
-            if self.cw.launch_debugger_on_error:
-                raise
+                start_response(resp.status, resp.headers)
+
+                log.info('Replying with status %s.\n' % resp.status)
+
+                return resp.body
 
             else:
+                start_response(
+                    '500 ERROR',
+                    [('Content-Type', 'text/html; charset=utf-8')],
+                    sys.exc_info())
 
-                #log.critical('address bar: {0}'.format(req.address_bar))
-                #log.critical('post body: {0}'.format(req.wz_req.form))
+                s = self.error_page.render()
 
-                #log.critical(environ)
-                #log.critical(ex, exc_info=1)
+                return [s.encode('utf8')]
 
-                if req.is_JSON and self.response_class:
 
-                    resp = self.response_class.json(dict(
-                        reply_timestamp=datetime.datetime.now(),
-                        message="Error encountered '{0}'".format(ex),
-                        success=False))
+    def handle_timeout(self, req, ex, start_response):
 
-                    resp.status = '500 ERROR'
+        """
+        Reply with a 504 when the handler ran out of time, rather than
+        an error page, since nothing is actually broken.
+        """
 
-                    if self.enable_access_control:
-                        resp.headers.append(('Access-Control-Allow-Origin',
-                            dict(req.wz_req.headers).get('Origin', '*')))
+        log.warning('{0} ran out of time: {1}'.format(req.line_one, ex))
 
-                        resp.headers.append(('Access-Control-Allow-Credentials',
-                            'true'))
+        status = '504 GATEWAY TIMEOUT'
 
+        if req.is_JSON and self.response_class:
 
-                    start_response(resp.status, resp.headers)
+            resp = self.response_class.json(dict(
+                reply_timestamp=datetime.datetime.now(),
+                message="This took too long, so I gave up.  Try again "
+                    "in a little while.",
+                success=False))
 
-                    log.info('Replying with status %s.\n' % resp.status)
+            resp.status = status
 
-                    return resp.body
+            if self.enable_access_control:
 
-                else:
-                    start_response(
-                        '500 ERROR',
-                        [('Content-Type', 'text/html; charset=utf-8')],
-                        sys.exc_info())
+                resp.headers.append(('Access-Control-Allow-Origin',
+                    dict(req.wz_req.headers).get('Origin', '*')))
 
-                    s = self.error_page.render()
+                resp.headers.append(('Access-Control-Allow-Credentials',
+                    'true'))
 
-                    return [s.encode('utf8')]
+            start_response(resp.status, resp.headers)
 
+            log.info('Replying with status %s.\n' % resp.status)
+
+            return resp.body
+
+        else:
+
+            start_response(
+                status,
+                [('Content-Type', 'text/html; charset=utf-8')])
+
+            log.info('Replying with status %s.\n' % status)
+
+            return [b'<h1>This took too long</h1>'
+                b'<p>Try again in a little while.</p>']
 
     def dispatch(self, request):
 
@@ -222,40 +571,193 @@ class Dispatcher(object):
 
         """
 
-        for candidate in self.handlers:
+        line_one = str(request.line_one)
+
+        if self.dispatch_cache is not None:
+
+            decision = self.dispatch_cache.get(line_one)
+
+            if decision:
+
+                self.copy_matched_groups_into_request(
+                    decision.matched_groups,
+                    request)
+
+                log.info(
+                    'Dispatching to {0}.{1} (cached).'.format(
+                    self.describe_handler_class(decision.handler),
+                    decision.handle_function.__name__,
+                ))
+
+                return decision.handle_function
+
+        position, indexed_handler, matched_groups = \
+        self.route_table.lookup(request)
+
+        # We can only remember this decision if every route method we
+        # call only looks at the line one.
+        cacheable = True
+
+        # Handlers with their own route methods still get asked, but
+        # only the ones in front of the indexed handler, so the first
+        # handler in the list still wins.
+        for candidate in self.route_table.unindexed_handlers_before(
+            position):
+
+            cacheable = cacheable and candidate.route_only_reads_line_one
 
             thing = candidate.route(request)
 
             if thing:
 
-                # Check if we got a function back.  This is the
-                # preferred behavior.
-                if callable(thing):
+                handle_function = self.convert_route_result_to_function(
+                    candidate,
+                    thing)
+
+                if handle_function:
+
+                    if cacheable:
+                        self.remember_dispatch_decision(line_one,
+                            candidate, handle_function, None)
+
+                    return handle_function
+
+        if indexed_handler:
+
+            self.copy_matched_groups_into_request(matched_groups, request)
+
+            handle_function = self.convert_route_result_to_function(
+                indexed_handler,
+                indexed_handler.handle)
+
+            if cacheable:
+                self.remember_dispatch_decision(line_one,
+                    indexed_handler, handle_function, matched_groups)
 
-                    log.info(
-                        'Dispatching to {0}.{1}.{2}.'.format(
-                        candidate.__class__.__module__,
-                        candidate.__class__.__name__,
-                        thing.__name__,
-                    ))
+            return handle_function
 
-                    return thing
+    @staticmethod
+    def copy_matched_groups_into_request(matched_groups, request):
+
+        # Do the same thing Handler.check_route_patterns does with
+        # the named groups.
+        if matched_groups:
+            for k in matched_groups:
+                request[k] = matched_groups[k]
+
+    def remember_dispatch_decision(self, line_one, handler,
+        handle_function, matched_groups):
+
+        if self.dispatch_cache is not None:
+
+            self.dispatch_cache.put(line_one, DispatchDecision(
+                handler,
+                handle_function,
+                matched_groups,
+                self.is_not_found_handler(handler)))
+
+    @staticmethod
+    def describe_handler_class(handler):
+
+        """
+        Return the module and name of handler's class, for log lines.
+        A LazyHandler reads these out of the manifest, so logging
+        doesn't import anything.
+        """
+
+        if isinstance(handler, LazyHandler):
+            return '{0}.{1}'.format(
+                handler.handler_module,
+                handler.handler_name)
+
+        else:
+            return '{0}.{1}'.format(
+                type(handler).__module__,
+                type(handler).__name__)
+
+    @staticmethod
+    def is_not_found_handler(handler):
+
+        if isinstance(handler, LazyHandler):
+            return handler.is_not_found
+
+        else:
+            return isinstance(handler, frameworkhandlers.NotFound)
 
-                # Check if the thing we got has a thing.handle method.
-                elif inspect.ismethod(getattr(thing, 'handle', None)):
+    def convert_route_result_to_function(self, candidate, thing):
 
-                    warnings.warn(
-                        'Return self.handle rather than self',
-                        DeprecationWarning)
+        # Check if we got a function back.  This is the
+        # preferred behavior.
+        if callable(thing):
 
-                    log.info(
-                        'Dispatching to {0}.{1}.{2}.'.format(
-                        candidate.__class__.__module__,
-                        candidate.__class__.__name__,
-                        thing.handle.im_func.func_name,
-                    ))
+            log.info(
+                'Dispatching to {0}.{1}.'.format(
+                self.describe_handler_class(candidate),
+                thing.__name__,
+            ))
+
+            return thing
+
+        # Check if the thing we got has a thing.handle method.
+        elif inspect.ismethod(getattr(thing, 'handle', None)):
+
+            warnings.warn(
+                'Return self.handle rather than self',
+                DeprecationWarning)
+
+            log.info(
+                'Dispatching to {0}.{1}.'.format(
+                self.describe_handler_class(candidate),
+                thing.handle.__name__,
+            ))
+
+            return thing.handle
+
+    def make_route_table(self):
+
+        """
+        Subclasses can override this if they want to build their route
+        table some other way.
+
+        If you change self.handlers after the dispatcher is built, call
+        this again and store the result in self.route_table.
+        """
+
+        return RouteTable(self.handlers)
+
+    def make_probes(self):
+
+        """
+        Return a dictionary that maps the liveness and readiness paths
+        from the yaml file to WSGI apps that answer them.  See
+        horsemeat.webapp.probes.
+        """
 
-                    return thing.handle
+        d = dict()
+
+        if self.cw.liveness_path:
+            d[self.cw.liveness_path] = probes.answer_liveness_probe
+
+        if self.cw.readiness_path:
+
+            d[self.cw.readiness_path] = probes.ReadinessCheck(
+                self.cw,
+                checks_database=self.cw.readiness_checks_database,
+                cache_seconds=self.cw.readiness_cache_seconds)
+
+        return d
+
+    def make_dispatch_cache(self):
+
+        """
+        Return None to turn off the dispatch cache.
+
+        Set dispatch_cache_size under app in the yaml file to change how
+        many line ones we remember.
+        """
+
+        if self.cw.dispatch_cache_size:
+            return DispatchCache(self.cw.dispatch_cache_size)
 
     @classmethod
     def app_from_yaml(cls, yaml_file_name):
@@ -282,12 +784,17 @@ class Dispatcher(object):
 
             if cw.launch_debugger_on_error:
 
-                return werkzeug.debug.DebuggedApplication(
+                webapp = werkzeug.debug.DebuggedApplication(
                     cls(j, pgconn, cw),
                     evalex=True)
 
             else:
-                return cls(j, pgconn, cw)
+                webapp = cls(j, pgconn, cw)
+
+            if cw.preload_app:
+                cw.prepare_for_fork()
+
+            return webapp
 
         except Exception as ex:
             log.critical(ex, exc_info=1)
@@ -329,6 +836,20 @@ class Dispatcher(object):
 
     def make_handlers_from_module_string(self, s):
 
+        # If the handler manifest knows about this module, don't import
+        # anything yet.
+        if self.handler_manifest:
+
+            descriptions = self.handler_manifest.handler_descriptions(s)
+
+            if descriptions is not None:
+
+                self.current_handler_manifest.modules[s] = \
+                self.handler_manifest.modules[s]
+
+                return [LazyHandler(d, self.config_wrapper, self)
+                    for d in descriptions]
+
         m = importlib.import_module(s)
 
         # This is one really big gigantic list comprehension, but don't
@@ -351,7 +872,7 @@ class Dispatcher(object):
         # and that list spells out the list of classes and the order to
         # add.
 
-        return [cls(self.config_wrapper, self)
+        handlers = [cls(self.config_wrapper, self)
 
             for name, cls in inspect.getmembers(m)
 
@@ -369,6 +890,36 @@ class Dispatcher(object):
             and getattr(cls.route, '__isabstractmethod__', False) is False
         ]
 
+        self.current_handler_manifest.add_module(s, handlers)
+
+        return handlers
+
+    def load_handler_manifest(self):
+
+        if self.cw.handler_manifest_path:
+
+            try:
+                return HandlerManifest.from_file(self.cw.handler_manifest_path)
+
+            except (IOError, ValueError, KeyError) as ex:
+
+                log.warning("Couldn't load handler manifest {0}: "
+                    "{1!r}".format(self.cw.handler_manifest_path, ex))
+
+    def write_handler_manifest(self, filename=None):
+
+        """
+        Write out a manifest describing the handlers this dispatcher
+        made with make_handlers_from_module_string.
+
+        Next time a dispatcher starts up with app.handler_manifest
+        pointing at this file, it won't import any handler modules until
+        a request needs them.
+        """
+
+        self.current_handler_manifest.write(
+            filename or self.cw.handler_manifest_path)
+
 
     @abc.abstractmethod
     def make_handlers(self):
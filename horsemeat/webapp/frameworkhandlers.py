@@ -20,6 +20,10 @@ module_template_package = 'horsemeat.webapp.framework.framework_templates'
 
 class NotFound(Handler):
 
+    # This handler wants everything, so the dispatcher can remember
+    # every line one that ends up here.
+    route_only_reads_line_one = True
+
     def route(self, req):
         return self.handle
 
@@ -0,0 +1,55 @@
+# vim: set expandtab ts=4 sw=4 filetype=python fileencoding=utf8:
+
+"""
+Server hooks for gunicorn.  Pull them into your gunicorn config file
+like this::
+
+    # gunicorn.conf.py
+    from horsemeat.webapp.gunicornhooks import post_fork, post_worker_init
+
+    preload_app = True
+
+and set preload_app under app in your yaml file too, so build_webapp
+closes the database connection and freezes the garbage collector before
+gunicorn forks the workers.
+
+Each worker logs how long it took to boot and how much memory it uses
+that isn't shared with the master.  Compare those log lines with
+preload_app on and off.
+"""
+
+import logging
+import os
+import time
+
+from horsemeat import configwrapper
+
+log = logging.getLogger(__name__)
+
+def get_default_config_wrapper():
+
+    try:
+        return configwrapper.ConfigWrapper.get_default()
+
+    # Without preload_app, the worker hasn't built the app yet.
+    except ValueError:
+        return None
+
+def post_fork(server, worker):
+
+    worker.horsemeat_forked_at = time.monotonic()
+
+    cw = get_default_config_wrapper()
+
+    if cw:
+        cw.reset_after_fork()
+
+def post_worker_init(worker):
+
+    forked_at = getattr(worker, 'horsemeat_forked_at', None)
+
+    log.info("Worker {0} booted in {1}; {2}".format(
+        os.getpid(),
+        '{0:.3f} seconds'.format(time.monotonic() - forked_at)
+            if forked_at else 'an unknown amount of time',
+        configwrapper.describe_memory_usage()))
@@ -10,6 +10,8 @@ import warnings
 import decorator
 import jinja2
 
+from horsemeat import pg
+
 log = logging.getLogger(__name__)
 
 module_template_prefix = 'framework'
@@ -21,10 +23,35 @@ class Handler(object):
 
     add_these_to_jinja2_globals = dict()
 
+    # Set this to 'read only', 'autocommit', or 'serializable' and the
+    # dispatcher sets up the database connection that way before this
+    # handler uses it.  See horsemeat.pg.transaction_modes.
+    transaction_mode = None
+
+    # With replicas listed in the yaml file, GET and HEAD requests and
+    # read only handlers get req.pgconn from a replica.  Set this to
+    # False for a GET handler that writes, or True for a POST handler
+    # that only reads.
+    use_replica = None
+
+    # How many seconds this handler gets, counting from when the
+    # request came in, before its queries get canceled and the user
+    # gets a 504.  None means ConfigWrapper.latency_budget_secs.
+    latency_budget = None
+
     route_patterns = []
 
     route_strings = set()
 
+    # Set this to True if your route method only looks at
+    # req.line_one, and doesn't read cookies, the body, the session, or
+    # anything else, and doesn't store anything in the request.  Then
+    # the dispatcher can remember which handler wants each line one.
+    #
+    # Handlers that use check_route_strings or check_route_patterns
+    # don't need to bother with this.
+    route_only_reads_line_one = False
+
     # Subclasses must point this at something besides None!
     Response = None
 
@@ -80,6 +107,15 @@ class Handler(object):
     def pgconn(self):
         return self.cw.get_pgconn()
 
+    def run_queries_concurrently(self, queries):
+
+        """
+        See horsemeat.pg.run_queries_concurrently.  Use this when a
+        page needs a bunch of queries that don't depend on each other.
+        """
+
+        return pg.run_queries_concurrently(self.cw, queries)
+
     @abc.abstractmethod
     def route(self, request):
         """
@@ -266,6 +302,33 @@ class Handler(object):
         if req.line_one in self.route_strings:
             return self.handle
 
+    @property
+    def route_kind(self):
+
+        """
+        The dispatcher's route table reads this to figure out if it can
+        index this handler instead of calling its route method.
+
+        Handlers that do::
+
+            route = Handler.check_route_strings
+
+        come back as 'strings', and handlers that do::
+
+            route = Handler.check_route_patterns
+
+        come back as 'patterns'.  Everybody else comes back as None, and
+        their route method gets called on every request, like always.
+        """
+
+        if type(self).route is Handler.check_route_strings \
+        and self.route_strings:
+            return 'strings'
+
+        elif type(self).route is Handler.check_route_patterns \
+        and self.route_patterns:
+            return 'patterns'
+
     @property
     def handler_namespace(self):
 
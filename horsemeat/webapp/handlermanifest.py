@@ -0,0 +1,312 @@
+# vim: set expandtab ts=4 sw=4 filetype=python fileencoding=utf8:
+
+"""
+Every worker used to import every handler module, dig through it with
+inspect.getmembers, and then instantiate every handler before it could
+answer a single request.
+
+A handler manifest is a JSON file that remembers what all that digging
+found: which handler classes live in each module string, what order
+they go in, and how they route.  When the dispatcher has a manifest, it
+builds its route table from the manifest and puts a LazyHandler in
+self.handlers for each class.  The real handler gets imported and built
+the first time a request needs it.
+
+Write a manifest from a dispatcher that built its handlers the normal
+way::
+
+    >>> dispatcher.write_handler_manifest('/tmp/handler-manifest.json') # doctest: +SKIP
+
+and then point the yaml file at it::
+
+    app:
+        handler_manifest: /tmp/handler-manifest.json
+
+If any of the source files behind a module string changed since the
+manifest was written, the dispatcher ignores the manifest for that
+module string and loads it the normal way.
+
+"""
+
+import importlib
+import json
+import logging
+import os
+import re
+import sys
+import threading
+
+import jinja2
+
+from horsemeat.version import __version__
+from horsemeat.webapp import frameworkhandlers
+from horsemeat.webapp.handler import Handler
+
+log = logging.getLogger(__name__)
+
+def describe_handler(handler):
+
+    """
+    Return a dictionary with everything the dispatcher needs to know
+    about this handler without importing it.
+    """
+
+    cls = type(handler)
+    m = sys.modules[cls.__module__]
+
+    d = dict(
+        module=cls.__module__,
+        name=cls.__name__,
+        route_kind=handler.route_kind,
+        route_only_reads_line_one=bool(handler.route_only_reads_line_one),
+
+        # Handlers that do stuff when they get built or when the app
+        # starts up can't wait for their first request.
+        needs_eager_load=bool(
+            cls.__init__ is not Handler.__init__
+            or cls.on_startup is not Handler.on_startup
+            or handler.add_these_to_jinja2_globals),
+
+        template_folder=None,
+
+        # The dispatch cache treats decisions that end up here as
+        # negative ones.
+        is_not_found=isinstance(handler, frameworkhandlers.NotFound),
+    )
+
+    if hasattr(m, 'module_template_prefix') \
+    and hasattr(m, 'module_template_package'):
+
+        d['template_folder'] = [
+            m.module_template_prefix,
+            m.module_template_package]
+
+    if d['route_kind'] == 'strings':
+        d['route_strings'] = sorted(str(s) for s in handler.route_strings)
+
+    elif d['route_kind'] == 'patterns':
+
+        d['route_patterns'] = list()
+
+        for rp in handler.route_patterns:
+
+            if not hasattr(rp, 'match'):
+                d['route_patterns'].append(dict(string=str(rp)))
+
+            elif isinstance(rp.pattern, str):
+                d['route_patterns'].append(dict(
+                    pattern=rp.pattern,
+                    flags=rp.flags))
+
+            # A bytes pattern won't fit in JSON, so this handler just
+            # gets its route method called.
+            else:
+                d['route_kind'] = None
+                del d['route_patterns']
+                break
+
+    return d
+
+def describe_source_file(module_name):
+
+    filename = getattr(sys.modules.get(module_name), '__file__', None)
+
+    if filename:
+
+        st = os.stat(filename)
+
+        return dict(
+            path=os.path.abspath(filename),
+            mtime=st.st_mtime,
+            size=st.st_size)
+
+def source_file_is_unchanged(source_file):
+
+    try:
+        st = os.stat(source_file['path'])
+
+    except OSError:
+        return False
+
+    return st.st_mtime == source_file['mtime'] \
+    and st.st_size == source_file['size']
+
+class HandlerManifest(object):
+
+    def __init__(self, modules=None):
+
+        # Maps module strings to a dictionary with keys source_files
+        # and handlers.
+        self.modules = modules if modules is not None else dict()
+
+    @classmethod
+    def from_file(cls, filename):
+
+        with open(filename) as f:
+            d = json.load(f)
+
+        if d.get('horsemeat_version') != __version__:
+
+            log.warning("Handler manifest {0} came from horsemeat {1}, "
+                "not {2}, so I'm ignoring it".format(
+                    filename,
+                    d.get('horsemeat_version'),
+                    __version__))
+
+            return cls()
+
+        return cls(d['modules'])
+
+    def write(self, filename):
+
+        with open(filename, 'w') as f:
+
+            json.dump(
+                dict(
+                    horsemeat_version=__version__,
+                    modules=self.modules),
+                f,
+                indent=4,
+                sort_keys=True)
+
+        log.info("Wrote handler manifest for {0} module strings to "
+            "{1}".format(len(self.modules), filename))
+
+    def add_module(self, s, handlers):
+
+        module_names = set([s])
+        module_names.update(type(h).__module__ for h in handlers)
+
+        source_files = [describe_source_file(name)
+            for name in sorted(module_names)]
+
+        self.modules[s] = dict(
+            source_files=[sf for sf in source_files if sf],
+            handlers=[describe_handler(h) for h in handlers])
+
+    def handler_descriptions(self, s):
+
+        """
+        Return the list of handler descriptions for module string s, or
+        None if the manifest doesn't know about s or if the source
+        files changed.
+        """
+
+        if s not in self.modules:
+            return
+
+        elif not all(source_file_is_unchanged(source_file)
+            for source_file in self.modules[s]['source_files']):
+
+            log.warning("Handler manifest is stale for {0}".format(s))
+
+        else:
+            return self.modules[s]['handlers']
+
+class LazyHandler(object):
+
+    """
+    Stands in for a handler until a request needs the real thing.
+
+    The route table only reads route_kind, route_strings,
+    route_patterns, and route_only_reads_line_one, and those come right
+    out of the manifest.  Everything else gets passed through to the
+    real handler, which gets imported and built on first use.
+
+    This is still a LazyHandler as far as type and isinstance go.  Use
+    handler_module, handler_name, and is_not_found to ask about the real
+    handler's class without loading it.
+    """
+
+    def __init__(self, description, config_wrapper, dispatcher):
+
+        self.description = description
+        self.config_wrapper = config_wrapper
+        self.dispatcher = dispatcher
+
+        self.loaded_handler = None
+        self.lock = threading.Lock()
+
+        self.handler_module = description['module']
+        self.handler_name = description['name']
+        self.is_not_found = description.get('is_not_found', False)
+
+        self.route_kind = description['route_kind']
+
+        self.route_only_reads_line_one = \
+        description['route_only_reads_line_one']
+
+        self.route_strings = set(description.get('route_strings', []))
+
+        self.route_patterns = [
+            re.compile(rp['pattern'], rp['flags']) if 'pattern' in rp
+            else rp['string']
+            for rp in description.get('route_patterns', [])]
+
+        if description['template_folder']:
+            self.add_module_template_folder_to_jinja2_environment()
+
+        if description['needs_eager_load']:
+            self.load()
+
+    def __repr__(self):
+
+        return '<{0}.{1} for {2}.{3} (loaded: {4})>'.format(
+            type(self).__module__,
+            type(self).__name__,
+            self.handler_module,
+            self.handler_name,
+            self.loaded_handler is not None)
+
+    def add_module_template_folder_to_jinja2_environment(self):
+
+        # This is the same thing Handler does, but without importing
+        # the handler's module.
+
+        prefix, package = self.description['template_folder']
+
+        package_name, template_folder = package.rsplit('.', 1)
+
+        j = self.config_wrapper.get_jinja2_environment()
+
+        if prefix not in j.loader.mapping:
+
+            j.loader.mapping[prefix] = jinja2.PackageLoader(
+                package_name,
+                template_folder)
+
+    def load(self):
+
+        if self.loaded_handler is None:
+
+            with self.lock:
+
+                if self.loaded_handler is None:
+
+                    m = importlib.import_module(self.description['module'])
+                    cls = getattr(m, self.description['name'])
+
+                    self.loaded_handler = cls(
+                        self.config_wrapper,
+                        self.dispatcher)
+
+                    log.info("Loaded {0}".format(self.loaded_handler))
+
+        return self.loaded_handler
+
+    def route(self, request):
+        return self.load().route(request)
+
+    @property
+    def handle(self):
+        return self.load().handle
+
+    def on_startup(self):
+
+        # If the real handler had its own on_startup method, it got
+        # loaded already.
+        if self.loaded_handler is not None:
+            return self.loaded_handler.on_startup()
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
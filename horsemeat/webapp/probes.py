@@ -0,0 +1,166 @@
+# vim: set expandtab ts=4 sw=4 filetype=python fileencoding=utf8:
+
+"""
+Cheap answers for load balancer health checks.
+
+Set these under app in the yaml file::
+
+    app:
+        liveness_path: /healthz
+        readiness_path: /readyz
+
+and the dispatcher answers those paths before it builds a request
+object, looks at any handlers, or logs anything.
+
+The liveness probe always says ok.  The readiness probe runs select 1
+on the database connection, but no more than once every
+readiness_cache_seconds (default 1).  Set readiness_checks_database to
+false to skip the query.
+
+When every connection in the pool is checked out, the readiness probe
+says not ready right away instead of waiting in line for one.
+"""
+
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+ok_headers = [
+    ('Content-Type', 'text/plain; charset=utf-8'),
+    ('Content-Length', '2'),
+    ('Cache-Control', 'no-store')]
+
+not_ready_headers = [
+    ('Content-Type', 'text/plain; charset=utf-8'),
+    ('Content-Length', '9'),
+    ('Cache-Control', 'no-store')]
+
+def answer_liveness_probe(environ, start_response):
+
+    start_response('200 OK', list(ok_headers))
+    return [b'ok']
+
+class ReadinessCheck(object):
+
+    """
+    Remembers the last time it checked the database, so a flood of
+    probes only costs one query per cache_seconds.
+
+    >>> check = ReadinessCheck(None, checks_database=False)
+    >>> check.is_ready()
+    True
+    """
+
+    def __init__(self, config_wrapper, checks_database=True,
+        cache_seconds=1.0):
+
+        self.config_wrapper = config_wrapper
+        self.checks_database = checks_database
+        self.cache_seconds = cache_seconds
+
+        self.ready = True
+        self.checked_at = None
+
+        # When one thread is running select 1, the others just use
+        # the last answer instead of waiting in line.
+        self.lock = threading.Lock()
+
+    def is_ready(self):
+
+        if not self.checks_database:
+            return True
+
+        elif self.checked_at is not None \
+        and time.monotonic() - self.checked_at < self.cache_seconds:
+            return self.ready
+
+        elif not self.lock.acquire(blocking=False):
+            return self.ready
+
+        try:
+
+            ready = self.database_is_ready()
+
+            # Only log when the answer changes, so probes stay out of
+            # the logs.
+            if ready != self.ready:
+
+                log.log(
+                    logging.INFO if ready else logging.WARNING,
+                    "Readiness changed to {0}".format(ready))
+
+            self.ready = ready
+            self.checked_at = time.monotonic()
+
+            return ready
+
+        finally:
+            self.lock.release()
+
+    def database_is_ready(self):
+
+        cw = self.config_wrapper
+
+        pool = cw.get_connection_pool()
+
+        # The pool throws away broken connections by itself.  Don't
+        # wait for a free one, because a load balancer won't wait for
+        # this probe, and a pool with nothing free isn't ready anyway.
+        if pool:
+
+            try:
+
+                with pool.connection(timeout=0) as pgconn:
+
+                    cursor = pgconn.cursor()
+                    cursor.execute("select 1")
+                    cursor.fetchone()
+
+                return True
+
+            except Exception as ex:
+                log.warning("Readiness check failed: {0}".format(ex))
+                return False
+
+        try:
+
+            pgconn = cw.get_pgconn()
+
+            cursor = pgconn.cursor()
+            cursor.execute("select 1")
+            cursor.fetchone()
+
+            pgconn.rollback()
+
+            return True
+
+        except Exception as ex:
+
+            log.warning("Readiness check failed: {0}".format(ex))
+
+            # Make a fresh connection next time.
+            pgconn = cw.postgresql_connection
+
+            if pgconn is not None:
+
+                try:
+                    pgconn.close()
+
+                except Exception:
+                    pass
+
+                cw.postgresql_connection = None
+
+            return False
+
+    def __call__(self, environ, start_response):
+
+        if self.is_ready():
+            start_response('200 OK', list(ok_headers))
+            return [b'ok']
+
+        else:
+            start_response('503 SERVICE UNAVAILABLE', list(not_ready_headers))
+            return [b'not ready']
@@ -1,6 +1,7 @@
 # vim: set expandtab ts=4 sw=4 filetype=python fileencoding=utf8:
 
 import collections.abc
+import contextvars
 import http.cookies
 import hashlib
 import hmac
@@ -9,19 +10,52 @@ import json
 import logging
 import re
 import sys
-import textwrap
 import urllib
 import urllib.parse
 import warnings
 import wsgiref.util
 
 from horsemeat import CookieWrapper
+from horsemeat.model.user import PersonLoader
+from horsemeat.pg import DeferredStatements, statements
 
 from werkzeug.wrappers import Request as WerkzeugRequest
 from werkzeug.http import parse_cookie
 
 log = logging.getLogger(__name__)
 
+# Every request with a session cookie runs these, so they get prepared
+# once per connection.  See horsemeat.pg.Statement.
+
+select_live_session = statements.register('select_live_session', """
+    select (s.*)::webapp_sessions as ts
+    from webapp_sessions s
+    where s.session_uuid = (%s)
+    and s.expires > current_timestamp
+    """)
+
+select_user = statements.register('select_user', """
+    select (p.*)::people as user
+    from people p
+    where p.person_uuid = (%s)
+    """)
+
+# The dispatcher sets this to the request it is handling, so code that
+# doesn't get handed the request, like templates, can still find it.
+# Each thread (and each asyncio task) sees its own value.
+current_request = contextvars.ContextVar('current_request')
+
+def get_current_request():
+
+    """
+    Return the request being handled right now, or None.
+
+    >>> get_current_request() is None
+    True
+    """
+
+    return current_request.get(None)
+
 class Request(collections.abc.MutableMapping):
 
     """
@@ -41,6 +75,39 @@ class Request(collections.abc.MutableMapping):
         # The number below is about 10 megabytes.
         self.maximum_buffer_size = 10 * 1000 * 1000
 
+    @property
+    def pgconn(self):
+
+        """
+        The dispatcher passes in None, so this asks the config wrapper
+        the first time somebody needs the database.  With a connection
+        pool, that's when this request checks out a connection.
+        """
+
+        if self._pgconn is None:
+            return self.config_wrapper.get_pgconn()
+
+        else:
+            return self._pgconn
+
+    @pgconn.setter
+    def pgconn(self, pgconn):
+        self._pgconn = pgconn
+
+    @property
+    def primary_pgconn(self):
+
+        """
+        Same as pgconn, except never a replica.  Use this for writes in
+        handlers that otherwise read from a replica.
+        """
+
+        if self._pgconn is None:
+            return self.config_wrapper.get_primary_pgconn()
+
+        else:
+            return self._pgconn
+
     @property
     def HTTP_COOKIE(self):
         return self.get('HTTP_COOKIE')
@@ -326,6 +393,36 @@ class Request(collections.abc.MutableMapping):
         self['horsemeat.news_message_cookie'] = message
         return message
 
+    @property
+    def deferred_statements(self):
+
+        """
+        Add statements in here when you don't need their results, and
+        they go out with the commit at the end of the request.  See
+        horsemeat.pg.DeferredStatements.
+        """
+
+        if 'horsemeat.deferred_statements' not in self:
+            self['horsemeat.deferred_statements'] = DeferredStatements()
+
+        return self['horsemeat.deferred_statements']
+
+    @property
+    def people(self):
+
+        """
+        Look people up through this instead of one query at a time, so
+        the same person never gets looked up twice in one request.  See
+        horsemeat.model.user.PersonLoader.
+        """
+
+        if 'horsemeat.people' not in self:
+
+            self['horsemeat.people'] = PersonLoader(
+                lambda: self.pgconn)
+
+        return self['horsemeat.people']
+
     @property
     def news_message_cookie_popped(self):
         return self.get('horsemeat.news_message_cookie_popped')
@@ -465,16 +562,11 @@ class Request(collections.abc.MutableMapping):
                 self['session_uuid'] = None
                 return
 
-            qry = textwrap.dedent("""
-                select (s.*)::webapp_sessions as ts
-                from webapp_sessions s
-                where s.session_uuid = (%s)
-                and s.expires > current_timestamp
-                """)
-
-            cursor = self.pgconn.cursor()
+            # Read this from the primary, since a replica might not
+            # know about a session that just started.
+            cursor = self.primary_pgconn.cursor()
 
-            cursor.execute(qry, [session_uuid])
+            select_live_session.execute(cursor, [session_uuid])
 
             if cursor.rowcount == 1:
                 s = cursor.fetchone().ts
@@ -506,18 +598,14 @@ class Request(collections.abc.MutableMapping):
         # If we don't already have a user, see if we can look one up.
         elif self.session and self.session.person_uuid:
 
-            cursor = self.pgconn.cursor()
+            cursor = self.primary_pgconn.cursor()
 
-            cursor.execute(textwrap.dedent("""
-                select (p.*)::people as user
-                from people p
-                where p.person_uuid = (%s)
-                """), [self.session.person_uuid])
+            select_user.execute(cursor, [self.session.person_uuid])
 
             row = cursor.fetchone()
 
             if row:
-                self['user'] = row.user
+                self['user'] = self.people.remember(row.user)
                 return self['user']
 
 
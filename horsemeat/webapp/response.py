@@ -34,6 +34,100 @@ def listmofize(x):
 
 log = logging.getLogger(__name__)
 
+class StreamingBody(object):
+
+    """
+    A response body that goes out a chunk at a time, like a big CSV
+    export built on horsemeat.pg.stream_rows.  Make one with
+    Response.stream.
+
+    The server iterates over this after the handler returns, so the
+    dispatcher leaves the request's transaction and connection alone
+    until the server closes the body.  Each chunk gets made in the
+    request's context, so req.pgconn is still the same connection.
+
+    >>> body = StreamingBody(iter(['a', b'b']))
+    >>> list(body), body.finished
+    ([b'a', b'b'], True)
+    """
+
+    def __init__(self, chunks):
+
+        self.chunks = chunks
+        self.iterator = None
+
+        # The dispatcher fills these in with start.
+        self.context = None
+        self.on_close = None
+
+        # True when every chunk went out.
+        self.finished = False
+        self.closed = False
+
+    def start(self, context, on_close):
+
+        """
+        Make the chunks in context, and call on_close(finished) in
+        there after the server closes this.
+        """
+
+        self.context = context
+        self.on_close = on_close
+
+    def run(self, f, *args):
+
+        if self.context is None:
+            return f(*args)
+
+        else:
+            return self.context.run(f, *args)
+
+    def next_chunk(self):
+
+        if self.iterator is None:
+            self.iterator = iter(self.chunks)
+
+        return next(self.iterator)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+
+        try:
+            chunk = self.run(self.next_chunk)
+
+        except StopIteration:
+            self.finished = True
+            raise
+
+        if isinstance(chunk, str):
+            return chunk.encode('utf8')
+
+        else:
+            return chunk
+
+    def close(self):
+
+        if self.closed:
+            return
+
+        self.closed = True
+
+        try:
+
+            # This closes a generator, which closes any cursors it has
+            # open in finally blocks.
+            close = getattr(self.iterator or self.chunks, 'close', None)
+
+            if close:
+                self.run(close)
+
+        finally:
+
+            if self.on_close:
+                self.run(self.on_close, self.finished)
+
 class Response(object):
 
     # Subclasses need to fill these in for themselves.
@@ -75,7 +169,7 @@ class Response(object):
 
         from gunicorn.http.wsgi import FileWrapper
 
-        if isinstance(val, FileWrapper):
+        if isinstance(val, (FileWrapper, StreamingBody)):
             self._body = val
 
         # Remember that in python 3, unicode stuff is just a string.
@@ -468,6 +562,37 @@ class Response(object):
 
         return self
 
+    @classmethod
+    def stream(cls, chunks, content_type='text/plain; charset=utf-8',
+        status='200 OK'):
+
+        """
+        Send chunks (strings or bytes) out one at a time as the server
+        asks for them, rather than building the whole body in memory::
+
+            def handle(self, req):
+
+                def make_csv():
+
+                    for rows in pg.stream_rows(req.pgconn,
+                        "select * from people", batches=True):
+
+                        f = io.StringIO()
+                        csv.writer(f).writerows(rows)
+                        yield f.getvalue()
+
+                return Response.stream(make_csv(), 'text/csv')
+
+        The transaction stays open until the last chunk goes out, so
+        server-side cursors keep working, and then gets committed, or
+        rolled back if making a chunk blew up.
+        """
+
+        return cls(
+            status,
+            [('Content-Type', content_type)],
+            StreamingBody(chunks))
+
     @classmethod
     def csv(cls, data):
 
@@ -494,6 +619,24 @@ class Response(object):
 
         return cls.html(x.encode('utf8'))
 
+    @classmethod
+    async def tmpl_async(cls, template_name, **data):
+
+        """
+        Like tmpl, but for async handlers.  The template can await
+        stuff, like async generators.
+        """
+
+        cw = cls.configwrapper.ConfigWrapper.get_default()
+
+        j = cw.get_async_jinja2_environment()
+
+        template = j.get_template(template_name)
+
+        x = await template.render_async(**data)
+
+        return cls.html(x.encode('utf8'))
+
 
     def set_session_cookie(self, session_uuid, secret,
         expires_date=None, path='/'):
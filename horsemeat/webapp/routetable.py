@@ -0,0 +1,420 @@
+# vim: set expandtab ts=4 sw=4 filetype=python fileencoding=utf8:
+
+"""
+The dispatcher used to ask every handler, one after the other, if it
+wanted the request.  With a few hundred handlers, that's a few hundred
+python function calls per request, and the requests that nobody wants
+(the ones that end up at the NotFound handler) pay the most.
+
+Most handlers don't need to be asked, though.  When a handler uses
+Handler.check_route_strings as its route method, we already know
+exactly which line ones it wants, so we can look those up in a
+dictionary.
+
+And when a handler uses Handler.check_route_patterns, we can glue its
+regular expressions together with everybody else's into one big
+alternation, and then match the line one once.  Every branch ends with
+an empty group named after the handler, so the name of the last group
+that matched tells us which handler won.
+
+The RouteTable below indexes those handlers and only falls back to
+calling route(...) on the handlers that wrote their own route method.
+
+"""
+
+import collections
+import logging
+import re
+import threading
+
+log = logging.getLogger(__name__)
+
+# These are the flags we can turn on inside a scoped group like
+# (?i:...).  Patterns compiled with any other flags don't get merged.
+scoped_flags = [
+    (re.IGNORECASE, 'i'),
+    (re.MULTILINE, 'm'),
+    (re.DOTALL, 's'),
+    (re.VERBOSE, 'x'),
+]
+
+def convert_route_pattern_to_alternative(rp, label):
+
+    r"""
+    Return the source for one branch of the big alternation, or None if
+    I can't safely merge this route pattern.
+
+    Named groups get renamed so that two handlers can both use
+    (?P<club_number>...) without stepping on each other:
+
+    >>> convert_route_pattern_to_alternative(
+    ...     re.compile(r'GET /club/(?P<club_number>\d+)$'), '_r3_0')
+    '(?:GET /club/(?P<_r3_0__club_number>\\d+)$)(?P<_r3_0>)'
+
+    Plain strings have to match the whole line one:
+
+    >>> convert_route_pattern_to_alternative('GET /login', '_r4_0')
+    'GET\\ /login\\Z(?P<_r4_0>)'
+
+    Numbered backreferences would point at the wrong group after the
+    merge, so I give up on those:
+
+    >>> convert_route_pattern_to_alternative(
+    ...     re.compile(r'GET /(\w+)/\1'), '_r5_0') is None
+    True
+
+    """
+
+    if not hasattr(rp, 'match'):
+        return r'{1}\Z(?P<{0}>)'.format(label, re.escape(str(rp)))
+
+    if not isinstance(getattr(rp, 'pattern', None), str):
+        return
+
+    flags = rp.flags & ~re.UNICODE
+    flag_letters = ''
+
+    for flag, letter in scoped_flags:
+        if flags & flag:
+            flag_letters += letter
+            flags &= ~flag
+
+    # Something like re.ASCII or re.LOCALE.
+    if flags:
+        return
+
+    # Numbered backreferences, conditional groups, and global inline
+    # flags like (?i) all break once the pattern is inside a group.
+    if re.search(r'\\[1-9]|\(\?\(|\(\?[aiLmsux]+\)', rp.pattern):
+        return
+
+    body = re.sub(
+        r'\(\?P<(\w+)>',
+        lambda m: '(?P<{0}__{1}>'.format(label, m.group(1)),
+        rp.pattern)
+
+    body = re.sub(
+        r'\(\?P=(\w+)\)',
+        lambda m: '(?P={0}__{1})'.format(label, m.group(1)),
+        body)
+
+    # In verbose mode, a comment on the last line would swallow the
+    # closing parenthesis.
+    if 'x' in flag_letters:
+        body = '(?{0}:{1}\n)'.format(flag_letters, body)
+
+    # Wrap everything else too, in case the pattern has its own
+    # top-level alternation.
+    else:
+        body = '(?{0}:{1})'.format(flag_letters, body)
+
+    # Put the label group at the end, rather than wrapping the whole
+    # branch in it.  The re module gets really slow when every branch
+    # of a big alternation starts with a capturing group.
+    source = '{1}(?P<{0}>)'.format(label, body)
+
+    # Make sure the renaming didn't go sideways, for example, on a
+    # pattern that matches the literal text "(?P<".
+    try:
+        compiled = re.compile(source)
+
+    except re.error:
+        return
+
+    expected_names = set(['{0}__{1}'.format(label, name)
+        for name in rp.groupindex])
+
+    expected_names.add(label)
+
+    if set(compiled.groupindex) == expected_names \
+    and compiled.groups == rp.groups + 1:
+        return source
+
+class RouteTable(object):
+
+    """
+    Build one of these from the dispatcher's list of handlers::
+
+    >>> from horsemeat.webapp.bogusrequest import BogusRequest
+    >>> class FakeHandler(object):
+    ...     route_kind = 'strings'
+    ...     def __init__(self, *route_strings):
+    ...         self.route_strings = set(route_strings)
+
+    >>> a = FakeHandler('GET /a', 'GET /b')
+    >>> b = FakeHandler('GET /b', 'GET /c')
+
+    >>> rt = RouteTable([a, b])
+
+    >>> rt.lookup(BogusRequest.from_line_one('GET /c')) == (1, b, None)
+    True
+
+    When two handlers want the same line one, the first one in the list
+    wins, just like it did before:
+
+    >>> rt.lookup(BogusRequest.from_line_one('GET /b')) == (0, a, None)
+    True
+
+    >>> rt.lookup(BogusRequest.from_line_one('GET /nope'))
+    (None, None, None)
+
+    Handlers with route patterns come back with the named groups that
+    matched:
+
+    >>> class FakePatternHandler(object):
+    ...     route_kind = 'patterns'
+    ...     route_patterns = [re.compile(r'GET /c/(?P<c_id>\d+)$')]
+
+    >>> c = FakePatternHandler()
+    >>> rt = RouteTable([a, c, b])
+
+    >>> rt.lookup(BogusRequest.from_line_one('GET /c/99')) == (
+    ...     1, c, {'c_id': '99'})
+    True
+
+    """
+
+    def __init__(self, handlers):
+
+        self.handlers = list(handlers)
+
+        # Maps line ones like "GET /login" to the position of the first
+        # handler that wants it.
+        self.exact_routes = dict()
+
+        # These are (position, handler) pairs for every handler that
+        # has its own route method.  We have to ask these guys.
+        self.unindexed_handlers = list()
+
+        # Maps each branch of the big alternation to a tuple of
+        # (position, handler, [group names]).
+        self.pattern_branches = dict()
+
+        alternatives = list()
+
+        for position, handler in enumerate(self.handlers):
+
+            route_kind = getattr(handler, 'route_kind', None)
+
+            if route_kind == 'strings':
+
+                for s in handler.route_strings:
+                    self.exact_routes.setdefault(str(s), position)
+
+            elif route_kind == 'patterns':
+
+                if not self.add_pattern_branches(
+                    position, handler, alternatives):
+
+                    self.unindexed_handlers.append((position, handler))
+
+            else:
+                self.unindexed_handlers.append((position, handler))
+
+        if alternatives:
+
+            self.pattern_matcher = re.compile('|'.join(alternatives))
+
+            self.first_pattern_position = min(
+                position for position, handler, names
+                in self.pattern_branches.values())
+
+        else:
+            self.pattern_matcher = None
+            self.first_pattern_position = None
+
+        log.info("Built route table with {0} exact routes, {1} merged "
+            "route patterns, and {2} unindexed handlers".format(
+                len(self.exact_routes),
+                len(self.pattern_branches),
+                len(self.unindexed_handlers)))
+
+    def add_pattern_branches(self, position, handler, alternatives):
+
+        """
+        Add a branch to alternatives for every one of this handler's
+        route patterns and return True.
+
+        If any one of the patterns can't be merged, don't add anything,
+        and return False, so the handler gets its route method called
+        like normal.
+        """
+
+        branches = list()
+
+        for i, rp in enumerate(handler.route_patterns):
+
+            label = '_r{0}_{1}'.format(position, i)
+
+            source = convert_route_pattern_to_alternative(rp, label)
+
+            if source is None:
+
+                log.debug("Can't merge route pattern {0!r} from "
+                    "{1!r}".format(rp, handler))
+
+                return False
+
+            else:
+                branches.append((label, source,
+                    list(getattr(rp, 'groupindex', []))))
+
+        for label, source, names in branches:
+            alternatives.append(source)
+            self.pattern_branches[label] = (position, handler, names)
+
+        return True
+
+    def lookup(self, request):
+
+        """
+        Return a tuple of (position, handler, matched groups) for the
+        first indexed handler that wants this request, or (None, None,
+        None).
+
+        The matched groups are None for handlers found by route
+        strings.  For handlers found by route patterns, it's a
+        dictionary that the dispatcher copies into the request, just
+        like Handler.check_route_patterns does.
+        """
+
+        line_one = str(request.line_one)
+
+        position = self.exact_routes.get(line_one)
+
+        # Only run the big regular expression if a pattern handler
+        # could come in front of the exact match.
+        if self.pattern_matcher is not None and (
+            position is None or position > self.first_pattern_position):
+
+            match = self.pattern_matcher.match(line_one)
+
+            if match:
+
+                pattern_position, handler, names = \
+                self.pattern_branches[match.lastgroup]
+
+                if position is None or pattern_position < position:
+
+                    return pattern_position, handler, dict(
+                        (name, match.group(
+                            '{0}__{1}'.format(match.lastgroup, name)))
+                        for name in names)
+
+        if position is None:
+            return None, None, None
+
+        else:
+            return position, self.handlers[position], None
+
+    def unindexed_handlers_before(self, stop=None):
+
+        """
+        Yield the unindexed handlers that sit in front of position stop
+        in the list of handlers.
+
+        If stop is None, yield all of them.
+        """
+
+        for position, handler in self.unindexed_handlers:
+
+            if stop is not None and position > stop:
+                break
+
+            yield handler
+
+
+CacheInfo = collections.namedtuple('CacheInfo',
+    ['hits', 'misses', 'negative_hits', 'currsize', 'maxsize'])
+
+DispatchDecision = collections.namedtuple('DispatchDecision',
+    ['handler', 'handle_function', 'matched_groups', 'is_negative'])
+
+class DispatchCache(object):
+
+    """
+    A bounded least-recently-used cache of dispatch decisions, keyed by
+    line one.
+
+    The dispatcher only stores a decision here when every handler it
+    asked along the way promised that its route method only looks at
+    the line one.  Decisions that ended up at the NotFound handler get
+    stored too, so bots scanning for /wp-login.php don't cost a trip
+    through every handler.
+
+    >>> dc = DispatchCache(maxsize=2)
+    >>> dc.get('GET /a') is None
+    True
+
+    >>> dc.put('GET /a', DispatchDecision('a', None, None, False))
+    >>> dc.put('GET /b', DispatchDecision('b', None, None, False))
+    >>> dc.get('GET /a').handler
+    'a'
+
+    Now GET /b is the oldest, so it gets pushed out:
+
+    >>> dc.put('GET /c', DispatchDecision('c', None, None, True))
+    >>> dc.get('GET /b') is None
+    True
+
+    >>> dc.get('GET /c').is_negative
+    True
+
+    >>> dc.cache_info()
+    CacheInfo(hits=2, misses=2, negative_hits=1, currsize=2, maxsize=2)
+
+    """
+
+    def __init__(self, maxsize=1024):
+
+        self.maxsize = maxsize
+        self.decisions = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+
+        self.lock = threading.Lock()
+
+    def get(self, line_one):
+
+        with self.lock:
+
+            decision = self.decisions.get(line_one)
+
+            if decision is None:
+                self.misses += 1
+
+            else:
+
+                self.decisions.move_to_end(line_one)
+                self.hits += 1
+
+                if decision.is_negative:
+                    self.negative_hits += 1
+
+            return decision
+
+    def put(self, line_one, decision):
+
+        with self.lock:
+
+            self.decisions[line_one] = decision
+            self.decisions.move_to_end(line_one)
+
+            while len(self.decisions) > self.maxsize:
+                self.decisions.popitem(last=False)
+
+    def clear(self):
+
+        with self.lock:
+            self.decisions.clear()
+
+    def cache_info(self):
+
+        return CacheInfo(
+            self.hits,
+            self.misses,
+            self.negative_hits,
+            len(self.decisions),
+            self.maxsize)
@@ -0,0 +1,135 @@
+# vim: set expandtab ts=4 sw=4 filetype=python fileencoding=utf8:
+
+"""
+Run a horsemeat app under gunicorn without writing a gunicorn command
+line or config file.  Tell it which ConfigWrapper subclass to use and
+which yaml file to load::
+
+    $ horsemeat-serve myproject.configwrapper.ConfigWrapper prod.yaml
+
+Everything else comes from the app section of the yaml file:
+
+    webapp_host
+        Defaults to 127.0.0.1.
+
+    webapp_port
+        Required.
+
+    num_webapp_workers
+        Defaults to 1.  Use auto to get two per CPU plus one.
+
+    num_webapp_threads
+        Defaults to 1.  Use auto to get one per CPU.
+
+    webapp_timeout and webapp_graceful_timeout
+        In seconds.
+
+    webapp_reuse_port
+        Defaults to true.
+
+    pidfile
+        Optional.
+
+    preload_app
+        Build the app once in the master and fork the workers from
+        it.  See ConfigWrapper.prepare_for_fork.
+
+The command-line options override the yaml file.
+
+Send the master a HUP to restart the workers gracefully.  With
+preload_app, the workers fork from the same old app, so to pick up new
+code, start a second master (webapp_reuse_port lets it bind the same
+port) and then send the old one a TERM.
+"""
+
+import argparse
+import importlib
+import logging
+
+import gunicorn.app.base
+
+from horsemeat.webapp import gunicornhooks
+
+log = logging.getLogger(__name__)
+
+class HorsemeatApplication(gunicorn.app.base.BaseApplication):
+
+    def __init__(self, config_wrapper, options):
+
+        self.config_wrapper = config_wrapper
+        self.options = options
+
+        super(HorsemeatApplication, self).__init__()
+
+    def load_config(self):
+
+        for k, v in self.options.items():
+            self.cfg.set(k, v)
+
+    def load(self):
+        return self.config_wrapper.build_webapp()
+
+def make_gunicorn_options(cw):
+
+    """
+    Translate the config wrapper's worker settings into gunicorn
+    settings.
+    """
+
+    options = dict(
+        bind='{0}:{1}'.format(cw.webapp_host, cw.webapp_port),
+        workers=cw.num_webapp_workers,
+        threads=cw.num_webapp_threads,
+        timeout=cw.webapp_timeout_secs,
+        graceful_timeout=cw.webapp_graceful_timeout_secs,
+        reuse_port=cw.webapp_reuse_port,
+        preload_app=cw.preload_app,
+        post_fork=gunicornhooks.post_fork,
+        post_worker_init=gunicornhooks.post_worker_init,
+    )
+
+    if cw.config_dictionary['app'].get('pidfile'):
+        options['pidfile'] = cw.pidfile
+
+    return options
+
+def import_config_wrapper_class(dotted_name):
+
+    module_name, class_name = dotted_name.rsplit('.', 1)
+
+    return getattr(importlib.import_module(module_name), class_name)
+
+def set_up_args():
+
+    ap = argparse.ArgumentParser(
+        description="Run a horsemeat app under gunicorn")
+
+    ap.add_argument('config_wrapper_class',
+        help="Like myproject.configwrapper.ConfigWrapper")
+
+    ap.add_argument('yaml_file_name')
+
+    ap.add_argument('--bind', help="Like 0.0.0.0:8000")
+    ap.add_argument('--workers', type=int)
+    ap.add_argument('--threads', type=int)
+
+    return ap.parse_args()
+
+def main():
+
+    args = set_up_args()
+
+    cls = import_config_wrapper_class(args.config_wrapper_class)
+    cw = cls.load_yaml(args.yaml_file_name)
+
+    options = make_gunicorn_options(cw)
+
+    for k in ('bind', 'workers', 'threads'):
+
+        if getattr(args, k) is not None:
+            options[k] = getattr(args, k)
+
+    HorsemeatApplication(cw, options).run()
+
+if __name__ == '__main__':
+    main()
@@ -31,7 +31,7 @@ setup(
     install_requires=[
         "Jinja2>=2.6",
         "PyYAML>=3.10",
-        "Werkzeug>=0.10.1",
+        "Werkzeug>=2.0",
         "decorator>=3.4.0",
         "psycopg2>=2.7",
         # "nose>=1.3.3",
@@ -51,4 +51,10 @@ setup(
     scripts=[
         "horsemeat/scripts/make-frippery-project",
     ],
+
+    entry_points={
+        "console_scripts": [
+            "horsemeat-serve = horsemeat.webapp.serve:main",
+        ],
+    },
 )